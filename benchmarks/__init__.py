@@ -0,0 +1,40 @@
+"""
+Name:        benchmarks package
+Purpose:     Benchmarks of the BIBFRAME Access and Discovery Catalog views
+             run against an in-process Elastic Search stand-in, measuring
+             wall time and Elastic Search calls per request.
+
+Author:      Jeremy Nelson
+
+Created:     2015/08/03
+Copyright:   (c) Jeremy Nelson 2015
+Licence:     GPLv3
+"""
+__author__ = "Jeremy Nelson"
+__license__ = "GPLv3"
+
+import os
+import sys
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def install(elastic_search):
+    """Swaps the Elastic Search client of every loaded catalog module for
+    another client, i.e. a FakeElasticsearch
+
+    Args:
+        elastic_search -- Elastic Search client
+    """
+    for name, module in list(sys.modules.items()):
+        if name.split(".")[0] != "catalog" or module is None:
+            continue
+        if hasattr(module, 'es_search'):
+            module.es_search = elastic_search
+
+def load_catalog():
+    """Imports the catalog with the benchmark settings unless
+    BIBCAT_SETTINGS is already set"""
+    os.environ.setdefault('BIBCAT_SETTINGS',
+                          os.path.join(BENCHMARK_DIR, 'settings.py'))
+    import catalog
+    return catalog
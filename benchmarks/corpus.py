@@ -0,0 +1,86 @@
+"""
+Name:        corpus
+Purpose:     Generates reproducible BIBFRAME corpora, shaped like the
+             documents the catalog indexes, for the benchmarks.
+
+Author:      Jeremy Nelson
+
+Created:     2015/08/03
+Copyright:   (c) Jeremy Nelson 2015
+Licence:     GPLv3
+"""
+__author__ = "Jeremy Nelson"
+__license__ = "GPLv3"
+
+import random
+import uuid
+
+WORDS = ['actors', 'australia', 'biography', 'crowe', 'history', 'library',
+         'motion', 'pictures', 'russell', 'science', 'colorado', 'music',
+         'poetry', 'mountains', 'rivers', 'catalog', 'linked', 'data',
+         'frame', 'western', 'railroads', 'mining', 'women', 'education']
+
+ORGANIZATIONS = ['Tutt Library', 'Denver Public Library', 'Library of Congress']
+
+def __uuid__(rand):
+    return str(uuid.UUID(int=rand.getrandbits(128), version=4))
+
+def __phrase__(rand, words=3):
+    return " ".join(rand.choice(WORDS) for i in range(words)).title()
+
+def generate_corpus(works, seed=2015):
+    """Generates Works with an Instance, Title, cover art and held items
+    each, and a shared pool of Person, Organization and Topic authorities,
+    returning a list of (uuid, doc_type, _source) tuples.
+
+    Args:
+        works -- number of Works
+        seed -- random seed, defaults to 2015
+    """
+    rand = random.Random(seed)
+    documents = []
+
+    def add(doc_type, source):
+        doc_id = __uuid__(rand)
+        source['fedora:uuid'] = [doc_id]
+        source['fedora:hasLocation'] = [
+            "http://localhost:8080/rest/{}".format(doc_id)]
+        source['type'] = ["bf:{}".format(doc_type)]
+        documents.append((doc_id, doc_type, source))
+        return doc_id
+
+    organizations = [add('Organization', {'bf:label': [name]})
+                     for name in ORGANIZATIONS]
+    people = [add('Person', {'bf:label': [__phrase__(rand, 2)],
+                             'bf:authorizedAccessPoint': [
+                                 __phrase__(rand, 2)]})
+              for i in range(max(works // 10, 1))]
+    topics = [add('Topic', {'bf:label': [__phrase__(rand, 2)]})
+              for i in range(max(works // 20, 1))]
+    for i in range(works):
+        title = __phrase__(rand)
+        title_id = add('Title', {'bf:titleValue': [title]})
+        creators = rand.sample(people, min(len(people), rand.randint(1, 3)))
+        work_id = add('Work', {
+            'bf:workTitle': [title_id],
+            'bf:authorizedAccessPoint': [title],
+            'bf:creator': creators,
+            'bf:subject': rand.sample(topics, 1)})
+        instance_id = add('Instance', {
+            'bf:instanceOf': [work_id],
+            'bf:titleStatement': [title],
+            'bf:extent': ["{} p.".format(rand.randint(50, 900))]})
+        add('CoverArt', {
+            'bf:coverArtFor': [instance_id],
+            'bf:coverArt': ['R0lGODlhAQABAAAAACw='],
+            'schema:isBasedOnUrl': ['http://covers.example.org/{}'.format(i)]})
+        for j in range(rand.randint(1, 3)):
+            add('HeldItem', {
+                'bf:holdingFor': [instance_id],
+                'bf:heldBy': [rand.choice(organizations)],
+                'bf:itemId': ["{}.{}".format(i, j)],
+                'bf:shelfMarkLcc': ["PN{}.C{}".format(rand.randint(1, 9999),
+                                                      j)],
+                'bf:circulationStatus': [rand.choice(['Available',
+                                                      'Checked out'])]})
+    return documents
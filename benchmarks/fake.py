@@ -0,0 +1,274 @@
+"""
+Name:        fake
+Purpose:     In-process stand-in for the Elastic Search client that serves
+             seeded BIBFRAME documents with configurable injected latency
+             and counts every call.
+
+Author:      Jeremy Nelson
+
+Created:     2015/08/03
+Copyright:   (c) Jeremy Nelson 2015
+Licence:     GPLv3
+"""
+__author__ = "Jeremy Nelson"
+__license__ = "GPLv3"
+
+import copy
+import re
+import time
+
+from collections import Counter, defaultdict
+from elasticsearch.exceptions import NotFoundError
+
+TOKEN_RE = re.compile(r"\w+")
+QUERY_STRING_RE = re.compile(r'^(?P<field>[^:]+):"(?P<value>.+)"$')
+
+class FakeElasticsearch(object):
+    """Answers the subset of the Elastic Search client API the catalog
+    uses from documents held in memory.
+
+    Args:
+        documents -- list of (uuid, doc_type, _source) tuples
+        latency -- seconds to sleep on every call
+        latencies -- dict of seconds to sleep by operation, i.e. search
+    """
+
+    def __init__(self, documents=[], latency=0.0, latencies={}):
+        self.latency = latency
+        self.latencies = dict(latencies)
+        self.calls = Counter()
+        self.documents = dict()
+        self.terms = defaultdict(set)
+        self.tokens = defaultdict(set)
+        for uuid, doc_type, source in documents:
+            self.index(uuid, doc_type, source)
+
+    def index(self, uuid, doc_type, source):
+        """Adds a document and indexes its terms and tokens"""
+        self.documents[uuid] = (doc_type, source)
+        self.terms[('_type', doc_type)].add(uuid)
+        for field, values in source.items():
+            if not isinstance(values, list):
+                values = [values]
+            for value in values:
+                if not isinstance(value, str):
+                    continue
+                self.terms[(field, value)].add(uuid)
+                for token in TOKEN_RE.findall(value.lower()):
+                    self.tokens[token].add(uuid)
+
+    def __call__(self, operation):
+        self.calls[operation] += 1
+        delay = self.latencies.get(operation, self.latency)
+        if delay > 0:
+            time.sleep(delay)
+
+    def reset(self):
+        """Resets the call counts"""
+        self.calls.clear()
+
+    def __hit__(self, uuid, fields=None, source=True):
+        doc_type, document = self.documents[uuid]
+        hit = {'_id': uuid,
+               '_index': 'bibframe',
+               '_type': doc_type,
+               '_version': 1,
+               '_score': 1.0,
+               'found': True}
+        if fields is not None:
+            if isinstance(fields, str):
+                fields = fields.split(",")
+            hit['fields'] = dict([(field, list(document[field]))
+                                  for field in fields if field in document])
+        if source is True:
+            hit['_source'] = copy.deepcopy(document)
+        elif source:
+            if isinstance(source, str):
+                source = source.split(",")
+            hit['_source'] = dict([(field, copy.deepcopy(document[field]))
+                                   for field in source if field in document])
+        return hit
+
+    def __filter__(self, es_filter):
+        """Returns the set of ids matching a filter"""
+        if isinstance(es_filter, list):
+            return self.__all_of__(es_filter)
+        if 'and' in es_filter:
+            return self.__all_of__(es_filter['and'])
+        if 'or' in es_filter:
+            output = set()
+            for row in es_filter['or']:
+                output |= self.__filter__(row)
+            return output
+        if 'term' in es_filter:
+            field, value = list(es_filter['term'].items())[0]
+            return set(self.terms.get((field, value), set()))
+        if 'terms' in es_filter:
+            field, values = list(es_filter['terms'].items())[0]
+            output = set()
+            for value in values:
+                output |= self.terms.get((field, value), set())
+            return output
+        if 'type' in es_filter:
+            return set(self.terms.get(('_type', es_filter['type']['value']),
+                                      set()))
+        if 'range' in es_filter:
+            return set()
+        return self.__query__(es_filter.get('query', {"match_all": {}}))
+
+    def __all_of__(self, filters):
+        output = set(self.documents.keys())
+        for row in filters:
+            output &= self.__filter__(row)
+        return output
+
+    def __query__(self, query):
+        """Returns the set of ids matching a query"""
+        if 'match' in query:
+            field, phrase = list(query['match'].items())[0]
+            output = set()
+            for token in TOKEN_RE.findall((phrase or '').lower()):
+                output |= self.tokens.get(token, set())
+            return output
+        if 'filtered' in query:
+            filtered = query['filtered']
+            output = self.__query__(filtered.get('query', {"match_all": {}}))
+            if 'filter' in filtered:
+                output &= self.__filter__(filtered['filter'])
+            return output
+        if 'query_string' in query:
+            match = QUERY_STRING_RE.match(query['query_string']['query'])
+            if match is None:
+                return set(self.documents.keys())
+            return set(self.terms.get(
+                (match.group('field'), match.group('value')), set()))
+        if 'bool' in query:
+            return self.__all_of__(query['bool'].get('must', []))
+        if len(query) < 1 or 'match_all' in query:
+            return set(self.documents.keys())
+        return self.__filter__(query)
+
+    def __aggregate__(self, ids, aggregation):
+        if 'terms' in aggregation:
+            field = aggregation['terms']['field']
+            counts = Counter()
+            for uuid in ids:
+                doc_type, source = self.documents[uuid]
+                if field == '_type':
+                    counts[doc_type] += 1
+                    continue
+                values = source.get(field, [])
+                if not isinstance(values, list):
+                    values = [values]
+                counts.update(values)
+            size = aggregation['terms'].get('size', 10)
+            return {'buckets': [{'key': key, 'doc_count': count}
+                                for key, count in counts.most_common(size)]}
+        if 'filters' in aggregation:
+            return {'buckets': dict([
+                (name, {'doc_count': len(ids & self.__filter__(row))})
+                for name, row in aggregation['filters']['filters'].items()])}
+        return {}
+
+    def __search__(self, body, doc_type=None, size=None, from_=None,
+                   fields=None, _source=True):
+        body = body or {}
+        ids = self.__query__(body.get('query', {"match_all": {}}))
+        if doc_type:
+            types = doc_type.split(",")
+            ids = set([uuid for uuid in ids
+                       if self.documents[uuid][0] in types])
+        size = int(body.get('size', 10) if size is None else size)
+        from_ = int(body.get('from', 0) if from_ is None else from_)
+        ordered = sorted(ids, key=lambda uuid: "{}#{}".format(
+            self.documents[uuid][0], uuid))
+        if 'search_after' in body:
+            last_uid = body['search_after'][-1]
+            ordered = [uuid for uuid in ordered
+                       if "{}#{}".format(self.documents[uuid][0],
+                                         uuid) > last_uid]
+        hits = []
+        for uuid in ordered[from_:from_+size]:
+            hit = self.__hit__(uuid,
+                               fields or body.get('fields'),
+                               _source if not 'fields' in body else False)
+            if isinstance(body.get('sort'), list):
+                hit['sort'] = [1.0, "{}#{}".format(hit['_type'], uuid)]
+            hits.append(hit)
+        result = {'took': 0,
+                  'hits': {'total': len(ids),
+                           'max_score': 1.0,
+                           'hits': hits}}
+        if 'aggs' in body:
+            result['aggregations'] = dict([
+                (name, self.__aggregate__(ids, aggregation))
+                for name, aggregation in body['aggs'].items()])
+        return result
+
+    def exists(self, index, id, doc_type='_all', **params):
+        self('exists')
+        return id in self.documents and \
+            doc_type in ('_all', self.documents[id][0])
+
+    def get(self, index, id, doc_type='_all', fields=None, _source=True,
+            **params):
+        self('get')
+        if not id in self.documents or \
+           not doc_type in ('_all', self.documents[id][0]):
+            raise NotFoundError(404, 'not found')
+        return self.__hit__(id, fields, _source)
+
+    def get_source(self, index, id, doc_type='_all', **params):
+        return self.get(index, id, doc_type)['_source']
+
+    def mget(self, body, index=None, doc_type=None, fields=None,
+             _source_include=None, **params):
+        self('mget')
+        docs = []
+        for uuid in body.get('ids', []):
+            if uuid in self.documents:
+                docs.append(self.__hit__(uuid, fields, _source_include or
+                                         (fields is None)))
+            else:
+                docs.append({'_id': uuid, '_index': index, 'found': False})
+        return {'docs': docs}
+
+    def search(self, index=None, doc_type=None, body=None, size=None,
+               from_=None, fields=None, _source_include=None, **params):
+        self('search')
+        return self.__search__(body, doc_type, size, from_, fields,
+                               _source_include or True)
+
+    def msearch(self, body, index=None, doc_type=None, **params):
+        self('msearch')
+        responses = []
+        for header, search_body in zip(body[::2], body[1::2]):
+            responses.append(self.__search__(search_body, header.get('type')))
+        return {'responses': responses}
+
+    def count(self, index=None, doc_type=None, body=None, **params):
+        self('count')
+        result = self.__search__(body, doc_type, size=0)
+        return {'count': result['hits']['total']}
+
+    def suggest(self, body, index=None, **params):
+        self('suggest')
+        output = dict()
+        for name, suggester in body.items():
+            prefix = (suggester.get('text') or '').lower()
+            doc_type = suggester['completion']['field'].split("_")[0]
+            options = []
+            for uuid, (type_, source) in self.documents.items():
+                if type_.lower() != doc_type:
+                    continue
+                for label in source.get('bf:label', []):
+                    if label.lower().startswith(prefix):
+                        options.append({'text': label,
+                                        'score': 1.0,
+                                        'payload': {'id': uuid}})
+                        break
+                if len(options) >= suggester['completion'].get('size', 5):
+                    break
+            output[name] = [{'text': prefix, 'offset': 0,
+                             'length': len(prefix), 'options': options}]
+        return output
@@ -0,0 +1,166 @@
+"""
+Name:        run
+Purpose:     Runs the catalog view benchmarks against FakeElasticsearch at
+             several corpus sizes, reporting wall time and Elastic Search
+             calls per request.
+
+             python -m benchmarks.run --sizes 100 1000 --latency 0.002
+
+Author:      Jeremy Nelson
+
+Created:     2015/08/03
+Copyright:   (c) Jeremy Nelson 2015
+Licence:     GPLv3
+"""
+__author__ = "Jeremy Nelson"
+__license__ = "GPLv3"
+
+import argparse
+import json
+import sys
+import time
+
+from . import install, load_catalog
+from .corpus import generate_corpus
+from .fake import FakeElasticsearch
+
+def scenarios(documents):
+    """Returns the (name, method, path, data) requests to benchmark for a
+    corpus"""
+    first = dict()
+    for uuid, doc_type, source in documents:
+        first.setdefault(doc_type, (uuid, source))
+    work_id = first['Work'][0]
+    instance_id = first['Instance'][0]
+    phrase = first['Work'][1]['bf:authorizedAccessPoint'][0].split()[0]
+    return [
+        ("search", "POST", "/search",
+         {"phrase": phrase, "from": 0, "size": 20}),
+        ("typeahead", "GET", "/typeahead",
+         {"q": phrase[:3], "type": "Work"}),
+        ("typeahead-all", "GET", "/typeahead",
+         {"q": phrase[:3], "type": "AllTypes"}),
+        ("itemDetails", "GET", "/itemDetails",
+         {"uuid": work_id, "type": "Work"}),
+        ("classcount", "GET", "/classcount", {}),
+        ("work-detail", "GET", "/Work/{}".format(work_id), {}),
+        ("instance-detail", "GET", "/Instance/{}".format(instance_id), {}),
+        ("detail-json", "GET", "/Instance/{}.json".format(instance_id), {}),
+        ("detail-redirect", "GET", "/{}".format(work_id), {})]
+
+def reset_caches(catalog):
+    """Empties the process-wide caches so every request is measured cold"""
+    catalog.cache.label_cache.clear()
+    catalog.cache.sparql_cache.clear()
+    catalog.views.class_counts.value = None
+
+def denormalize(catalog, documents):
+    """Adds the index-time display fields to the Works and Instances of a
+    corpus, as python -m catalog.denormalize --all would"""
+    from catalog.denormalize import display_fields
+    elastic_search = FakeElasticsearch(documents)
+    with catalog.app.app_context():
+        fields = display_fields(documents, elastic_search)
+    return [(uuid, doc_type, dict(source, **fields.get(uuid, {})))
+            for uuid, doc_type, source in documents]
+
+def benchmark(size, latency=0.0, repeat=5, warm=False, denormalized=False):
+    """Benchmarks every scenario against a corpus of size Works
+
+    Args:
+        size -- number of Works in the corpus
+        latency -- seconds of latency injected in every Elastic Search call
+        repeat -- number of requests for each scenario
+        warm -- keep the process-wide caches between requests
+        denormalized -- add the index-time display fields to the corpus
+    """
+    catalog = load_catalog()
+    documents = generate_corpus(size)
+    if denormalized:
+        documents = denormalize(catalog, documents)
+    elastic_search = FakeElasticsearch(documents, latency=latency)
+    install(elastic_search)
+    client = catalog.app.test_client()
+    results = []
+    for name, method, path, data in scenarios(documents):
+        timings, calls = [], None
+        for i in range(repeat):
+            if not warm:
+                reset_caches(catalog)
+            elastic_search.reset()
+            start = time.perf_counter()
+            if method == "POST":
+                response = client.post(path, data=data)
+            else:
+                response = client.get(path, query_string=data)
+            timings.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                raise RuntimeError("{} {} returned {}".format(
+                    method, path, response.status_code))
+            if calls is None:
+                calls = dict(elastic_search.calls)
+        results.append({
+            "size": size,
+            "documents": len(documents),
+            "scenario": name,
+            "mean_ms": round(1000 * sum(timings) / len(timings), 3),
+            "min_ms": round(1000 * min(timings), 3),
+            "es_calls": sum(calls.values()),
+            "es_operations": calls})
+    return results
+
+def check(results, tolerance=1):
+    """Returns the scenarios whose Elastic Search calls per request grow
+    with the corpus size, a sign of an N+1 query. The tolerance allows for
+    calls that depend on which document types a page of hits holds.
+
+    Args:
+        results -- benchmark results
+        tolerance -- allowed growth in calls, defaults to 1
+    """
+    calls = dict()
+    for row in sorted(results, key=lambda row: row['size']):
+        calls.setdefault(row['scenario'], []).append(row['es_calls'])
+    return sorted([name for name, counts in calls.items()
+                   if max(counts) - counts[0] > tolerance])
+
+def main(args):
+    results = []
+    for size in args.sizes:
+        results.extend(benchmark(size, args.latency, args.repeat, args.warm,
+                                 args.denormalized))
+    print("{:<18} {:>8} {:>10} {:>10} {:>9}".format(
+        "scenario", "works", "mean ms", "min ms", "ES calls"))
+    for row in results:
+        print("{scenario:<18} {size:>8} {mean_ms:>10} {min_ms:>10} "
+              "{es_calls:>9}".format(**row))
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+    if args.check:
+        growing = check(results, args.tolerance)
+        if len(growing) > 0:
+            print("Elastic Search calls grow with corpus size for: {}".format(
+                ", ".join(growing)))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the catalog views with FakeElasticsearch")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000],
+                        help='Corpus sizes in Works, defaults to 100 1000')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds injected in every Elastic Search call')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Requests for each scenario, defaults to 5')
+    parser.add_argument('--warm', action='store_true',
+                        help='Keep process-wide caches between requests')
+    parser.add_argument('--denormalized', action='store_true',
+                        help='Index the corpus with display fields')
+    parser.add_argument('--json', help='Write the results to a JSON file')
+    parser.add_argument('--check', action='store_true',
+                        help='Exit 1 if ES calls per request grow with size')
+    parser.add_argument('--tolerance', type=int, default=1,
+                        help='Growth in ES calls allowed by --check')
+    sys.exit(main(parser.parse_args()))
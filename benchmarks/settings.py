@@ -0,0 +1,6 @@
+"""Configuration used by the benchmarks, loaded with the BIBCAT_SETTINGS
+environmental variable"""
+SECRET_KEY = "bibcat-benchmarks"
+ELASTIC_SEARCH = "localhost:9200"
+KIBANA_URL = "localhost:5601"
+WTF_CSRF_ENABLED = False
@@ -30,10 +30,19 @@ from .forms import BasicSearch
 import sys
 
 app = Flask(__name__,  instance_relative_config=True)
-app.config.from_pyfile('config.py')
-
-es_search = Elasticsearch([app.config.get("ELASTIC_SEARCH")])
-if 'DATASTORE' in app.config:
+if 'BIBCAT_SETTINGS' in os.environ:
+    app.config.from_envvar('BIBCAT_SETTINGS')
+else:
+    app.config.from_pyfile('config.py')
+
+from .metrics import InstrumentedClient
+es_search = InstrumentedClient(
+    Elasticsearch([app.config.get("ELASTIC_SEARCH")]),
+    'es')
+# Name of the Elastic Search index, or of the alias of the live versioned
+# index maintained with python -m catalog.reindex
+es_index = app.config.get('ELASTIC_INDEX', 'bibframe')
+if 'host' in app.config.get('DATASTORE', {}):
     datastore_url = "http://"
     datastore_url += ":".join([app.config['DATASTORE']['host'], 
                                str(app.config['DATASTORE']['port'])])
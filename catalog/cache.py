@@ -0,0 +1,313 @@
+"""
+Name:        cache
+Purpose:     Caches of Elastic Search documents for the BIBFRAME Access
+             and Discovery Catalog.
+
+Author:      Jeremy Nelson
+
+Created:     2015/07/22
+Copyright:   (c) Jeremy Nelson 2015
+Licence:     GPLv3
+"""
+__author__ = "Jeremy Nelson"
+__license__ = "GPLv3"
+
+import logging
+import re
+import threading
+import time
+
+from collections import OrderedDict
+from flask import g
+from . import app, es_index, es_search
+
+logger = logging.getLogger(__name__)
+
+class EntityMap(object):
+    """Request-scoped identity map of bibframe documents. Every document
+    is fetched at most once per request and pending ids are fetched
+    together with a single mget."""
+
+    def __init__(self, elastic_search, index=es_index):
+        self.elastic_search = elastic_search
+        self.index = index
+        self.sources = dict()
+        self.versions = dict()
+        self.pending = set()
+        self.hits, self.misses = 0, 0
+
+    def prime(self, uuids):
+        """Queues ids to be fetched with the next mget
+
+        Args:
+            uuids -- iterable of document ids
+        """
+        for uuid in uuids:
+            if not uuid in self.sources:
+                self.pending.add(uuid)
+
+    def put(self, uuid, source):
+        """Adds a document _source already retrieved by a search
+
+        Args:
+            uuid -- document id
+            source -- document _source
+        """
+        self.sources[uuid] = source
+        self.pending.discard(uuid)
+
+    def flush(self):
+        """Fetches all pending ids with a single mget, documents that are
+        not found are remembered as None"""
+        if len(self.pending) < 1:
+            return
+        uuids = list(self.pending)
+        self.pending.clear()
+        result = self.elastic_search.mget(
+            body={'ids': uuids},
+            index=self.index)
+        for uuid in uuids:
+            self.sources[uuid] = None
+        for doc in result.get('docs', []):
+            if doc.get('found'):
+                self.sources[doc['_id']] = doc.get('_source')
+                self.versions[doc['_id']] = doc.get('_version')
+
+    def get_many(self, uuids):
+        """Returns a dict of _source by id for the found documents
+
+        Args:
+            uuids -- iterable of document ids
+        """
+        uuids = list(uuids)
+        for uuid in uuids:
+            if uuid in self.sources:
+                self.hits += 1
+            else:
+                self.misses += 1
+        self.prime(uuids)
+        self.flush()
+        return dict([(uuid, self.sources[uuid]) for uuid in uuids
+                     if self.sources.get(uuid) is not None])
+
+    def get(self, uuid):
+        """Returns the _source of a document or None if not found
+
+        Args:
+            uuid -- document id
+        """
+        return self.get_many([uuid]).get(uuid)
+
+    def stats(self):
+        """Returns the hit and miss counts for the request"""
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "size": len(self.sources)}
+
+
+class LRUCache(object):
+    """Bounded, thread-safe least recently used cache whose entries 
+    expire after ttl seconds. Each entry keeps the Elastic Search _version
+    it was read from so that it can be invalidated by newer versions."""
+
+    def __init__(self, maxsize=10000, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def get(self, key):
+        """Returns the cached value or None if missing or expired
+
+        Args:
+            key -- cache key
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[2] < time.time():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, version=None):
+        """Caches a value, evicting the least recently used entries
+
+        Args:
+            key -- cache key
+            value -- value to cache
+            version -- Elastic Search _version of the value
+        """
+        with self.lock:
+            self.entries[key] = (value, version, time.time() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key, version=None):
+        """Removes an entry, if version is given only when the cached
+        entry is older than that version
+
+        Args:
+            key -- cache key
+            version -- current Elastic Search _version
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            if version is None or entry[1] is None or entry[1] < version:
+                del self.entries[key]
+
+    def purge(self, predicate):
+        """Removes every entry whose key matches the predicate
+
+        Args:
+            predicate -- function taking a key and returning True to remove
+        """
+        with self.lock:
+            for key in [key for key in self.entries if predicate(key)]:
+                del self.entries[key]
+
+    def clear(self):
+        """Removes all entries"""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """Returns the size, hit, miss and eviction counts"""
+        return {"size": len(self.entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions}
+
+
+class RefreshingValue(object):
+    """Value produced by a loader that is served from memory and reloaded
+    every interval seconds by a background thread. Requests are always
+    answered with the last loaded value, even while it is being reloaded,
+    and only the very first request waits for the loader."""
+
+    def __init__(self, loader, interval=300):
+        self.loader = loader
+        self.interval = interval
+        self.value = None
+        self.loaded = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Calls the loader and stores its value"""
+        value = self.loader()
+        self.value, self.loaded = value, time.time()
+        return value
+
+    def __run__(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.load()
+            except Exception:
+                logger.exception("Refreshing %s failed", self.loader.__name__)
+
+    def get(self):
+        """Returns the current value, loading it on the first call and 
+        starting the background refresh thread"""
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.__run__,
+                    name="refresh-{}".format(self.loader.__name__))
+                self.thread.daemon = True
+                self.thread.start()
+            if self.value is None:
+                return self.load()
+        return self.value
+
+    def age(self):
+        """Returns the seconds since the value was last loaded"""
+        if self.loaded is None:
+            return None
+        return time.time() - self.loaded
+
+
+label_cache = LRUCache(
+    app.config.get('LABEL_CACHE_SIZE', 10000),
+    app.config.get('LABEL_CACHE_TTL', 3600))
+
+sparql_cache = LRUCache(
+    app.config.get('SPARQL_CACHE_SIZE', 1000),
+    app.config.get('SPARQL_CACHE_TTL', 300))
+
+# IRIs and string literals are kept as they are, runs of whitespace and
+# comments between them become a single space
+SPARQL_KEY_RE = re.compile(
+    r'(<[^<>"{}|^`\\\s]*>'
+    r'|"""(?:[^"\\]|\\.|"(?!""))*"""'
+    r"|'''(?:[^'\\]|\\.|'(?!''))*'''"
+    r'|"(?:[^"\\\n]|\\.)*"'
+    r"|'(?:[^'\\\n]|\\.)*')"
+    r"|(?:\s|#[^\n]*)+")
+
+def __sparql_token__(match):
+    return match.group(1) or " "
+
+def normalize_sparql(sparql):
+    """Normalizes the whitespace and comments of a SPARQL query for use as
+    a cache key"""
+    return SPARQL_KEY_RE.sub(__sparql_token__, sparql).strip()
+
+def purge_sparql_cache(fedora_url=None):
+    """Purges the cached SPARQL results of queries mentioning a 
+    repository url, or all of them, when the repository changes
+
+    Args:
+        fedora_url -- optional fedora:hasLocation url that changed
+    """
+    if fedora_url is None:
+        sparql_cache.clear()
+    else:
+        sparql_cache.purge(lambda key: "<{}>".format(fedora_url) in key)
+
+def get_labels(uuids):
+    """Returns a dict of bf:label lists by id, reading from the 
+    process-wide label cache before the request's EntityMap
+
+    Args:
+        uuids -- iterable of document ids
+    """
+    output, missing = dict(), []
+    for uuid in uuids:
+        label = label_cache.get(uuid)
+        if label is None:
+            missing.append(uuid)
+        else:
+            output[uuid] = label
+    if len(missing) < 1:
+        return output
+    entities = entity_map()
+    for uuid, source in entities.get_many(missing).items():
+        if 'bf:label' in source:
+            output[uuid] = source['bf:label']
+            label_cache.set(uuid, 
+                            source['bf:label'], 
+                            entities.versions.get(uuid))
+    return output
+
+def entity_map():
+    """Returns the EntityMap for the current request"""
+    if not hasattr(g, 'entity_map'):
+        g.entity_map = EntityMap(es_search)
+    return g.entity_map
+
+@app.teardown_request
+def log_entity_map(exception=None):
+    if hasattr(g, 'entity_map'):
+        logger.debug("Entity map %s", g.entity_map.stats())
@@ -0,0 +1,97 @@
+"""
+Name:        datastore
+Purpose:     SPARQL datastore backends for the BIBFRAME Access and
+             Discovery Catalog, either the triplestore of the semantic
+             server or an in-process rdflib graph.
+
+Author:      Jeremy Nelson
+
+Created:     2015/07/29
+Copyright:   (c) Jeremy Nelson 2015
+Licence:     GPLv3
+"""
+__author__ = "Jeremy Nelson"
+__license__ = "GPLv3"
+
+import json
+import logging
+import threading
+
+import rdflib
+import requests
+from rdflib.util import guess_format
+from . import app
+from .metrics import InstrumentedClient
+from .upstream import triplestore
+
+logger = logging.getLogger(__name__)
+
+class HTTPDatastore(object):
+    """Sends SPARQL queries to the /triplestore of the semantic server"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def query(self, sparql):
+        """Returns the SPARQL JSON results or None if the triplestore is
+        unavailable or returns an error
+
+        Args:
+            sparql -- SPARQL query
+        """
+        try:
+            result = self.client.post('/triplestore', data={"sparql": sparql})
+        except requests.exceptions.RequestException:
+            return None
+        if result.status_code < 400:
+            return result.json()['results']
+
+
+class LocalDatastore(object):
+    """Answers SPARQL queries from an rdflib graph held in memory, loaded
+    from Turtle, N-Triples or RDF/XML dumps, i.e. the Library of Congress
+    BIBFRAME sample collections, on the first query"""
+
+    def __init__(self, paths, store='default'):
+        self.paths = paths
+        self.store = store
+        self.graph = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Parses the dumps into the graph"""
+        graph = rdflib.Graph(store=self.store)
+        for path in self.paths:
+            graph.parse(path, format=guess_format(path) or 'turtle')
+            logger.info("Loaded %s, graph has %s triples", path, len(graph))
+        self.graph = graph
+        return graph
+
+    def query(self, sparql):
+        """Returns the SPARQL JSON results or None if the query fails
+
+        Args:
+            sparql -- SPARQL query
+        """
+        with self.lock:
+            graph = self.graph
+            if graph is None:
+                graph = self.load()
+        try:
+            result = graph.query(sparql)
+        except Exception:
+            logger.exception("SPARQL query failed")
+            return None
+        return json.loads(result.serialize(format='json'))['results']
+
+
+def __datastore__():
+    """Creates the datastore backend named by DATASTORE['backend'],
+    http (the default) or rdflib"""
+    config = app.config.get('DATASTORE', {})
+    if config.get('backend', 'http') == 'rdflib':
+        return LocalDatastore(config.get('files', []),
+                              config.get('store', 'default'))
+    return HTTPDatastore(triplestore)
+
+sparql_backend = InstrumentedClient(__datastore__(), 'sparql')
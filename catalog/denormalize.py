@@ -0,0 +1,289 @@
+"""
+Name:        denormalize
+Purpose:     Index-time display fields for Works and Instances. Writes a
+             precomputed display_title, display_creators, cover_id and
+             holdings_summary into each document so that search results
+             render from _source alone, and refreshes the documents that
+             reference a changed agent, Title, CoverArt or HeldItem.
+
+             python -m catalog.denormalize --all
+             python -m catalog.denormalize --changed <uuid> [<uuid> ...]
+
+Author:      Jeremy Nelson
+
+Created:     2015/08/06
+Copyright:   (c) Jeremy Nelson 2015
+Licence:     GPLv3
+"""
+__author__ = "Jeremy Nelson"
+__license__ = "GPLv3"
+
+import argparse
+import logging
+
+from elasticsearch.helpers import bulk, scan
+from . import app, es_index, es_search
+from .filters import guess_name
+from .util import __cover_art_dsl__, __held_items_dsl__
+from .util import __held_items_result__, __format_held_items__
+
+logger = logging.getLogger(__name__)
+
+DISPLAY_FIELDS = ['display_title',
+                  'display_creators',
+                  'cover_id',
+                  'holdings_summary']
+DENORMALIZED_TYPES = ['Work', 'Instance']
+# Fields whose values are the uuids a Work or Instance depends on, by the
+# type of the referenced document
+REFERENCE_FIELDS = {'Title': ('Work', 'bf:workTitle'),
+                    'Person': ('Work', 'bf:creator'),
+                    'Organization': ('Work', 'bf:creator'),
+                    'Family': ('Work', 'bf:creator'),
+                    'Meeting': ('Work', 'bf:creator'),
+                    'Jurisdiction': ('Work', 'bf:creator'),
+                    'Agent': ('Work', 'bf:creator')}
+
+def __mget__(elastic_search, uuids, index):
+    """Returns the found documents by id"""
+    uuids = list(uuids)
+    if len(uuids) < 1:
+        return dict()
+    result = elastic_search.mget(body={"ids": uuids}, index=index)
+    return dict([(doc['_id'], doc) for doc in result.get('docs', [])
+                 if doc.get('found')])
+
+def __agent_label__(agent):
+    for field in ['bf:label', 'bf:authorizedAccessPoint']:
+        if len(agent.get(field, [])) > 0:
+            return agent[field][0]
+
+def __display_title__(doc_type, source, linked):
+    if doc_type == 'Work':
+        titles = [guess_name(linked[title_id])
+                  for title_id in source.get('bf:workTitle', [])
+                  if title_id in linked]
+        if len(titles) > 0:
+            return ",".join(titles)
+        return ",".join(source.get('bf:authorizedAccessPoint', [])[:1])
+    return guess_name(source)
+
+def __instances_of__(elastic_search, work_ids, index):
+    """Returns the ids of the Instances of each of the Works"""
+    work_ids = list(work_ids)
+    instances = dict([(work_id, []) for work_id in work_ids])
+    if len(work_ids) < 1:
+        return instances
+    query = {"query": {"filtered": {"filter": {
+                 "terms": {"bf:instanceOf": work_ids}}}},
+             "fields": ["bf:instanceOf"]}
+    for hit in scan(elastic_search,
+                    query=query,
+                    index=index,
+                    doc_type='Instance'):
+        for work_id in hit.get('fields', {}).get('bf:instanceOf', [])[:1]:
+            if work_id in instances:
+                instances[work_id].append(hit['_id'])
+    return instances
+
+def display_fields(documents, elastic_search=None, index=es_index):
+    """Computes the display fields of the Works and Instances in a batch of
+    documents with two mgets, a scan for the Instances of the Works and
+    one msearch, returning a dict of fields by id. The cover and holdings
+    of a Work are those of its Instances.
+
+    Args:
+        documents -- list of (uuid, doc_type, _source) tuples
+        elastic_search -- Elastic Search client, defaults to es_search
+        index -- Elastic Search index, defaults to bibframe
+    """
+    elastic_search = elastic_search or es_search
+    batch = [(uuid, doc_type, source) for uuid, doc_type, source in documents
+             if doc_type in DENORMALIZED_TYPES]
+    works = dict([(uuid, source) for uuid, doc_type, source in batch
+                  if doc_type == 'Work'])
+    work_ids = set()
+    for uuid, doc_type, source in batch:
+        if doc_type == 'Instance':
+            work_ids.update(source.get('bf:instanceOf', [])[:1])
+    for uuid, doc in __mget__(elastic_search,
+                              work_ids - set(works),
+                              index).items():
+        works[uuid] = doc['_source']
+    linked_ids = set()
+    for work in works.values():
+        linked_ids.update(work.get('bf:workTitle', []))
+        linked_ids.update(work.get('bf:creator', []))
+    linked = dict([(uuid, doc['_source']) for uuid, doc in __mget__(
+        elastic_search, linked_ids, index).items()])
+    work_instances = __instances_of__(
+        elastic_search,
+        [uuid for uuid, doc_type, source in batch if doc_type == 'Work'],
+        index)
+    output, holders, msearch_body = dict(), [], []
+    for uuid, doc_type, source in batch:
+        if doc_type == 'Work':
+            work, instance_ids = source, work_instances.get(uuid, [])
+        else:
+            work = works.get((source.get('bf:instanceOf') or [None])[0], {})
+            instance_ids = uuid
+        creators = [__agent_label__(linked[agent_id])
+                    for agent_id in work.get('bf:creator', [])
+                    if agent_id in linked]
+        output[uuid] = {
+            "display_title": __display_title__(doc_type, source, linked),
+            "display_creators": [label for label in creators if label],
+            "cover_id": None,
+            "holdings_summary": {"count": 0, "available": 0, "items": []}}
+        if len(instance_ids) < 1:
+            continue
+        holders.append(uuid)
+        msearch_body.extend([
+            {'index': index},
+            __cover_art_dsl__(instance_ids),
+            {'index': index, 'type': 'HeldItem'},
+            __held_items_dsl__(instance_ids)])
+    if len(msearch_body) > 0:
+        responses = elastic_search.msearch(
+            body=msearch_body).get('responses', [])
+        for i, uuid in enumerate(holders):
+            cover_hits = responses[2*i].get('hits', {}).get('hits', [])
+            if len(cover_hits) > 0:
+                output[uuid]['cover_id'] = cover_hits[0]['_id']
+            items = __format_held_items__(
+                __held_items_result__(responses[2*i+1]))
+            output[uuid]['holdings_summary'] = {
+                "count": len(items),
+                "available": len([item for item in items
+                                  if item['circulationStatus'] ==
+                                      'Available']),
+                "items": items}
+    return output
+
+def __referencing__(elastic_search, doc_type, field, uuids, index):
+    """Returns the ids of documents of a type with any of the uuids in a
+    field"""
+    uuids = list(uuids)
+    if len(uuids) < 1:
+        return set()
+    query = {"query": {"filtered": {"filter": {"terms": {field: uuids}}}},
+             "fields": []}
+    return set([hit['_id'] for hit in scan(elastic_search,
+                                           query=query,
+                                           index=index,
+                                           doc_type=doc_type)])
+
+def dependents(uuid, doc_type, source, elastic_search=None, index=es_index):
+    """Returns the ids of the Works and Instances whose display fields
+    depend on a document, including the document itself. A Work depends
+    on the cover art and held items of its Instances.
+
+    Args:
+        uuid -- id of the changed document
+        doc_type -- Elastic Search type of the changed document
+        source -- _source of the changed document
+        elastic_search -- Elastic Search client, defaults to es_search
+        index -- Elastic Search index, defaults to bibframe
+    """
+    elastic_search = elastic_search or es_search
+    works, instances = set(), set()
+    if doc_type == 'Work':
+        works.add(uuid)
+    elif doc_type in REFERENCE_FIELDS:
+        referencing_type, field = REFERENCE_FIELDS[doc_type]
+        works.update(__referencing__(
+            elastic_search, referencing_type, field, [uuid], index))
+    instances.update(__referencing__(
+        elastic_search, 'Instance', 'bf:instanceOf', works, index))
+    if doc_type == 'Instance':
+        instances.add(uuid)
+        works.update(source.get('bf:instanceOf', [])[:1])
+    elif doc_type in ['HeldItem', 'CoverArt']:
+        field = 'bf:holdingFor' if doc_type == 'HeldItem' else \
+            'bf:coverArtFor'
+        holders = source.get(field, [])
+        instances.update(holders)
+        for instance in __mget__(elastic_search, holders, index).values():
+            works.update(instance['_source'].get('bf:instanceOf', [])[:1])
+    return works | instances
+
+def refresh(uuids, elastic_search=None, index=es_index, batch_size=100):
+    """Recomputes and writes the display fields of Works and Instances in
+    batches with partial updates through _bulk, returning the number of
+    documents updated
+
+    Args:
+        uuids -- iterable of document ids
+        elastic_search -- Elastic Search client, defaults to es_search
+        index -- Elastic Search index, defaults to bibframe
+        batch_size -- documents per mget and _bulk request
+    """
+    elastic_search = elastic_search or es_search
+    uuids, updated = list(uuids), 0
+    for start in range(0, len(uuids), batch_size):
+        docs = __mget__(elastic_search, uuids[start:start+batch_size], index)
+        documents = [(uuid, doc['_type'], doc['_source'])
+                     for uuid, doc in docs.items()]
+        fields = display_fields(documents, elastic_search, index)
+        actions = [{"_op_type": "update",
+                    "_index": index,
+                    "_type": docs[uuid]['_type'],
+                    "_id": uuid,
+                    "doc": row} for uuid, row in fields.items()]
+        if len(actions) > 0:
+            count, errors = bulk(elastic_search, actions, raise_on_error=False)
+            updated += count
+            for error in errors:
+                logger.error("Display fields update failed %s", error)
+    return updated
+
+def refresh_all(elastic_search=None, index=es_index, batch_size=100):
+    """Writes the display fields of every Work and Instance in the index"""
+    elastic_search = elastic_search or es_search
+    query = {"query": {"match_all": {}}, "fields": []}
+    uuids = [hit['_id'] for hit in scan(elastic_search,
+                                        query=query,
+                                        index=index,
+                                        doc_type=",".join(DENORMALIZED_TYPES))]
+    return refresh(uuids, elastic_search, index, batch_size)
+
+def refresh_changed(uuids, elastic_search=None, index=es_index,
+                    batch_size=100):
+    """Refreshes the display fields of the documents that depend on
+    changed documents
+
+    Args:
+        uuids -- ids of the changed documents
+    """
+    elastic_search = elastic_search or es_search
+    stale = set()
+    for uuid, doc in __mget__(elastic_search, uuids, index).items():
+        stale.update(dependents(uuid, doc['_type'], doc['_source'],
+                                elastic_search, index))
+    return refresh(sorted(stale), elastic_search, index, batch_size)
+
+def main(args):
+    logging.basicConfig(level=logging.INFO)
+    with app.app_context():
+        updated = __refresh__(args)
+    logger.info("Updated the display fields of %s documents", updated)
+
+def __refresh__(args):
+    if args.all:
+        return refresh_all(batch_size=args.batch_size)
+    elif args.changed:
+        return refresh_changed(args.uuids, batch_size=args.batch_size)
+    else:
+        return refresh(args.uuids, batch_size=args.batch_size)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Writes the display fields of Works and Instances")
+    parser.add_argument('uuids', nargs='*', help='Document ids')
+    parser.add_argument('--all', action='store_true',
+                        help='Refresh every Work and Instance')
+    parser.add_argument('--changed', action='store_true',
+                        help='The uuids changed, refresh their dependents')
+    parser.add_argument('--batch-size', type=int, default=app.config.get(
+        'DENORMALIZE_BATCH_SIZE', 100))
+    main(parser.parse_args())
@@ -22,10 +22,12 @@ import json
 import rdflib
 import urllib.request
 import re
-from flask import render_template, url_for
+from flask import g, render_template, url_for
 from .forms import BasicSearch
 import sys
 from . import app, datastore_url, es_search
+from .datastore import sparql_backend
+from .cache import entity_map, get_labels, normalize_sparql, sparql_cache
 from .util import *
 from .util import __get_cover_art__, __get_held_items__
 
@@ -69,6 +71,33 @@ WHERE {{{{
 
 
 
+# Held items and cover art of many Works or Instances in one query, the
+# entity urls are listed in the VALUES block
+ENTITY_DETAILS_SPARQL = """{}
+SELECT DISTINCT ?entity ?detail ?uuid
+WHERE {{{{
+   VALUES ?entity {{{{ {{}} }}}}
+   {{{{
+      ?held_item bf:holdingFor ?entity .
+      ?held_item fedora:uuid ?uuid .
+      BIND("held_item" AS ?detail)
+   }}}} UNION {{{{
+      ?instance bf:instanceOf ?entity .
+      ?held_item bf:holdingFor ?instance .
+      ?held_item fedora:uuid ?uuid .
+      BIND("held_item" AS ?detail)
+   }}}} UNION {{{{
+      ?cover_metadata bf:coverArtFor ?entity .
+      ?cover_metadata fedora:uuid ?uuid .
+      BIND("cover" AS ?detail)
+   }}}} UNION {{{{
+      ?instance bf:instanceOf ?entity .
+      ?cover_metadata bf:coverArtFor ?instance .
+      ?cover_metadata fedora:uuid ?uuid .
+      BIND("cover" AS ?detail)
+   }}}}
+}}}}""".format(PREFIX)
+
 GET_INSTANCE_SPARQL = """{}
 SELECT DISTINCT ?instance
 WHERE {{{{
@@ -98,6 +127,18 @@ WHERE {{{{
    ?org bf:label ?org_label .
 }}}}""".format(PREFIX)
 
+# Held item details for many fedora:uuids listed in the VALUES block
+HELD_ITEMS_DETAILS_SPARQL = """{}
+SELECT DISTINCT ?uuid ?org_label ?circ_status ?item_id
+WHERE {{{{
+   VALUES ?uuid {{{{ {{}} }}}}
+   ?held_item fedora:uuid ?uuid .
+   ?held_item bf:circulationStatus ?circ_status .
+   ?held_item bf:itemId ?item_id .
+   ?held_item bf:heldBy ?org .
+   ?org bf:label ?org_label .
+}}}}""".format(PREFIX)
+
 HELD_ITEMS_SPARQL = """{}
 SELECT DISTINCT ?uuid
 WHERE {{{{
@@ -116,6 +157,22 @@ WHERE {{{{
 
 
 
+def __sparql__(sparql):
+    """Sends a SPARQL query to the datastore, returning the results or
+    None if the datastore is unavailable or returns an error
+
+    Args:
+        sparql -- SPARQL query
+    """
+    key = normalize_sparql(sparql)
+    results = sparql_cache.get(key)
+    if results is not None:
+        return results
+    results = sparql_backend.query(sparql)
+    if results is not None:
+        sparql_cache.set(key, results)
+    return results
+
 @app.template_filter('bf_type')
 def bibframe_type(entity):
     if 'type' in entity:
@@ -127,27 +184,96 @@ def bibframe_type(entity):
 @app.template_filter('cover_art')
 def get_cover(entity):
     cover_url = url_for('static', filename='images/cover-placeholder.png')
-    entity_id = entity.get('fedora:uuid')
+    entity_id = entity.get('fedora:uuid')[0]
     cover_art = __get_cover_art__(entity_id)
     if cover_art is not None:
         cover_url = cover_art.get('src')
     return cover_url       
 
+def entity_details_sparql(fedora_urls):
+    """Retrieves the held item and cover art uuids of many Works or
+    Instances with one SPARQL query for every SPARQL_VALUES_SIZE
+    entities, returning a dict of details by url
+
+    Args:
+        fedora_urls -- list of fedora:hasLocation urls
+    """
+    output = dict([(url, {"held_items": [], "covers": []})
+                   for url in fedora_urls])
+    fedora_urls = list(output.keys())
+    values_size = app.config.get('SPARQL_VALUES_SIZE', 100)
+    for start in range(0, len(fedora_urls), values_size):
+        values = " ".join(["<{}>".format(url) 
+                           for url in fedora_urls[start:start+values_size]])
+        results = __sparql__(ENTITY_DETAILS_SPARQL.format(values))
+        if results is None:
+            continue
+        for row in results.get('bindings', []):
+            details = output.get(row['entity']['value'])
+            if details is None:
+                continue
+            value = row['uuid']['value']
+            key = "{}s".format(row['detail']['value'])
+            if not value in details[key]:
+                details[key].append(value)
+    return output
+
+def prime_entity_details(entities):
+    """Queues the urls of a page of Works or Instances so that the first
+    cover or held items lookup of the request fetches the details of all
+    of them with entity_details_sparql
+
+    Args:
+        entities -- list of Work or Instance _source
+    """
+    details = g.setdefault('entity_details', dict())
+    pending = g.setdefault('entity_details_pending', set())
+    for entity in entities:
+        for fedora_url in entity.get('fedora:hasLocation', [])[:1]:
+            if not fedora_url in details:
+                pending.add(fedora_url)
+
+def __entity_details__(fedora_url):
+    """Returns the held item and cover art uuids of an entity, fetching
+    them with every pending url of the request if not already known"""
+    details = g.setdefault('entity_details', dict())
+    if not fedora_url in details:
+        pending = g.setdefault('entity_details_pending', set())
+        pending.add(fedora_url)
+        details.update(entity_details_sparql(sorted(pending)))
+        pending.clear()
+    return details[fedora_url]
+
+def held_item_details_sparql(uuids):
+    """Retrieves the holding organization, circulation status and item id
+    of many held items with one SPARQL query, returning a dict of 
+    held items by uuid in the same form as their Elastic Search _source
+
+    Args:
+        uuids -- list of held item fedora:uuids
+    """
+    output = dict()
+    if len(uuids) < 1:
+        return output
+    values = " ".join(
+        ['"{}"^^<http://www.w3.org/2001/XMLSchema#string>'.format(uuid)
+         for uuid in uuids])
+    results = __sparql__(HELD_ITEMS_DETAILS_SPARQL.format(values))
+    if results is None:
+        return output
+    for row in results.get('bindings', []):
+        output[row['uuid']['value']] = {
+            'bf:heldBy': [row['org_label']['value']],
+            'bf:circulationStatus': [row['circ_status']['value']],
+            'bf:itemId': [row['item_id']['value']]}
+    return output
+
 def get_cover_sparql(entity):
     cover_url = url_for('static', filename='images/cover-placeholder.png')
-    if 'bf:workTitle' in entity:
-        sparql = GET_WORK_COVER_SPARQL.format(entity['fedora:hasLocation'][0])
-    else:
-        sparql = GET_INSTANCE_COVER_SPARQL.format(entity['fedora:hasLocation'][0])       
-    result = requests.post(
-       "{}/triplestore".format(datastore_url), 
-       data={"sparql": sparql})
-    
-    if result.status_code < 400:
-        results = result.json()['results']
-        if len(results['bindings']) > 0: 
-            cover_url = url_for('cover', 
-                uuid=results['bindings'][0]['uuid']['value'], ext='jpg')
+    fedora_url = entity['fedora:hasLocation'][0]
+    covers = __entity_details__(fedora_url)['covers']
+    if len(covers) > 0: 
+        cover_url = url_for('cover', uuid=covers[0], ext='jpg')
     return cover_url
 
 @app.template_filter('creator')
@@ -165,7 +291,7 @@ def creator(entity):
 @app.template_filter('held_items')
 def held_items(entity):
     output = str()
-    entity_uuid = entity.get('fedora:uuid')
+    entity_uuid = entity.get('fedora:uuid')[0]
     items = __get_held_items__(entity_uuid)
     if len(items) > 0:
         for item in items:
@@ -176,35 +302,17 @@ def held_items(entity):
 def held_items_sparql(entity):
     output = str()
     fedora_url = entity['fedora:hasLocation'][0]
-    # Ugly hack to determine if the entity is a Work
-    if 'bf:workTitle' in entity:
-        sparql = WORK_HELD_ITEMS_SPARQL.format(fedora_url)
-    else:
-        sparql = HELD_ITEMS_SPARQL.format(fedora_url)
-    result = requests.post(
-       "{}/triplestore".format(datastore_url), 
-       data={"sparql": sparql})
-    if result.status_code < 400:
-        results = result.json()['results']
-        for row in results.get('bindings', []):
-            uuid = row['uuid']['value']
-            if es_search.exists(id=uuid, index='bibframe'):
-                held_item = es_search.get_source(id=uuid, index='bibframe')
-                output += render_template('snippets/held-item.html',
-                                          item=held_item)
-            else:
-                sparql= HELD_ITEM_SPARQL.format(uuid)
-                held_item_result = requests.post(
-                    "{}/triplestore".format(datastore_url), 
-                    data={"sparql": sparql})
-                if held_item_result.status_code < 400:
-                    bindings = held_item_result.json().get('results').get('bindings')
-                    if len(bindings) > 0:
-                        output += render_template(
-                            'snippets/held-item.html', 
-                            item=[0])
-                else:
-                    output = "Cannot find {} for {}".format(uuid, fedora_url)
+    details = __entity_details__(fedora_url)
+    uuids = details['held_items']
+    held_items = entity_map().get_many(uuids)
+    missing = [uuid for uuid in uuids if not uuid in held_items]
+    held_items.update(held_item_details_sparql(missing))
+    for uuid in uuids:
+        if uuid in held_items:
+            output += render_template('snippets/held-item.html',
+                                      item=held_items[uuid])
+        else:
+            output += "Cannot find {} for {}".format(uuid, fedora_url)
     return output
 
 @app.template_filter('get_label')
@@ -214,10 +322,9 @@ def get_label(uuid):
     Args:
         uuid -- Unique id used as key in Elastic Search
     """
-    if es_search.exists(id=uuid, index='bibframe'):
-        result = es_search.get(id=uuid, index='bibframe', fields=['bf:label'])
-        if 'fields' in result:
-            return ' '.join(result['fields']['bf:label'])
+    labels = get_labels([uuid])
+    if uuid in labels:
+        return ' '.join(labels[uuid])
     return uuid
     
 
@@ -283,32 +390,32 @@ def generate_detail_title(entity):
     entity_classes = entity.get('type', [])
     if 'bf:Work' in entity_classes:
         if 'bf:workTitle' in entity:
-            for key in entity.get('bf:workTitle'):
-                if not es_search.exists(id=title_key, index='bibframe'):
-                    continue 
-                title = es_search.get_source(id=entity.get('bf:workTitle')[0], 
-                    index='bibframe')
-            output += title 
+            titles = entity_map().get_many(entity.get('bf:workTitle'))
+            for title_key in entity.get('bf:workTitle'):
+                if title_key in titles:
+                    output += guess_name(titles[title_key])
         work = entity
     if 'bf:Instance' in entity_classes:
         if 'bf:titleStatement' in entity:
             output += ",".join(entity.get('bf:titleStatement'))
         elif 'bf:title' in entity:
             output += ",".join(entity.get('bf:title'))
-        for work_key in entity.get('bf:instanceOf'):
-            if not es_search.exists(id=work_key, index='bibframe'):
-                continue
-            work = es_search.get_source(id=work_key, index='bibframe')
-            break
+        works = entity_map().get_many(entity.get('bf:instanceOf', []))
+        for work_key in entity.get('bf:instanceOf', []):
+            if work_key in works:
+                work = works[work_key]
+                break
     if output.count("/") < 1:
         output += " / "
+    if work is not None:
+        contributors = get_labels(
+            work.get('bf:creator', []) + work.get('bf:contributor', []))
     for agent in ['bf:creator', 'bf:contributor']:
         if work is not None and agent in work:
             for i, key in enumerate(work[agent]):
-                if not es_search.exists(id=key, index='bibframe'):
+                if not key in contributors:
                     continue
-                contributor = es_search.get_source(id=key, index='bibframe')
-                output += " ".join(contributor.get('bf:label'))
+                output += " ".join(contributors[key])
                 if i < len(work[agent])-1:
                     output += ","
     return output
@@ -0,0 +1,473 @@
+"""
+Name:        ingest
+Purpose:     Parallel bulk loader for BIBFRAME RDF, i.e. the Library of
+             Congress sample collections. A process pool parses the RDF
+             files and splits each graph into one document per subject,
+             a writer thread indexes the documents with Elastic Search
+             _bulk and, optionally, writes them to Fedora 4 in one
+             transaction per batch over pooled connections. Bounded queues
+             between the stages keep the parsers from outrunning the
+             writers.
+
+             python -m catalog.ingest bibframe-sample/ --workers 4
+
+Author:      Jeremy Nelson
+
+Created:     2015/08/07
+Copyright:   (c) Jeremy Nelson 2015
+Licence:     GPLv3
+"""
+__author__ = "Jeremy Nelson"
+__license__ = "GPLv3"
+
+import argparse
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures import ThreadPoolExecutor
+
+import rdflib
+from elasticsearch.helpers import bulk
+from rdflib.util import guess_format
+from . import app, es_index, es_search
+from .upstream import __upstream_client__
+
+logger = logging.getLogger(__name__)
+
+BF = rdflib.Namespace("http://bibframe.org/vocab/")
+SCHEMA = rdflib.Namespace("http://schema.org/")
+PREFIXES = {str(BF): 'bf',
+            str(SCHEMA): 'schema',
+            str(rdflib.RDFS): 'rdfs'}
+# A subject's search doc type is the first of these classes it has
+SEARCH_DOC_TYPES = ['Work', 'Instance', 'HeldItem', 'CoverArt', 'Person',
+                    'Organization', 'Family', 'Meeting', 'Jurisdiction',
+                    'Agent', 'Topic', 'Place', 'TemporalConcept', 'Title',
+                    'Annotation']
+
+def subject_uuid(subject):
+    """Returns the document id of a subject, the same in every worker so
+    references between subjects resolve without coordination
+
+    Args:
+        subject -- rdflib.URIRef
+    """
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, str(subject)))
+
+def guess_search_doc_type(graph, subject):
+    """Returns the Elastic Search type of a subject from its BIBFRAME
+    classes, or None if it has none
+
+    Args:
+        graph -- rdflib.Graph
+        subject -- rdflib.URIRef
+    """
+    return search_doc_type(graph.objects(subject, rdflib.RDF.type))
+
+def search_doc_type(classes):
+    """Returns the Elastic Search type for a list of rdf:type urls, or None
+    if none of them is a BIBFRAME class"""
+    classes = [str(type_)[len(str(BF)):] for type_ in classes
+               if str(type_).startswith(str(BF))]
+    for name in SEARCH_DOC_TYPES:
+        if name in classes:
+            return name
+    if len(classes) > 0:
+        return sorted(classes)[0]
+
+def field_name(predicate):
+    """Returns the prefixed field name of a predicate or None"""
+    for namespace, prefix in PREFIXES.items():
+        if str(predicate).startswith(namespace):
+            return "{}:{}".format(prefix, str(predicate)[len(namespace):])
+
+def subject_document(graph, subject, fedora_base=None, namespace=None):
+    """Returns the (uuid, doc_type, _source) of a subject. Objects in the
+    repository namespace or that are subjects of the same graph are stored
+    as their document ids, like the documents of the bibframe index, so
+    references to subjects in other files resolve too.
+
+    Args:
+        graph -- rdflib.Graph
+        subject -- rdflib.URIRef
+        fedora_base -- optional Fedora 4 base url for fedora:hasLocation
+        namespace -- optional base url of the repository's subjects
+    """
+    doc_id = subject_uuid(subject)
+    source = {"fedora:uuid": [doc_id], "type": []}
+    if fedora_base:
+        source["fedora:hasLocation"] = ["{}/rest/{}".format(
+            fedora_base.rstrip("/"), doc_id)]
+    for predicate, object_ in graph.predicate_objects(subject):
+        if predicate == rdflib.RDF.type:
+            field = field_name(object_)
+            if field is not None:
+                source["type"].append(field)
+            continue
+        field = field_name(predicate)
+        if field is None:
+            continue
+        if isinstance(object_, rdflib.URIRef) and \
+           ((namespace and str(object_).startswith(namespace)) or
+            (object_, None, None) in graph):
+            value = subject_uuid(object_)
+        else:
+            value = str(object_)
+        source.setdefault(field, []).append(value)
+    return doc_id, guess_search_doc_type(graph, subject), source
+
+def subject_turtle(graph, subject):
+    """Returns a subject's triples as Turtle with <> as the subject, the
+    body of a Fedora 4 container PUT"""
+    output = rdflib.Graph()
+    for namespace, prefix in PREFIXES.items():
+        output.bind(prefix, namespace)
+    for predicate, object_ in graph.predicate_objects(subject):
+        output.add((rdflib.URIRef(''), predicate, object_))
+    return output.serialize(format='turtle')
+
+def parse_subjects(path, fedora_base=None, turtle=False, namespace=None):
+    """Parses an RDF file and splits it by subject, run in the worker
+    processes. Returns the number of triples and a list of (uuid,
+    doc_type, _source, turtle) tuples.
+
+    Args:
+        path -- RDF file path
+        fedora_base -- optional Fedora 4 base url
+        turtle -- include each subject's Turtle for Fedora
+        namespace -- optional base url of the repository's subjects
+    """
+    graph = rdflib.Graph()
+    graph.parse(path, format=guess_format(path) or 'turtle')
+    documents = []
+    for subject in set(graph.subjects()):
+        if not isinstance(subject, rdflib.URIRef) or \
+           guess_search_doc_type(graph, subject) is None:
+            continue
+        doc_id, doc_type, source = subject_document(graph, subject,
+                                                    fedora_base, namespace)
+        documents.append((doc_id, doc_type, source,
+                          subject_turtle(graph, subject) if turtle else None))
+    return len(graph), documents
+
+def rdf_files(paths):
+    """Yields the RDF files in a list of files and directories"""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for filename in sorted(files):
+                if guess_format(filename) is not None:
+                    yield os.path.join(root, filename)
+
+
+class Throughput(object):
+    """Thread-safe counts of the triples or MARC records read and the
+    documents written"""
+
+    def __init__(self):
+        self.start = time.time()
+        self.triples, self.documents, self.errors, self.files = 0, 0, 0, 0
+        self.records = 0
+        self.lock = threading.Lock()
+
+    def add(self, triples=0, documents=0, errors=0, files=0, records=0):
+        with self.lock:
+            self.triples += triples
+            self.documents += documents
+            self.errors += errors
+            self.files += files
+            self.records += records
+
+    def report(self):
+        """Returns the counts with triples and documents per second"""
+        with self.lock:
+            elapsed = max(time.time() - self.start, 1e-6)
+            return {"files": self.files,
+                    "records": self.records,
+                    "triples": self.triples,
+                    "documents": self.documents,
+                    "errors": self.errors,
+                    "seconds": round(elapsed, 3),
+                    "records_per_second": round(self.records / elapsed, 1),
+                    "triples_per_second": round(self.triples / elapsed, 1),
+                    "documents_per_second": round(
+                        self.documents / elapsed, 1)}
+
+    def __str__(self):
+        return ("{files} files, {triples} triples ({triples_per_second}/s), "
+                "{documents} documents ({documents_per_second}/s), "
+                "{errors} errors in {seconds}s").format(**self.report())
+
+
+class FedoraWriter(object):
+    """Writes batches of containers to Fedora 4, one transaction per
+    batch, with concurrent PUTs over an UpstreamClient's connection pool
+
+    Args:
+        client -- UpstreamClient for the Fedora 4 host
+        workers -- concurrent PUTs, at most the client's pool size
+    """
+
+    def __init__(self, client, workers=10):
+        self.client = client
+        self.executor = ThreadPoolExecutor(workers)
+
+    def __put__(self, transaction, doc_id, turtle):
+        return self.client.request(
+            "PUT",
+            "{}/{}".format(transaction, doc_id),
+            data=turtle.encode('utf-8') if isinstance(turtle, str) else turtle,
+            headers={"Content-Type": "text/turtle"})
+
+    def write(self, batch):
+        """Creates or replaces the containers of a batch, rolling back the
+        transaction if any of them fails
+
+        Args:
+            batch -- list of (uuid, doc_type, _source, turtle) tuples
+        """
+        response = self.client.post("rest/fcr:tx")
+        response.raise_for_status()
+        transaction = response.headers['Location'][
+            len(self.client.base_url):].strip("/")
+        responses = list(self.executor.map(
+            lambda row: self.__put__(transaction, row[0], row[3]),
+            batch))
+        failed = [response for response in responses
+                  if response.status_code >= 400]
+        if len(failed) > 0:
+            self.client.post("{}/fcr:tx/fcr:rollback".format(transaction))
+            raise IOError("{} of {} Fedora writes failed, first {} {}".format(
+                len(failed), len(batch), failed[0].status_code,
+                failed[0].text[:200]))
+        self.client.post(
+            "{}/fcr:tx/fcr:commit".format(transaction)).raise_for_status()
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class BulkWriter(threading.Thread):
+    """Writer thread that indexes documents from a bounded queue with
+    Elastic Search _bulk, and writes them to Fedora first if given a
+    FedoraWriter. put blocks while the queue is full.
+
+    Args:
+        elastic_search -- Elastic Search client
+        index -- Elastic Search index
+        stats -- Throughput
+        batch_size -- documents per _bulk request
+        queue_size -- documents waiting to be written before put blocks
+        fedora -- optional FedoraWriter
+    """
+
+    def __init__(self, elastic_search, index, stats, batch_size=500,
+                 queue_size=5000, fedora=None):
+        super(BulkWriter, self).__init__(name="bulk-writer")
+        self.daemon = True
+        self.elastic_search = elastic_search
+        self.index = index
+        self.stats = stats
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.fedora = fedora
+        self.error = None
+
+    def put(self, document):
+        """Queues a (uuid, doc_type, _source, turtle) tuple, raising the
+        writer's error if it stopped"""
+        if self.error is not None:
+            raise self.error
+        self.queue.put(document)
+
+    def checkpoint(self, callback):
+        """Queues a callback that is called once every document queued
+        before it has been written"""
+        self.put(callback)
+
+    def flush(self, batch):
+        if self.fedora is not None:
+            self.fedora.write(batch)
+        actions = [{"_index": self.index,
+                    "_type": doc_type,
+                    "_id": doc_id,
+                    "_source": source}
+                   for doc_id, doc_type, source, turtle in batch]
+        count, errors = bulk(self.elastic_search,
+                             actions,
+                             chunk_size=len(actions),
+                             raise_on_error=False)
+        for error in errors[:10]:
+            logger.error("Indexing failed %s", error)
+        self.stats.add(documents=count, errors=len(errors))
+
+    def run(self):
+        batch = []
+        while True:
+            document = self.queue.get()
+            # None stops the writer, a callable is a checkpoint
+            marker = document is None or callable(document)
+            if not marker:
+                batch.append(document)
+            if len(batch) >= self.batch_size or \
+               (marker and len(batch) > 0):
+                try:
+                    self.flush(batch)
+                except Exception as error:
+                    logger.exception("Writing a batch failed")
+                    self.error = error
+                    # Drains the queue so that put does not block forever
+                    while self.queue.get() is not None:
+                        pass
+                    return
+                batch = []
+            if callable(document):
+                document()
+            if document is None:
+                return
+
+    def close(self):
+        """Flushes the queued documents and stops the thread"""
+        self.queue.put(None)
+        self.join()
+        if self.fedora is not None:
+            self.fedora.close()
+        if self.error is not None:
+            raise self.error
+
+
+def __refresh_interval__(elastic_search, index, interval):
+    """Sets the refresh interval of an index, returning the previous one,
+    or None if the index does not exist yet"""
+    try:
+        settings = elastic_search.indices.get_settings(index=index)
+        previous = settings[index]['settings']['index'].get(
+            'refresh_interval', "1s")
+        elastic_search.indices.put_settings(
+            index=index,
+            body={"index": {"refresh_interval": interval}})
+    except Exception as error:
+        logger.warning("Could not set the refresh interval of %s: %s",
+                       index, error)
+        return None
+    return previous
+
+def ingest(paths,
+           elastic_search=None,
+           index=es_index,
+           workers=None,
+           batch_size=500,
+           queue_size=5000,
+           refresh_interval="-1",
+           fedora_url=None,
+           report_interval=30,
+           namespace=None):
+    """Loads RDF files in parallel, returning the Throughput report
+
+    Args:
+        paths -- RDF files or directories of them
+        elastic_search -- Elastic Search client, defaults to es_search
+        index -- Elastic Search index, defaults to bibframe
+        workers -- parser processes, defaults to the number of CPUs
+        batch_size -- documents per _bulk request and Fedora transaction
+        queue_size -- documents waiting to be written before parsing
+                      pauses
+        refresh_interval -- index refresh interval during the load,
+                            defaults to -1, off
+        fedora_url -- optional Fedora 4 url to also write containers to
+        report_interval -- seconds between progress log lines
+        namespace -- base url of the subjects, references to it are
+                     stored as document ids, defaults to INGEST_NAMESPACE
+    """
+    elastic_search = elastic_search or es_search
+    namespace = namespace or app.config.get('INGEST_NAMESPACE')
+    stats = Throughput()
+    fedora = None
+    if fedora_url is not None:
+        client = __upstream_client__(fedora_url)
+        fedora = FedoraWriter(client, app.config.get('UPSTREAM_POOL_SIZE', 10))
+    writer = BulkWriter(elastic_search, index, stats, batch_size, queue_size,
+                        fedora)
+    writer.start()
+    previous = None
+    if refresh_interval is not None:
+        previous = __refresh_interval__(elastic_search, index,
+                                        refresh_interval)
+    last_report = time.time()
+
+    def drain(futures):
+        for future in futures:
+            triples, documents = future.result()
+            stats.add(triples=triples, files=1)
+            for document in documents:
+                writer.put(document)
+
+    try:
+        with ProcessPoolExecutor(workers) as pool:
+            # At most two files per worker are parsed ahead of the writer
+            max_pending = 2 * (workers or os.cpu_count() or 1)
+            pending = set()
+            for path in rdf_files(paths):
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    drain(done)
+                if time.time() - last_report > report_interval:
+                    logger.info("%s", stats)
+                    last_report = time.time()
+                pending.add(pool.submit(parse_subjects, path, fedora_url,
+                                        fedora is not None, namespace))
+            drain(pending)
+    finally:
+        writer.close()
+        if previous is not None:
+            __refresh_interval__(elastic_search, index, previous)
+    logger.info("%s", stats)
+    return stats.report()
+
+def main(args):
+    logging.basicConfig(level=logging.INFO)
+    report = ingest(args.paths,
+                    workers=args.workers,
+                    batch_size=args.batch_size,
+                    queue_size=args.queue_size,
+                    refresh_interval=args.refresh_interval,
+                    fedora_url=args.fedora,
+                    namespace=args.namespace)
+    if args.denormalize:
+        from .denormalize import refresh_all
+        with app.app_context():
+            refresh_all(batch_size=args.batch_size)
+    print("{triples_per_second} triples/s, {documents_per_second} "
+          "documents/s".format(**report))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Loads BIBFRAME RDF into Elastic Search and Fedora")
+    parser.add_argument('paths', nargs='+',
+                        help='RDF files or directories of them')
+    parser.add_argument('--workers', type=int,
+                        help='Parser processes, defaults to the CPU count')
+    parser.add_argument('--batch-size', type=int,
+                        default=app.config.get('INGEST_BATCH_SIZE', 500))
+    parser.add_argument('--queue-size', type=int,
+                        default=app.config.get('INGEST_QUEUE_SIZE', 5000))
+    parser.add_argument('--refresh-interval',
+                        default=app.config.get('INGEST_REFRESH_INTERVAL', '-1'),
+                        help='Index refresh interval during the load')
+    parser.add_argument('--fedora', default=app.config.get('FEDORA_URL'),
+                        help='Fedora 4 url, i.e. http://localhost:8080')
+    parser.add_argument('--namespace',
+                        default=app.config.get('INGEST_NAMESPACE'),
+                        help='Base url of the subjects, i.e. '
+                             'http://bibframe.org/resources/')
+    parser.add_argument('--denormalize', action='store_true',
+                        help='Write the display fields after loading')
+    main(parser.parse_args())
@@ -0,0 +1,382 @@
+"""
+Name:        marc
+Purpose:     Streaming, resumable MARC21 and MARCXML ingestion. Records are
+             read one at a time without loading the file into memory,
+             converted to BIBFRAME documents in worker processes and
+             indexed with Elastic Search _bulk. A checkpoint of the byte
+             offset and record count of the last written record lets a
+             crashed load resume where it stopped.
+
+             python -m catalog.marc records.mrc --workers 4 --resume
+
+Author:      Jeremy Nelson
+
+Created:     2015/08/10
+Copyright:   (c) Jeremy Nelson 2015
+Licence:     GPLv3
+"""
+__author__ = "Jeremy Nelson"
+__license__ = "GPLv3"
+
+import argparse
+import io
+import json
+import logging
+import os
+import re
+import time
+import uuid
+import xml.etree.ElementTree as etree
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pymarc
+from . import app, es_index, es_search
+from .ingest import BulkWriter, Throughput
+
+logger = logging.getLogger(__name__)
+
+MARC_XML_RECORD = "{{{}}}record".format(pymarc.MARC_XML_NS)
+MARC_XML_COLLECTION = '<collection xmlns="{}">'.format(pymarc.MARC_XML_NS)
+TRAILING_PUNCTUATION_RE = re.compile(r"[\s/:;,.=]+$")
+
+def __id__(*parts):
+    """Returns a document id that is the same for the same parts in every
+    worker and every run, so shared agents and topics are indexed once and
+    a resumed load overwrites instead of duplicating"""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL,
+                          "marc:{}".format(":".join(parts))))
+
+def __clean__(value):
+    return TRAILING_PUNCTUATION_RE.sub("", value.strip())
+
+def __subfields__(field, codes):
+    return " ".join(value.strip() for value in field.get_subfields(*codes)
+                    if value.strip())
+
+def __first__(record, tag):
+    """Returns the first field of a tag or None"""
+    fields = record.get_fields(tag)
+    if len(fields) > 0:
+        return fields[0]
+
+def __document__(doc_id, doc_type, **fields):
+    source = {"fedora:uuid": [doc_id], "type": ["bf:{}".format(doc_type)]}
+    for field, values in fields.items():
+        values = [value for value in values if value]
+        if len(values) > 0:
+            source[field] = values
+    return (doc_id, doc_type, source, None)
+
+def record_documents(record):
+    """Converts a MARC record into BIBFRAME Work, Instance, Title, agent,
+    Topic and HeldItem documents shaped like those of the bibframe index,
+    returning a list of (uuid, doc_type, _source, None) tuples
+
+    Args:
+        record -- pymarc.Record
+    """
+    control_field = __first__(record, '001')
+    control = control_field.data.strip() if control_field else None
+    if control is None:
+        control = __id__(record.as_marc().decode('utf-8', 'replace'))
+    documents = []
+    title_field = __first__(record, '245')
+    title_value = __clean__(__subfields__(title_field, 'a')) \
+        if title_field else ''
+    subtitle = __clean__(__subfields__(title_field, 'b')) \
+        if title_field else ''
+    title_id = __id__(control, 'title')
+    documents.append(__document__(title_id, 'Title',
+                                  **{"bf:titleValue": [title_value],
+                                     "bf:subtitle": [subtitle]}))
+    agents = []
+    for tag, doc_type in [('100', 'Person'), ('110', 'Organization'),
+                          ('111', 'Meeting')]:
+        for field in record.get_fields(tag):
+            name = __clean__(__subfields__(field, 'abcdq'))
+            if not name:
+                continue
+            agent_id = __id__(doc_type, name.lower())
+            agents.append((agent_id, name))
+            documents.append(__document__(
+                agent_id, doc_type,
+                **{"bf:label": [name], "bf:authorizedAccessPoint": [name]}))
+    topics = []
+    for field in record.get_fields('650', '651'):
+        label = "--".join(__clean__(value) for value in
+                          field.get_subfields('a', 'x', 'y', 'z')
+                          if value.strip())
+        if not label:
+            continue
+        topic_id = __id__('Topic', label.lower())
+        topics.append(topic_id)
+        documents.append(__document__(
+            topic_id, 'Topic',
+            **{"bf:label": [label], "bf:authorizedAccessPoint": [label]}))
+    language = None
+    fixed_field = __first__(record, '008')
+    if fixed_field and len(fixed_field.data) >= 38:
+        language = fixed_field.data[35:38].strip() or None
+    work_id, instance_id = __id__(control, 'work'), __id__(control, 'instance')
+    access_point = " ".join([name for agent_id, name in agents[:1]] +
+                            [title_value])
+    documents.append(__document__(
+        work_id, 'Work',
+        **{"bf:workTitle": [title_id],
+           "bf:authorizedAccessPoint": [access_point.strip()],
+           "bf:creator": [agent_id for agent_id, name in agents],
+           "bf:subject": topics,
+           "bf:language": [language],
+           "bf:derivedFrom": [control]}))
+    documents.append(__document__(
+        instance_id, 'Instance',
+        **{"bf:instanceOf": [work_id],
+           "bf:titleStatement": [__subfields__(title_field, 'abc')
+                                 if title_field else None],
+           "bf:extent": [__subfields__(field, 'a')
+                         for field in record.get_fields('300')],
+           "bf:publicationStatement": [
+               __subfields__(field, 'abc')
+               for field in record.get_fields('260', '264')],
+           "bf:isbn": [__clean__(value) for field in record.get_fields('020')
+                       for value in field.get_subfields('a')],
+           "bf:derivedFrom": [control]}))
+    shelf_mark = None
+    if __first__(record, '050'):
+        shelf_mark = __subfields__(__first__(record, '050'), 'ab')
+    for i, field in enumerate(record.get_fields('852')):
+        documents.append(__document__(
+            __id__(control, 'item', str(i)), 'HeldItem',
+            **{"bf:holdingFor": [instance_id],
+               "bf:subLocation": [__subfields__(field, 'b')],
+               "bf:shelfMarkLcc": [__subfields__(field, 'hi') or shelf_mark],
+               "bf:itemId": [__subfields__(field, 'p')]}))
+    return documents
+
+def convert_chunk(chunk, xml=False):
+    """Converts a chunk of raw records, run in the worker processes.
+    Returns the list of documents and the number of records that could
+    not be read.
+
+    Args:
+        chunk -- list of MARC21 bytes or MARCXML record elements as bytes
+        xml -- the records are MARCXML
+    """
+    documents, errors = [], 0
+    for raw in chunk:
+        try:
+            if xml:
+                record = pymarc.parse_xml_to_array(io.BytesIO(
+                    MARC_XML_COLLECTION.encode() + raw + b"</collection>"))[0]
+            else:
+                record = pymarc.Record(data=raw, force_utf8=True)
+            documents.extend(record_documents(record))
+        except Exception as error:
+            logger.warning("Could not convert a record: %s", error)
+            errors += 1
+    return documents, errors
+
+def read_marc21(path, offset=0):
+    """Yields the (raw bytes, end offset) of each record in a MARC21 file
+    starting at a byte offset, reading one record at a time
+
+    Args:
+        path -- MARC21 file path
+        offset -- byte offset of the first record to read
+    """
+    with open(path, "rb") as marc_file:
+        marc_file.seek(offset)
+        while True:
+            length = marc_file.read(5)
+            if len(length) < 5:
+                return
+            try:
+                record_length = int(length)
+            except ValueError:
+                raise ValueError("Invalid record length {!r} at offset {}"
+                                 .format(length, offset))
+            raw = length + marc_file.read(record_length - 5)
+            offset += len(raw)
+            yield raw, offset
+
+def read_marcxml(path, skip=0):
+    """Yields the (record element bytes, None) of each record in a MARCXML
+    file, clearing parsed elements so memory use stays flat. XML parsing
+    has no resumable byte offset, the first skip records are passed over
+    instead.
+
+    Args:
+        path -- MARCXML file path
+        skip -- number of records to skip
+    """
+    context = etree.iterparse(path, events=("start", "end"))
+    root = None
+    for event, element in context:
+        if root is None:
+            root = element
+        if event != "end" or element.tag != MARC_XML_RECORD:
+            continue
+        if skip > 0:
+            skip -= 1
+        else:
+            yield etree.tostring(element), None
+        element.clear()
+        root.clear()
+
+
+class Checkpoint(object):
+    """Byte offset and record count of the last record written to Elastic
+    Search, saved atomically to a JSON file
+
+    Args:
+        path -- checkpoint file path
+        source -- path of the file being loaded
+    """
+
+    def __init__(self, path, source):
+        self.path = path
+        self.source = os.path.abspath(source)
+        self.offset, self.records = 0, 0
+
+    def load(self):
+        """Reads the checkpoint of the same source file if there is one"""
+        if not os.path.exists(self.path):
+            return self
+        with open(self.path) as checkpoint:
+            saved = json.load(checkpoint)
+        if saved.get('source') != self.source:
+            raise ValueError("Checkpoint {} is for {}".format(
+                self.path, saved.get('source')))
+        self.offset = saved.get('offset') or 0
+        self.records = saved.get('records', 0)
+        return self
+
+    def save(self, offset, records):
+        self.offset, self.records = offset, records
+        temp_path = "{}.tmp".format(self.path)
+        with open(temp_path, "w") as checkpoint:
+            json.dump({"source": self.source,
+                       "offset": offset,
+                       "records": records,
+                       "time": time.time()},
+                      checkpoint)
+        os.replace(temp_path, self.path)
+
+
+def ingest_marc(path,
+                elastic_search=None,
+                index=es_index,
+                workers=None,
+                chunk_size=500,
+                batch_size=500,
+                checkpoint_path=None,
+                resume=False,
+                xml=None,
+                report_interval=30):
+    """Streams a MARC21 or MARCXML file into Elastic Search, returning the
+    Throughput report
+
+    Args:
+        path -- MARC21 or MARCXML file path
+        elastic_search -- Elastic Search client, defaults to es_search
+        index -- Elastic Search index, defaults to bibframe
+        workers -- converter processes, defaults to the number of CPUs
+        chunk_size -- records sent to a worker at a time and between
+                      checkpoints
+        batch_size -- documents per _bulk request
+        checkpoint_path -- checkpoint file, defaults to path.checkpoint
+        resume -- continue from the checkpoint
+        xml -- the file is MARCXML, defaults to guessing from the name
+        report_interval -- seconds between progress log lines
+    """
+    elastic_search = elastic_search or es_search
+    if xml is None:
+        xml = path.lower().endswith(".xml")
+    checkpoint = Checkpoint(checkpoint_path or "{}.checkpoint".format(path),
+                            path)
+    if resume:
+        checkpoint.load()
+        logger.info("Resuming %s after %s records at offset %s",
+                    path, checkpoint.records, checkpoint.offset)
+    if xml:
+        records = read_marcxml(path, checkpoint.records)
+    else:
+        records = read_marc21(path, checkpoint.offset)
+    stats = Throughput()
+    writer = BulkWriter(elastic_search, index, stats, batch_size,
+                        queue_size=4 * batch_size)
+    writer.start()
+    count, last_report = checkpoint.records, time.time()
+
+    def drain(future, offset, count):
+        documents, errors = future.result()
+        stats.add(errors=errors)
+        for document in documents:
+            writer.put(document)
+        writer.checkpoint(lambda: checkpoint.save(offset, count))
+
+    try:
+        with ProcessPoolExecutor(workers) as pool:
+            # Chunks are drained in order so that a checkpoint never
+            # passes a record that has not been written
+            pending = deque()
+            max_pending = 2 * (workers or os.cpu_count() or 1)
+            chunk, offset = [], checkpoint.offset
+            for raw, offset in records:
+                chunk.append(raw)
+                count += 1
+                if len(chunk) < chunk_size:
+                    continue
+                if len(pending) >= max_pending:
+                    drain(*pending.popleft())
+                pending.append((pool.submit(convert_chunk, chunk, xml),
+                                offset, count))
+                stats.add(records=len(chunk))
+                chunk = []
+                if time.time() - last_report > report_interval:
+                    logger.info("%s records, %s", count, stats)
+                    last_report = time.time()
+            if len(chunk) > 0:
+                pending.append((pool.submit(convert_chunk, chunk, xml),
+                                offset, count))
+                stats.add(records=len(chunk))
+            while len(pending) > 0:
+                drain(*pending.popleft())
+    finally:
+        writer.close()
+    report = stats.report()
+    logger.info("Loaded %s records from %s: %s", count, path, report)
+    return report
+
+def main(args):
+    logging.basicConfig(level=logging.INFO)
+    with app.app_context():
+        report = ingest_marc(args.path,
+                             workers=args.workers,
+                             chunk_size=args.chunk_size,
+                             batch_size=args.batch_size,
+                             checkpoint_path=args.checkpoint,
+                             resume=args.resume,
+                             xml=True if args.xml else None)
+    print("{records_per_second} records/s, {documents_per_second} "
+          "documents/s".format(**report))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Streams a MARC21 or MARCXML file into Elastic Search")
+    parser.add_argument('path', help='MARC21 or MARCXML file')
+    parser.add_argument('--workers', type=int,
+                        help='Converter processes, defaults to the CPU count')
+    parser.add_argument('--chunk-size', type=int,
+                        default=app.config.get('MARC_CHUNK_SIZE', 500))
+    parser.add_argument('--batch-size', type=int,
+                        default=app.config.get('INGEST_BATCH_SIZE', 500))
+    parser.add_argument('--checkpoint',
+                        help='Checkpoint file, defaults to <path>.checkpoint')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue from the checkpoint')
+    parser.add_argument('--xml', action='store_true',
+                        help='The file is MARCXML')
+    main(parser.parse_args())
@@ -0,0 +1,220 @@
+"""
+Name:        metrics
+Purpose:     Per-request instrumentation of the Elastic Search and SPARQL
+             calls made by the catalog views, reported in a Server-Timing
+             header and aggregated into histograms for the /metrics
+             endpoint in the Prometheus text format.
+
+Author:      Jeremy Nelson
+
+Created:     2015/08/04
+Copyright:   (c) Jeremy Nelson 2015
+Licence:     GPLv3
+"""
+__author__ = "Jeremy Nelson"
+__license__ = "GPLv3"
+
+import threading
+import time
+
+from flask import g, has_request_context, request, signals_available
+from flask import before_render_template, template_rendered
+from . import app
+from .slowlog import slow_queries
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+CALL_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+class Histogram(object):
+    """Thread-safe histogram with cumulative buckets for each combination
+    of label values"""
+
+    def __init__(self, name, description, labels, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self.series = dict()
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """Adds an observation
+
+        Args:
+            value -- observed value, i.e. seconds
+            labels -- label values, one for each of the histogram's labels
+        """
+        key = tuple(str(labels.get(label, '')) for label in self.labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = {
+                    "buckets": [0] * len(self.buckets),
+                    "count": 0,
+                    "sum": 0.0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][i] += 1
+            series["count"] += 1
+            series["sum"] += value
+
+    def clear(self):
+        with self.lock:
+            self.series.clear()
+
+    def exposition(self):
+        """Returns the histogram in the Prometheus text format"""
+        lines = ["# HELP {} {}".format(self.name, self.description),
+                 "# TYPE {} histogram".format(self.name)]
+        with self.lock:
+            series = sorted((key, dict(value, buckets=list(value["buckets"])))
+                            for key, value in self.series.items())
+        for key, value in series:
+            labels = ['{}="{}"'.format(name, __escape__(label))
+                      for name, label in zip(self.labels, key)]
+            for bound, count in zip(self.buckets, value["buckets"]):
+                lines.append('{}_bucket{{{}}} {}'.format(
+                    self.name,
+                    ",".join(labels + ['le="{}"'.format(bound)]),
+                    count))
+            lines.append('{}_bucket{{{}}} {}'.format(
+                self.name, ",".join(labels + ['le="+Inf"']), value["count"]))
+            lines.append('{}_sum{{{}}} {}'.format(
+                self.name, ",".join(labels), value["sum"]))
+            lines.append('{}_count{{{}}} {}'.format(
+                self.name, ",".join(labels), value["count"]))
+        return "\n".join(lines)
+
+
+def __escape__(label):
+    return label.replace("\\", "\\\\").replace('"', '\\"').replace("\n",
+                                                                   "\\n")
+
+upstream_seconds = Histogram(
+    "bibcat_upstream_call_seconds",
+    "Duration of Elastic Search and SPARQL calls by operation",
+    ["backend", "operation"])
+request_seconds = Histogram(
+    "bibcat_request_seconds",
+    "Duration of requests by view",
+    ["endpoint"])
+request_upstream_seconds = Histogram(
+    "bibcat_request_upstream_seconds",
+    "Time a request spent in Elastic Search, SPARQL or templates by view",
+    ["endpoint", "backend"])
+request_upstream_calls = Histogram(
+    "bibcat_request_upstream_calls",
+    "Elastic Search and SPARQL calls made by a request by view",
+    ["endpoint", "backend"],
+    CALL_BUCKETS)
+HISTOGRAMS = [upstream_seconds, request_seconds, request_upstream_seconds,
+              request_upstream_calls]
+
+def record(backend, operation, duration):
+    """Records a call to a backend, adding it to the current request's
+    timings when there is one
+
+    Args:
+        backend -- backend name, i.e. es or sparql
+        operation -- client method, i.e. search or mget
+        duration -- seconds the call took
+    """
+    upstream_seconds.observe(duration, backend=backend, operation=operation)
+    if has_request_context():
+        timings = g.setdefault('upstream_timings', dict())
+        calls, seconds = timings.get(backend, (0, 0.0))
+        timings[backend] = (calls + 1, seconds + duration)
+
+
+class InstrumentedClient(object):
+    """Wraps a client, i.e. the Elastic Search client or a SPARQL
+    datastore, timing every public method call"""
+
+    def __init__(self, client, backend):
+        self.client = client
+        self.backend = backend
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if name.startswith("_") or not callable(attribute):
+            return attribute
+
+        def timed(*args, **kwargs):
+            start, result = time.perf_counter(), None
+            try:
+                result = attribute(*args, **kwargs)
+                return result
+            finally:
+                duration = time.perf_counter() - start
+                record(self.backend, name, duration)
+                slow_queries.observe(self.backend, name, args, kwargs,
+                                     result, duration)
+        return timed
+
+
+def exposition():
+    """Returns every histogram in the Prometheus text format"""
+    return "\n".join(histogram.exposition() for histogram in HISTOGRAMS) + \
+        "\n"
+
+def server_timing(timings, total):
+    """Returns the Server-Timing header value for a request
+
+    Args:
+        timings -- dict of (calls, seconds) by backend
+        total -- seconds the request took
+    """
+    metrics = []
+    for backend, (calls, seconds) in sorted(timings.items()):
+        metrics.append('{};dur={:.1f};desc="{} calls"'.format(
+            backend, seconds * 1000, calls))
+    metrics.append("total;dur={:.1f}".format(total * 1000))
+    return ", ".join(metrics)
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+    g.upstream_timings = dict()
+
+@app.after_request
+def report_timings(response):
+    start = g.get('request_start')
+    if start is None:
+        return response
+    total = time.perf_counter() - start
+    timings = g.get('upstream_timings', dict())
+    endpoint = request.endpoint or 'unknown'
+    request_seconds.observe(total, endpoint=endpoint)
+    for backend, (calls, seconds) in timings.items():
+        request_upstream_seconds.observe(seconds,
+                                         endpoint=endpoint,
+                                         backend=backend)
+        request_upstream_calls.observe(calls,
+                                       endpoint=endpoint,
+                                       backend=backend)
+    if app.config.get('SERVER_TIMING', True):
+        response.headers['Server-Timing'] = server_timing(timings, total)
+    return response
+
+if signals_available:
+    # Template rendering is timed like a backend so the Server-Timing
+    # header splits a view into Elastic Search, SPARQL and Jinja time.
+    # Filters render templates inside templates, so the renders in
+    # progress are a stack of [start, seconds spent in nested renders]
+    # and each template records only its own time.
+    def __start_render__(sender, template, context, **extra):
+        g.setdefault('render_starts', []).append([time.perf_counter(), 0.0])
+
+    def __end_render__(sender, template, context, **extra):
+        starts = g.get('render_starts')
+        if not starts:
+            return
+        start, nested = starts.pop()
+        duration = time.perf_counter() - start
+        if len(starts) > 0:
+            starts[-1][1] += duration
+        record('render', template.name, duration - nested)
+
+    before_render_template.connect(__start_render__, app, weak=False)
+    template_rendered.connect(__end_render__, app, weak=False)
@@ -0,0 +1,172 @@
+"""
+Name:        profiling
+Purpose:     On-demand cProfile profiles of live requests, triggered by
+             logged in staff with an X-Profile header or profile query
+             parameter, or sampled at PROFILE_SAMPLE_RATE, and saved to
+             PROFILE_DIR for the /reports/profiles views.
+
+Author:      Jeremy Nelson
+
+Created:     2015/08/05
+Copyright:   (c) Jeremy Nelson 2015
+Licence:     GPLv3
+"""
+__author__ = "Jeremy Nelson"
+__license__ = "GPLv3"
+
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import time
+
+from flask import g, request, session
+from . import app
+
+logger = logging.getLogger(__name__)
+
+PROFILE_NAME_RE = re.compile(r"^\d+-\d+-[\w.]+$")
+PROFILE_SORTS = list(pstats.Stats.sort_arg_dict_default)
+
+def profile_dir():
+    """Returns the directory profiles are saved to, creating it"""
+    directory = app.config.get(
+        'PROFILE_DIR',
+        os.path.join(app.instance_path, 'profiles'))
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+def __requested__():
+    """Returns True if the request should be profiled"""
+    if 'username' in session and \
+       (request.headers.get('X-Profile') or 'profile' in request.args):
+        return True
+    rate = app.config.get('PROFILE_SAMPLE_RATE', 0)
+    return rate > 0 and random.random() < rate
+
+def summarize(stats, size=25):
+    """Returns the functions with the largest cumulative time
+
+    Args:
+        stats -- pstats.Stats
+        size -- number of functions, defaults to 25
+    """
+    rows = []
+    for (filename, line, function), (calls, primitive, total, cumulative,
+                                     callers) in stats.stats.items():
+        rows.append({"function": "{}:{}({})".format(filename, line, function),
+                     "calls": calls,
+                     "total": round(total, 6),
+                     "cumulative": round(cumulative, 6)})
+    return sorted(rows, key=lambda row: row["cumulative"], reverse=True)[:size]
+
+def save_profile(profiler, duration):
+    """Saves a request's profile and its summary, removing the oldest
+    profiles beyond PROFILE_KEEP
+
+    Args:
+        profiler -- disabled cProfile.Profile
+        duration -- seconds the request took
+    """
+    directory = profile_dir()
+    name = "{}-{}-{}".format(int(time.time() * 1000),
+                             os.getpid(),
+                             request.endpoint or 'unknown')
+    stats = pstats.Stats(profiler)
+    stats.dump_stats(os.path.join(directory, "{}.prof".format(name)))
+    with open(os.path.join(directory, "{}.json".format(name)), "w") as summary:
+        json.dump({"name": name,
+                   "endpoint": request.endpoint,
+                   "url": request.full_path,
+                   "method": request.method,
+                   "duration": round(duration, 6),
+                   "time": time.time(),
+                   "functions": summarize(stats)},
+                  summary)
+    for old in list_profiles()[app.config.get('PROFILE_KEEP', 50):]:
+        for ext in ['json', 'prof']:
+            try:
+                os.remove(os.path.join(directory, "{}.{}".format(
+                    old['name'], ext)))
+            except OSError:
+                pass
+    return name
+
+def list_profiles():
+    """Returns the saved profile summaries, newest first"""
+    directory = profile_dir()
+    profiles = []
+    for filename in sorted(os.listdir(directory), reverse=True):
+        if not filename.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, filename)) as summary:
+                profiles.append(json.load(summary))
+        except (OSError, ValueError):
+            continue
+    return profiles
+
+def profile_path(name):
+    """Returns the path of a saved profile or None
+
+    Args:
+        name -- profile name
+    """
+    if not PROFILE_NAME_RE.match(name):
+        return None
+    path = os.path.join(profile_dir(), "{}.prof".format(name))
+    if os.path.exists(path):
+        return path
+
+def profile_text(name, sort='cumulative', size=50):
+    """Returns a saved profile as pstats text or None
+
+    Args:
+        name -- profile name
+        sort -- pstats sort key, defaults to cumulative
+        size -- number of functions, defaults to 50
+    """
+    path = profile_path(name)
+    if path is None:
+        return None
+    output = io.StringIO()
+    stats = pstats.Stats(path, stream=output)
+    stats.sort_stats(sort).print_stats(size)
+    return output.getvalue()
+
+@app.before_request
+def start_profile():
+    if not __requested__():
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiler is already active in this thread
+        return
+    g.profiler = profiler
+    g.profile_start = time.perf_counter()
+
+@app.after_request
+def stop_profile(response):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+    profiler.disable()
+    duration = time.perf_counter() - g.pop('profile_start')
+    try:
+        response.headers['X-Profile'] = save_profile(profiler, duration)
+    except OSError:
+        logger.exception("Saving the profile of %s failed", request.path)
+    return response
+
+@app.teardown_request
+def discard_profile(exception=None):
+    # Disables the profiler of a request that failed before after_request
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
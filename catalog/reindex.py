@@ -0,0 +1,399 @@
+"""
+Name:        reindex
+Purpose:     Zero-downtime reindexing. The catalog searches the ELASTIC_INDEX
+             alias; a rebuild copies the live index into the next
+             versioned index (bibframe_v1, bibframe_v2, ...), throttled so
+             the live cluster keeps serving searches, checks the document
+             counts match and then moves the alias in one atomic
+             _aliases call. The previous version is kept for rollback;
+             migrating a concrete index keeps it as bibframe_v0.
+
+             python -m catalog.reindex --max-rate 2000
+             python -m catalog.reindex --mapping bibframe.json
+             python -m catalog.reindex --rollback
+             python -m catalog.reindex --status
+
+Author:      Jeremy Nelson
+
+Created:     2015/08/14
+Copyright:   (c) Jeremy Nelson 2015
+Licence:     GPLv3
+"""
+__author__ = "Jeremy Nelson"
+__license__ = "GPLv3"
+
+import argparse
+import json
+import logging
+import os
+import re
+import time
+
+from elasticsearch.helpers import bulk, scan
+from . import app, es_index, es_search
+from .ingest import Throughput, __refresh_interval__
+
+logger = logging.getLogger(__name__)
+
+# Index settings that are set by Elastic Search and can't be copied into
+# a new index
+GENERATED_SETTINGS = ['creation_date', 'uuid', 'version']
+
+
+def version_name(alias, version):
+    return "{}_v{}".format(alias, version)
+
+def index_version(name, alias=es_index):
+    """Returns the version number of a versioned index of the alias or
+    None"""
+    match = re.match(r"^{}_v(\d+)$".format(re.escape(alias)), name)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+def versions(elastic_search=None, alias=es_index):
+    """Returns the sorted (version, index name) of the alias's versioned
+    indices"""
+    if elastic_search is None:
+        elastic_search = es_search
+    settings = elastic_search.indices.get_settings(
+        index="{}_v*".format(alias))
+    found = [(index_version(name, alias), name) for name in settings]
+    return sorted([row for row in found if row[0] is not None])
+
+def live_index(elastic_search=None, alias=es_index):
+    """Returns the index the alias points to, the alias itself when it is
+    still a concrete index, or None if neither exists"""
+    if elastic_search is None:
+        elastic_search = es_search
+    if elastic_search.indices.exists_alias(name=alias):
+        return sorted(elastic_search.indices.get_alias(name=alias))[0]
+    if elastic_search.indices.exists(index=alias):
+        return alias
+    return None
+
+def index_body(index, elastic_search=None):
+    """Returns the settings and mappings of an index as the body for
+    creating a copy of it"""
+    if elastic_search is None:
+        elastic_search = es_search
+    settings = elastic_search.indices.get_settings(
+        index=index)[index]['settings']['index']
+    for name in GENERATED_SETTINGS:
+        settings.pop(name, None)
+    mappings = elastic_search.indices.get_mapping(
+        index=index)[index]['mappings']
+    return {"settings": {"index": settings}, "mappings": mappings}
+
+
+class Throttle(object):
+    """Sleeps so that no more than rate documents a second are sent, or
+    never if rate is None"""
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.start = time.time()
+        self.sent = 0
+
+    def wait(self, count):
+        self.sent += count
+        if not self.rate:
+            return
+        ahead = self.sent / float(self.rate) - (time.time() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def copy_documents(source,
+                   target,
+                   elastic_search=None,
+                   batch_size=500,
+                   max_rate=None,
+                   stats=None):
+    """Copies every document of the source index into the target with
+    scan and _bulk, returning the Throughput
+
+    Args:
+        source -- Name of the index to read
+        target -- Name of the index to write
+        elastic_search -- Elastic Search client, defaults to es_search
+        batch_size -- Documents per scroll page and _bulk request
+        max_rate -- Documents per second, None for no limit
+        stats -- Throughput to add to
+    """
+    if elastic_search is None:
+        elastic_search = es_search
+    if stats is None:
+        stats = Throughput()
+    throttle = Throttle(max_rate)
+    batch = []
+    hits = scan(elastic_search,
+                query={"query": {"match_all": {}}},
+                index=source,
+                size=batch_size)
+    for hit in hits:
+        batch.append({"_index": target,
+                      "_type": hit['_type'],
+                      "_id": hit['_id'],
+                      "_source": hit['_source']})
+        if len(batch) >= batch_size:
+            __write__(elastic_search, batch, stats)
+            throttle.wait(len(batch))
+            batch = []
+    if len(batch) > 0:
+        __write__(elastic_search, batch, stats)
+    return stats
+
+def __write__(elastic_search, actions, stats):
+    count, errors = bulk(elastic_search,
+                         actions,
+                         chunk_size=len(actions),
+                         raise_on_error=False)
+    for error in errors[:10]:
+        logger.error("Copying failed %s", error)
+    stats.add(documents=count, errors=len(errors))
+
+def count_documents(index, elastic_search=None):
+    if elastic_search is None:
+        elastic_search = es_search
+    elastic_search.indices.refresh(index=index)
+    return elastic_search.count(index=index)['count']
+
+def swap_alias(alias, target, elastic_search=None):
+    """Points the alias at the target index in one atomic _aliases call,
+    returning the indices it pointed to before"""
+    if elastic_search is None:
+        elastic_search = es_search
+    previous = []
+    if elastic_search.indices.exists_alias(name=alias):
+        previous = sorted(elastic_search.indices.get_alias(name=alias))
+    actions = [{"remove": {"index": index, "alias": alias}}
+               for index in previous if index != target]
+    actions.append({"add": {"index": target, "alias": alias}})
+    elastic_search.indices.update_aliases(body={"actions": actions})
+    return previous
+
+def __migrate__(alias, target, elastic_search, batch_size=500,
+                max_rate=None):
+    """Replaces the concrete index named alias with an alias of the same
+    name, returning the name of the version 0 index the original is first
+    copied into unchanged, so that rollback can return to it. Elastic
+    Search 1.x can't delete an index inside an _aliases call, so searches
+    fail between the two requests."""
+    backup = version_name(alias, 0)
+    if elastic_search.indices.exists(index=backup):
+        # Left by a migration that failed before the alias was created
+        elastic_search.indices.delete(index=backup)
+    logger.info("Copying %s into %s for rollback", alias, backup)
+    elastic_search.indices.create(index=backup,
+                                  body=index_body(alias, elastic_search))
+    copy_documents(alias, backup,
+                   elastic_search=elastic_search,
+                   batch_size=batch_size,
+                   max_rate=max_rate)
+    if count_documents(alias, elastic_search) != \
+       count_documents(backup, elastic_search):
+        raise IOError("Copying {} into {} lost documents, the index was not "
+                      "replaced".format(alias, backup))
+    logger.warning("Deleting the %s index to replace it with an alias of %s",
+                   alias, target)
+    elastic_search.indices.delete(index=alias)
+    swap_alias(alias, target, elastic_search)
+    return backup
+
+def reindex(elastic_search=None,
+            alias=es_index,
+            body=None,
+            batch_size=500,
+            max_rate=None,
+            swap=True,
+            migrate=False,
+            catch_up=False):
+    """Rebuilds the live index into the next versioned index and moves the
+    alias to it once the document counts match, returning a report
+
+    Args:
+        elastic_search -- Elastic Search client, defaults to es_search
+        alias -- Alias the catalog searches, defaults to ELASTIC_INDEX
+        body -- Settings and mappings of the new index, defaults to a copy
+                of the live index's
+        batch_size -- Documents per _bulk request
+        max_rate -- Documents copied per second, None for no limit
+        swap -- Move the alias, otherwise leave the new index for
+                inspection
+        migrate -- Allow replacing a concrete index named alias, the first
+                   time the catalog is moved to versioned indices. The
+                   original is kept as version 0.
+        catch_up -- Replay the repository changes made during the copy
+                    with the sync worker after the swap
+    """
+    if elastic_search is None:
+        elastic_search = es_search
+    source = live_index(elastic_search, alias)
+    if source is None:
+        raise ValueError("{} is neither an index nor an alias".format(alias))
+    if source == alias and swap and not migrate:
+        raise ValueError(
+            "{} is a concrete index, rerun with migrate to replace it with "
+            "an alias".format(alias))
+    existing = versions(elastic_search, alias)
+    version = existing[-1][0] + 1 if len(existing) > 0 else 1
+    target = version_name(alias, version)
+    if body is None:
+        body = index_body(source, elastic_search)
+    settings = body.setdefault("settings", {}).setdefault("index", {})
+    replicas = settings.pop('number_of_replicas', None)
+    refresh_interval = settings.pop('refresh_interval', "1s")
+    # No replicas or refreshes while copying, both are restored before
+    # the counts are compared
+    settings['number_of_replicas'] = 0
+    settings['refresh_interval'] = "-1"
+    mark = __sync_mark__() if catch_up else None
+    logger.info("Copying %s into %s", source, target)
+    elastic_search.indices.create(index=target, body=body)
+    stats = copy_documents(source, target,
+                           elastic_search=elastic_search,
+                           batch_size=batch_size,
+                           max_rate=max_rate)
+    __refresh_interval__(elastic_search, target, refresh_interval)
+    if replicas is not None:
+        elastic_search.indices.put_settings(
+            index=target,
+            body={"index": {"number_of_replicas": replicas}})
+    report = stats.report()
+    report.update({"alias": alias,
+                   "source": source,
+                   "target": target,
+                   "source_count": count_documents(source, elastic_search),
+                   "target_count": count_documents(target, elastic_search),
+                   "swapped": False})
+    if report['source_count'] != report['target_count']:
+        raise IOError(
+            "{source} has {source_count} documents but {target} has "
+            "{target_count}, the alias was not moved".format(**report))
+    if not swap:
+        return report
+    if source == alias:
+        source = report['source'] = __migrate__(alias, target,
+                                                elastic_search,
+                                                batch_size,
+                                                max_rate)
+    else:
+        swap_alias(alias, target, elastic_search)
+    report['swapped'] = True
+    logger.info("%s now points to %s, %s kept for rollback",
+                alias, target, source)
+    if mark is not None:
+        report['replayed'] = __replay__(mark, elastic_search, alias)
+    return report
+
+def rollback(elastic_search=None, alias=es_index):
+    """Points the alias back to the newest version older than the live
+    one, returning its name"""
+    if elastic_search is None:
+        elastic_search = es_search
+    live = index_version(live_index(elastic_search, alias) or '', alias)
+    older = [name for version, name in versions(elastic_search, alias)
+             if live is None or version < live]
+    if len(older) < 1:
+        raise ValueError("No earlier version of {} to roll back to".format(
+            alias))
+    swap_alias(alias, older[-1], elastic_search)
+    logger.info("%s rolled back to %s", alias, older[-1])
+    return older[-1]
+
+def prune(keep=1, elastic_search=None, alias=es_index):
+    """Deletes all but the newest keep versions that are not live,
+    returning the names deleted"""
+    if elastic_search is None:
+        elastic_search = es_search
+    live = live_index(elastic_search, alias)
+    idle = [name for version, name in versions(elastic_search, alias)
+            if name != live]
+    deleted = idle[:max(len(idle) - keep, 0)]
+    for name in deleted:
+        elastic_search.indices.delete(index=name)
+    return deleted
+
+def status(elastic_search=None, alias=es_index):
+    """Returns the live index and the document count of each version"""
+    if elastic_search is None:
+        elastic_search = es_search
+    return {"alias": alias,
+            "live": live_index(elastic_search, alias),
+            "versions": [
+                {"index": name,
+                 "documents": elastic_search.count(index=name)['count']}
+                for version, name in versions(elastic_search, alias)]}
+
+def __sync_mark__():
+    """Returns the high-water mark of the sync worker, or None if it has
+    not run"""
+    from .sync import SyncState, sync_state_path
+    path = sync_state_path()
+    if not os.path.exists(path):
+        return None
+    return SyncState(path).load().mark
+
+def __replay__(mark, elastic_search, alias):
+    """Reindexes the repository changes since mark into the alias. Writes
+    made while the copy ran went to the previous index."""
+    from .sync import PollingFeed, SyncState, SyncWorker, sync_state_path
+    state = SyncState("{}.reindex".format(sync_state_path()))
+    state.mark = mark
+    worker = SyncWorker(PollingFeed(), state,
+                        elastic_search=elastic_search,
+                        index=alias)
+    worker.run(once=True)
+    return state.indexed
+
+
+def main(args):
+    logging.basicConfig(level=logging.INFO)
+    with app.app_context():
+        if args.status:
+            output = status()
+        elif args.rollback:
+            output = {"live": rollback()}
+        elif args.prune is not None:
+            output = {"deleted": prune(args.prune)}
+        else:
+            body = None
+            if args.mapping:
+                with open(args.mapping) as mapping:
+                    body = json.load(mapping)
+            output = reindex(body=body,
+                             batch_size=args.batch_size,
+                             max_rate=args.max_rate,
+                             swap=not args.no_swap,
+                             migrate=args.migrate,
+                             catch_up=not args.no_catch_up)
+    print(json.dumps(output, indent=2))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Rebuilds the catalog index behind its alias")
+    parser.add_argument('--mapping',
+                        help='JSON file with the settings and mappings of '
+                             'the new index, copied from the live index if '
+                             'not given')
+    parser.add_argument('--batch-size', type=int,
+                        default=app.config.get('REINDEX_BATCH_SIZE', 500))
+    parser.add_argument('--max-rate', type=float,
+                        default=app.config.get('REINDEX_MAX_RATE'),
+                        help='Documents copied per second')
+    parser.add_argument('--no-swap', action='store_true',
+                        help='Build and verify the new index without '
+                             'moving the alias')
+    parser.add_argument('--migrate', action='store_true',
+                        help='Replace a concrete index with the alias, '
+                             'keeping a copy of it as version 0')
+    parser.add_argument('--no-catch-up', action='store_true',
+                        help='Do not replay the repository changes made '
+                             'during the copy')
+    parser.add_argument('--rollback', action='store_true',
+                        help='Point the alias back to the previous version')
+    parser.add_argument('--prune', type=int, metavar='KEEP',
+                        help='Delete all but KEEP previous versions')
+    parser.add_argument('--status', action='store_true')
+    main(parser.parse_args())
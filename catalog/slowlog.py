@@ -0,0 +1,186 @@
+"""
+Name:        slowlog
+Purpose:     Slow query log for the Elastic Search and SPARQL calls of the
+             catalog, recording the normalized query, view, duration and
+             hit count of calls above a threshold and aggregating them by
+             query shape.
+
+Author:      Jeremy Nelson
+
+Created:     2015/08/05
+Copyright:   (c) Jeremy Nelson 2015
+Licence:     GPLv3
+"""
+__author__ = "Jeremy Nelson"
+__license__ = "GPLv3"
+
+import json
+import logging
+import re
+import threading
+import time
+
+from collections import deque
+from flask import has_request_context, request
+from . import app
+
+logger = logging.getLogger(__name__)
+
+SPARQL_IRI_RE = re.compile(r"<[^>\s]*>")
+SPARQL_LITERAL_RE = re.compile(r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'')
+SPARQL_NUMBER_RE = re.compile(r"\b\d+(\.\d+)?\b")
+# Parameters of the Elastic Search client that shape a query rather than
+# carry its values
+SHAPE_PARAMS = ['index', 'doc_type', 'fields', '_source_include', 'size']
+
+def normalize_dsl(value):
+    """Replaces the values of an Elastic Search DSL body with ?, keeping
+    its structure, so that queries differing only in their phrases, ids
+    or offsets share one shape
+
+    Args:
+        value -- DSL body, or the list of header and body pairs of an
+                 msearch
+    """
+    if isinstance(value, dict):
+        return dict([(key, normalize_dsl(row)) for key, row in value.items()])
+    if isinstance(value, (list, tuple)):
+        rows = [normalize_dsl(row) for row in value]
+        if all(row == "?" for row in rows):
+            return ["?"] if len(rows) > 0 else []
+        return rows
+    return "?"
+
+def normalize_sparql(sparql):
+    """Replaces the IRIs, literals and numbers of a SPARQL query with ?
+    and normalizes its whitespace
+
+    Args:
+        sparql -- SPARQL query
+    """
+    sparql = SPARQL_IRI_RE.sub("?", sparql)
+    sparql = SPARQL_LITERAL_RE.sub("?", sparql)
+    sparql = SPARQL_NUMBER_RE.sub("?", sparql)
+    return " ".join(sparql.split())
+
+def query_shape(backend, operation, args, kwargs):
+    """Returns the normalized query of a client call as a string
+
+    Args:
+        backend -- backend name, es or sparql
+        operation -- client method
+        args -- positional arguments of the call
+        kwargs -- keyword arguments of the call
+    """
+    body = kwargs.get('body', kwargs.get('sparql', args[0] if args else None))
+    if isinstance(body, str):
+        return "{} {}".format(operation, normalize_sparql(body))
+    shape = {"operation": operation}
+    for param in SHAPE_PARAMS:
+        if param in kwargs:
+            shape[param] = kwargs[param]
+    if body is not None:
+        shape["body"] = normalize_dsl(body)
+    return json.dumps(shape, sort_keys=True, default=str)
+
+def hit_count(result):
+    """Returns the hits of an Elastic Search or SPARQL result, or None"""
+    if not isinstance(result, dict):
+        return None
+    if 'hits' in result:
+        return result['hits'].get('total')
+    if 'responses' in result:
+        return sum(row.get('hits', {}).get('total', 0)
+                   for row in result['responses'])
+    if 'docs' in result:
+        return len([doc for doc in result['docs'] if doc.get('found')])
+    if 'bindings' in result:
+        return len(result['bindings'])
+    if 'found' in result:
+        return int(result['found'])
+    return None
+
+
+class SlowQueryLog(object):
+    """Keeps the most recent slow queries and a rolling aggregation of
+    their shapes, evicting the shape seen longest ago when full"""
+
+    def __init__(self, threshold=0.5, maxlen=100, max_shapes=500):
+        self.threshold = threshold
+        self.recent = deque(maxlen=maxlen)
+        self.max_shapes = max_shapes
+        self.shapes = dict()
+        self.lock = threading.Lock()
+
+    def observe(self, backend, operation, args, kwargs, result, duration):
+        """Records a call if it took longer than the threshold
+
+        Args:
+            backend -- backend name, es or sparql
+            operation -- client method
+            args -- positional arguments of the call
+            kwargs -- keyword arguments of the call
+            result -- the call's result
+            duration -- seconds the call took
+        """
+        if self.threshold is None or duration < self.threshold:
+            return
+        view = request.endpoint if has_request_context() else None
+        entry = {"backend": backend,
+                 "operation": operation,
+                 "query": query_shape(backend, operation, args, kwargs),
+                 "view": view,
+                 "duration": round(duration, 6),
+                 "hits": hit_count(result),
+                 "time": time.time()}
+        logger.warning("Slow %s %s in %s took %.3fs, %s hits: %s",
+                       backend, operation, view, duration, entry["hits"],
+                       entry["query"])
+        key = (backend, entry["query"])
+        with self.lock:
+            self.recent.append(entry)
+            shape = self.shapes.pop(key, None)
+            if shape is None:
+                shape = {"backend": backend,
+                         "query": entry["query"],
+                         "views": [],
+                         "count": 0,
+                         "total": 0.0,
+                         "max": 0.0}
+                if len(self.shapes) >= self.max_shapes:
+                    del self.shapes[next(iter(self.shapes))]
+            shape["count"] += 1
+            shape["total"] += duration
+            shape["max"] = max(shape["max"], duration)
+            shape["last"] = entry["time"]
+            if view is not None and not view in shape["views"]:
+                shape["views"].append(view)
+            # Reinserted so the dict stays ordered by last use
+            self.shapes[key] = shape
+
+    def top(self, size=20, sort='total'):
+        """Returns the slowest query shapes with their mean duration
+
+        Args:
+            size -- number of shapes, defaults to 20
+            sort -- total, max, count or mean, defaults to total
+        """
+        with self.lock:
+            shapes = [dict(shape, views=list(shape["views"]))
+                      for shape in self.shapes.values()]
+        for shape in shapes:
+            shape["mean"] = shape["total"] / shape["count"]
+        return sorted(shapes,
+                      key=lambda shape: shape.get(sort, shape["total"]),
+                      reverse=True)[:size]
+
+    def clear(self):
+        with self.lock:
+            self.recent.clear()
+            self.shapes.clear()
+
+
+slow_queries = SlowQueryLog(
+    app.config.get('SLOW_QUERY_THRESHOLD', 0.5),
+    app.config.get('SLOW_QUERY_RECENT', 100),
+    app.config.get('SLOW_QUERY_SHAPES', 500))
@@ -21,6 +21,7 @@ function CatalogViewModel() {
 	self.sortOptions = ['Relevance','A-Z','Z-A'];
 	self.flash = ko.observable();
 	self.from = ko.observable(0);
+	self.cursor = ko.observable("");
 	self.queryPhrase = ko.observable();
 	self.queryPhraseForResults = ko.observable()
 	self.errorMsg = ko.observable("");
@@ -73,7 +74,7 @@ function CatalogViewModel() {
     };
     
 	self.loadResults = function() {
-		if((self.from() < self.totalResults())&&(self.viewMode()=='search')) { 
+		if((self.from() < self.totalResults())&&(self.cursor() !== null)&&(self.viewMode()=='search')) { 
 			   searchCatalog();
         }
 	}
@@ -112,6 +113,7 @@ function CatalogViewModel() {
 							if (isNotNull(queryStr)) {
 								$('.bf_searchToolbar').show();
 								self.from(0);
+								self.cursor("");
 								searchCatalog();
 							} else {
 								$('.bf_searchToolbar').hide();
@@ -193,6 +195,7 @@ function searchCatalog() {
 	  csrfmiddlewaretoken: self.csrf_token,
 	  phrase: self.queryPhrase(),
 	  from: self.from(),
+	  cursor: self.cursor(),
 	  size: self.shardSize() 
         }
         if(self.chosenBfSortViewId()) {
@@ -216,6 +219,9 @@ function searchCatalog() {
 					self.queryPhraseForResults(self.queryPhrase());
 					self.errorMsg("");
 					self.from(datastore_response['from']);
+					if('next' in datastore_response) {
+						self.cursor(datastore_response['next']);
+					}
 					if(datastore_response['total'] != self.totalResults()) {
 						self.totalResults(datastore_response['total']);
 					}
@@ -1,8 +1,4 @@
 function bibcat_launch_suggestbox (){
-	bfAgents.initialize();
-	bfInstances.initialize();
-	bfWorks.initialize(); 
-	bfTopics.initialize();
 	$('#bf_typeahead .typeahead').typeahead(
 	   {
 			highlight: true
@@ -10,7 +6,7 @@ function bibcat_launch_suggestbox (){
 	   {
 			name: 'bf-works',		
 			displayKey: 'work',		
-			source: bfWorks.ttAdapter(),	
+			source: bfAllTypesSource('work'),	
 			templates: {
 						header: '<h3 class="bg-info">Works</h3>',
 						footer: ''
@@ -19,7 +15,7 @@ function bibcat_launch_suggestbox (){
 	   {
 		  name: 'bf-instance',
 		  displayKey: 'instance',
-		  source: bfInstances.ttAdapter(),
+		  source: bfAllTypesSource('instance'),
 		  templates: 	{
 						   header: '<h3 class="bg-info">Instances</h3>',
 						   footer: ''
@@ -28,7 +24,7 @@ function bibcat_launch_suggestbox (){
 	   {
 		  name: 'bf-agent',
 		  displayKey: 'agent',
-		  source: bfAgents.ttAdapter(),
+		  source: bfAllTypesSource('agent'),
 		  templates:	{
 						   header: '<h3 class="bg-info">Agents (People/Organizations)</h3>',
 						   footer: ''
@@ -37,7 +33,7 @@ function bibcat_launch_suggestbox (){
 	   {
 		  name: 'bf-topics',
 		  displayKey: 'topic',
-		  source: bfTopics.ttAdapter(),
+		  source: bfAllTypesSource('topic'),
 		  templates: 	{
 							header: '<h3 class="bg-info">Topics</h3>',
 							footer: ''
@@ -68,25 +64,12 @@ $("div[class^='tt-dataset']").hover(function() {
 	$("div[class^='tt-dataset']").removeClass("tt-selectedDataSet");
 	$(this).addClass("tt-selectedDataSet");
 });
-var bfAgents = new Bloodhound({
-  datumTokenizer: Bloodhound.tokenizers.obj.whitespace('agent'),
-  queryTokenizer: Bloodhound.tokenizers.whitespace,
-  remote: '/typeahead?q=%QUERY&type=Agent'
-});
-
-
 var bfAuthorities = new Bloodhound({
   datumTokenizer: Bloodhound.tokenizers.obj.whitespace('authority'),
   queryTokenizer: Bloodhound.tokenizers.whitespace,
   remote: '/typeahead?q=%QUERY&type=Authority'
 });
 
-var bfInstances = new Bloodhound({
-  datumTokenizer: Bloodhound.tokenizers.obj.whitespace('instance'),
-  queryTokenizer: Bloodhound.tokenizers.whitespace,
-  remote: '/typeahead?q=%QUERY&type=Instance'
-});
-
 var bfPeople = new Bloodhound({
   datumTokenizer: Bloodhound.tokenizers.obj.whitespace('person'),
   queryTokenizer: Bloodhound.tokenizers.whitespace,
@@ -94,15 +77,41 @@ var bfPeople = new Bloodhound({
  });
 
 
-var bfTopics = new Bloodhound({
-  datumTokenizer: Bloodhound.tokenizers.obj.nonword('topic'),
-  queryTokenizer: Bloodhound.tokenizers.whitespace,
-  remote: '/typeahead?q=%QUERY&type=Topic'
- });
-
+// All of the typeahead datasets share one /typeahead?type=AllTypes request
+// per query, debounced like the Bloodhound remotes.
+var bfAllTypes = {
+  query: null,
+  pending: null,
+  timer: null,
+  fetch: function(query) {
+    if (query !== this.query) {
+      var pending = $.Deferred();
+      this.query = query;
+      this.pending = pending;
+      var self = this;
+      clearTimeout(this.timer);
+      this.timer = setTimeout(function() {
+        $.getJSON('/typeahead', {q: query, type: 'AllTypes'})
+          .done(pending.resolve)
+          .fail(function() {
+            // Forget the failed query so typing it again refetches, and
+            // give every waiting dataset an empty list
+            if (self.pending === pending) {
+              self.query = null;
+              self.pending = null;
+            }
+            pending.resolve({});
+          });
+      }, 300);
+    }
+    return this.pending;
+  }
+};
 
-var bfWorks = new Bloodhound({
-  datumTokenizer: Bloodhound.tokenizers.obj.whitespace('work'),
-  queryTokenizer: Bloodhound.tokenizers.whitespace,
-  remote: '/typeahead?q=%QUERY&type=Work'
- });
+function bfAllTypesSource(group) {
+  return function(query, cb) {
+    bfAllTypes.fetch(query).done(function(response) {
+      cb(response[group] || []);
+    });
+  };
+}
@@ -0,0 +1,217 @@
+"""
+Name:        suggest
+Purpose:     In-process prefix index that answers typeahead requests
+             without querying Elastic Search on every keystroke.
+
+Author:      Jeremy Nelson
+
+Created:     2015/07/20
+Copyright:   (c) Jeremy Nelson 2015
+Licence:     GPLv3
+"""
+__author__ = "Jeremy Nelson"
+__license__ = "GPLv3"
+
+import bisect
+import logging
+import re
+import threading
+import time
+
+from elasticsearch.helpers import scan
+from . import app, es_index, es_search
+from .util import SUGGEST_GROUPS
+
+logger = logging.getLogger(__name__)
+
+# Source fields used as labels when a document has no *_suggest input
+LABEL_FIELDS = ['bf:label',
+                'bf:titleStatement',
+                'bf:title',
+                'bf:titleValue',
+                'bf:authorizedAccessPoint']
+
+NON_WORD_RE = re.compile(r"[^\w]+")
+
+def normalize(label):
+    """Normalizes a label or typed phrase for prefix matching
+
+    Args:
+        label -- text label
+    """
+    return " ".join(NON_WORD_RE.sub(" ", label.lower()).split())
+
+
+class PrefixIndex(object):
+    """Sorted arrays, one for each suggester key, of normalized labels
+    mapped to the label and uuid of every typeahead entity in the bibframe
+    index"""
+
+    def __init__(self, elastic_search=None, index=es_index):
+        self.elastic_search = elastic_search
+        self.index = index
+        self.keys, self.entries = dict(), dict()
+        self.by_uuid = dict()
+        self.ready = False
+        self.last_refresh = None
+        self.last_build = None
+        self.lock = threading.Lock()
+
+    def __entries__(self, doc):
+        """Returns the (normalized, label, uuid, key) entries for an
+        Elastic Search document"""
+        key = doc.get('_type', '').lower()
+        source = doc.get('_source', {})
+        suggest = source.get('{}_suggest'.format(key), {})
+        labels = suggest.get('input', []) if isinstance(suggest, dict) else []
+        if isinstance(labels, str):
+            labels = [labels]
+        if len(labels) < 1:
+            for field in LABEL_FIELDS:
+                if field in source:
+                    labels = source[field]
+                    break
+        output = []
+        for label in set(labels):
+            normalized = normalize(label)
+            if len(normalized) > 0:
+                output.append((normalized, label, doc['_id'], key))
+        return output
+
+    def __scan__(self, query=None):
+        """Scrolls through the typeahead document types in the index"""
+        doc_types = ",".join([key.title() for key, group in SUGGEST_GROUPS])
+        es_dsl = {"query": query or {"match_all": {}}}
+        for doc in scan(self.elastic_search or es_search,
+                        query=es_dsl,
+                        index=self.index,
+                        doc_type=doc_types):
+            yield doc
+
+    def __swap__(self, by_uuid):
+        """Rebuilds the sorted arrays of each key from entries by uuid and
+        swaps them in place of the current ones"""
+        entries = dict()
+        for rows in by_uuid.values():
+            for entry in rows:
+                entries.setdefault(entry[3], []).append(entry)
+        keys = dict()
+        for key, rows in entries.items():
+            rows.sort()
+            keys[key] = [entry[0] for entry in rows]
+        self.keys, self.entries, self.by_uuid = keys, entries, by_uuid
+
+    def build(self):
+        """Builds the index by scrolling through all typeahead documents"""
+        started = time.time()
+        by_uuid = dict()
+        for doc in self.__scan__():
+            by_uuid[doc['_id']] = self.__entries__(doc)
+        with self.lock:
+            self.__swap__(by_uuid)
+            self.last_refresh = self.last_build = started
+            self.ready = True
+
+    def refresh(self):
+        """Merges documents changed since the last refresh into the index
+        if TYPEAHEAD_INDEX_TIMESTAMP is configured, otherwise rebuilds the
+        whole index. Deleted documents have no timestamp to find them by,
+        so the index is also rebuilt every TYPEAHEAD_INDEX_REBUILD
+        seconds."""
+        timestamp_field = app.config.get('TYPEAHEAD_INDEX_TIMESTAMP')
+        rebuild = app.config.get('TYPEAHEAD_INDEX_REBUILD', 86400)
+        if not self.ready or timestamp_field is None or \
+           time.time() - self.last_build >= rebuild:
+            return self.build()
+        started = time.time()
+        since = int(self.last_refresh * 1000)
+        by_uuid = dict(self.by_uuid)
+        for doc in self.__scan__(
+            {"range": {timestamp_field: {"gte": since}}}):
+            by_uuid[doc['_id']] = self.__entries__(doc)
+        with self.lock:
+            self.__swap__(by_uuid)
+            self.last_refresh = started
+
+    def suggest(self, phrase, keys, size=5):
+        """Returns up to size (label, uuid) matches for each suggester key
+        whose normalized label starts with the phrase
+
+        Args:
+            phrase -- text phrase
+            keys -- list of suggester keys, i.e. work, person
+            size -- maximum number of matches for each key
+        """
+        prefix = normalize(phrase or '')
+        output = dict([(key, []) for key in keys])
+        all_keys, all_entries = self.keys, self.entries
+        if len(prefix) < 1:
+            return output
+        for key in output:
+            keys_ = all_keys.get(key, [])
+            entries = all_entries.get(key, [])
+            seen = set()
+            position = bisect.bisect_left(keys_, prefix)
+            while (len(output[key]) < size and position < len(keys_) and
+                   keys_[position].startswith(prefix)):
+                normalized, label, uuid, key_ = entries[position]
+                position += 1
+                if uuid in seen:
+                    continue
+                seen.add(uuid)
+                output[key].append((label, uuid))
+        return output
+
+    def start(self, interval):
+        """Builds the index and refreshes it every interval seconds in a
+        background thread"""
+        def run():
+            while True:
+                try:
+                    self.refresh()
+                except Exception:
+                    logger.exception("Typeahead prefix index refresh failed")
+                time.sleep(interval)
+        thread = threading.Thread(target=run, name="typeahead-prefix-index")
+        thread.daemon = True
+        thread.start()
+
+prefix_index = PrefixIndex()
+
+@app.before_first_request
+def start_prefix_index():
+    """Starts the prefix index in each worker if TYPEAHEAD_INDEX is set"""
+    if app.config.get('TYPEAHEAD_INDEX', False):
+        prefix_index.start(app.config.get('TYPEAHEAD_INDEX_REFRESH', 300))
+
+def prefix_search(phrase, key):
+    """Answers a typeahead request from the prefix index, returning the
+    same JSON rows as the Elastic Search suggesters
+
+    Args:
+        phrase -- text phrase
+        key -- typeahead type, i.e. work, agent, alltypes
+    """
+    groups = dict([(key_, group) for key_, group in SUGGEST_GROUPS])
+    if key.startswith('alltypes'):
+        suggest_keys = list(groups.keys())
+    elif key.startswith('agent'):
+        suggest_keys = ['person', 'organization']
+    else:
+        suggest_keys = [key]
+    matches = prefix_index.suggest(phrase, suggest_keys)
+    if key.startswith('alltypes'):
+        output = dict([(group, []) for group in set(groups.values())])
+    else:
+        output = []
+    for suggest_key in suggest_keys:
+        group = groups.get(suggest_key, suggest_key)
+        if key.startswith('agent'):
+            group = 'agent'
+        rows = [{group: label, 'uuid': uuid}
+                for label, uuid in matches[suggest_key]]
+        if key.startswith('alltypes'):
+            output[group].extend(rows)
+        else:
+            output.extend(rows)
+    return output
@@ -0,0 +1,468 @@
+"""
+Name:        sync
+Purpose:     Incremental reindexing worker that keeps the bibframe index in
+             step with the Fedora 4 repository. Changes come from Fedora's
+             event stream, as JSON lines, or from polling the triplestore
+             for fedora:lastModified past a high-water mark. Only the
+             changed resources are reindexed and the Works and Instances
+             that display them are queued for new display fields.
+
+             python -m catalog.sync --interval 10
+             fcrepo-events | python -m catalog.sync --events -
+
+Author:      Jeremy Nelson
+
+Created:     2015/08/11
+Copyright:   (c) Jeremy Nelson 2015
+Licence:     GPLv3
+"""
+__author__ = "Jeremy Nelson"
+__license__ = "GPLv3"
+
+import argparse
+import calendar
+import datetime
+import io
+import json
+import logging
+import os
+import re
+import select
+import sys
+import time
+
+from elasticsearch.helpers import bulk
+from . import app, es_index, es_search
+from .datastore import sparql_backend
+from .denormalize import dependents, refresh
+from .ingest import field_name, search_doc_type
+
+logger = logging.getLogger(__name__)
+
+FEDORA = "http://fedora.info/definitions/v4/repository#"
+RDF_TYPE = "http://www.w3.org/1999/02/22-rdf-syntax-ns#type"
+
+CHANGES_SPARQL = """PREFIX fedora: <http://fedora.info/definitions/v4/repository#>
+PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
+SELECT DISTINCT ?resource ?modified
+WHERE {{
+  ?resource fedora:lastModified ?modified .
+  FILTER(?modified > "{mark}"^^xsd:dateTime ||
+         (?modified = "{mark}"^^xsd:dateTime && STR(?resource) > "{after}"))
+}}
+ORDER BY ?modified STR(?resource)
+LIMIT {size}"""
+
+RESOURCES_SPARQL = """PREFIX fedora: <http://fedora.info/definitions/v4/repository#>
+SELECT ?resource ?predicate ?object ?uuid
+WHERE {{
+  VALUES ?resource {{ {} }}
+  ?resource ?predicate ?object .
+  OPTIONAL {{ ?object fedora:uuid ?uuid }}
+}}"""
+
+EPOCH = "1970-01-01T00:00:00Z"
+XSD_DATETIME_RE = re.compile(
+    r"^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(\.\d+)?(Z|[+-]\d\d:\d\d)?$")
+
+def parse_time(value):
+    """Returns seconds since the epoch of an xsd:dateTime or of Fedora's
+    millisecond event timestamps"""
+    if isinstance(value, (int, float)) or str(value).isdigit():
+        return int(value) / 1000.0
+    match = XSD_DATETIME_RE.match(str(value).strip())
+    if match is None:
+        raise ValueError("Invalid xsd:dateTime {}".format(value))
+    moment = datetime.datetime.strptime(match.group(1), "%Y-%m-%dT%H:%M:%S")
+    seconds = calendar.timegm(moment.timetuple()) + \
+        float(match.group(2) or 0)
+    offset = match.group(3)
+    if offset and offset != "Z":
+        sign = -1 if offset.startswith("-") else 1
+        seconds -= sign * (int(offset[1:3]) * 3600 + int(offset[4:6]) * 60)
+    return seconds
+
+def format_time(seconds):
+    """Returns an xsd:dateTime in UTC for seconds since the epoch"""
+    return datetime.datetime.fromtimestamp(
+        seconds, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+class Change(object):
+    """A changed Fedora resource"""
+
+    def __init__(self, url, modified, deleted=False):
+        self.url = url
+        self.modified = modified
+        self.deleted = deleted
+
+    def __repr__(self):
+        return "Change({!r}, {!r}, deleted={})".format(
+            self.url, self.modified, self.deleted)
+
+
+class PollingFeed(object):
+    """Polls the triplestore, or the rdflib stand-in of DATASTORE, for
+    resources whose fedora:lastModified is at or after the high-water
+    mark, ordered by time and url. Deletions are not seen by polling."""
+
+    def __init__(self, datastore=None):
+        self.datastore = datastore or sparql_backend
+
+    def changes(self, mark, size, after=None):
+        """Returns up to size Changes at or after a high-water mark
+
+        Args:
+            mark -- high-water mark, an xsd:dateTime
+            size -- maximum number of changes
+            after -- skip the resources at the mark with urls up to this
+                     one, so that more resources than size sharing a
+                     timestamp are paged through
+        """
+        after = (after or "").replace("\\", "\\\\").replace('"', '\\"')
+        result = self.datastore.query(CHANGES_SPARQL.format(
+            mark=mark or EPOCH, after=after, size=size))
+        if result is None:
+            raise IOError("Polling the triplestore for changes failed")
+        return [Change(row['resource']['value'], row['modified']['value'])
+                for row in result.get('bindings', [])]
+
+
+class EventFeed(object):
+    """Reads Fedora 4 events as JSON lines from a stream, i.e. messages
+    from the fcrepo JMS topic forwarded by a STOMP consumer or Camel
+    route. Each line has the resource url in identifier or id, the event
+    types in eventType or type and a timestamp in milliseconds or as an
+    xsd:dateTime; the org.fcrepo.jms.* header names are also accepted."""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def __event__(self, line):
+        event = json.loads(line)
+        for key in list(event.keys()):
+            if key.startswith("org.fcrepo.jms."):
+                event.setdefault(key[len("org.fcrepo.jms."):], event[key])
+        url = event.get('identifier') or event.get('id')
+        if url and event.get('baseURL') and not url.startswith("http"):
+            url = event['baseURL'].rstrip("/") + url
+        types = event.get('eventType') or event.get('type') or ''
+        if isinstance(types, list):
+            types = ",".join(types)
+        return Change(url,
+                      format_time(parse_time(event.get('timestamp', 0))),
+                      'delet' in types.lower())
+
+    def changes(self, mark, size, after=None):
+        """Reads up to size events newer than a high-water mark, blocking
+        until at least one arrives or the stream ends"""
+        output = []
+        while len(output) < size:
+            line = self.stream.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            try:
+                change = self.__event__(line)
+            except (ValueError, TypeError) as error:
+                logger.warning("Skipping event %r: %s", line, error)
+                continue
+            if change.url is None or \
+               (mark and parse_time(change.modified) < parse_time(mark)):
+                continue
+            output.append(change)
+            if not self.__ready__():
+                break
+        return output
+
+    def __ready__(self):
+        """Returns True if another line can be read without blocking"""
+        try:
+            return len(select.select([self.stream], [], [], 0)[0]) > 0
+        except (OSError, ValueError, io.UnsupportedOperation):
+            # Not a pipe, socket or file, i.e. io.StringIO
+            return True
+
+
+class SyncState(object):
+    """High-water mark, the resources already indexed at the mark, and
+    the lag of the last batch, saved atomically to a JSON file so that
+    a restarted worker resumes"""
+
+    def __init__(self, path):
+        self.path = path
+        self.mark = None
+        self.seen = []
+        self.lag = 0.0
+        self.indexed = 0
+        self.updated = None
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path) as state:
+                saved = json.load(state)
+            self.mark = saved.get('mark')
+            self.seen = saved.get('seen', [])
+            self.indexed = saved.get('indexed', 0)
+        return self
+
+    def save(self):
+        self.updated = time.time()
+        temp_path = "{}.tmp".format(self.path)
+        with open(temp_path, "w") as state:
+            json.dump(self.report(), state)
+        os.replace(temp_path, self.path)
+
+    def report(self):
+        return {"mark": self.mark,
+                "seen": self.seen,
+                "lag": round(self.lag, 3),
+                "indexed": self.indexed,
+                "updated": self.updated}
+
+
+def resource_document(fedora_url, datastore=None):
+    """Returns the (uuid, doc_type, _source) of a Fedora resource from the
+    triplestore, or None if it no longer has any triples. Objects that are
+    repository resources are stored as their fedora:uuid.
+
+    Args:
+        fedora_url -- url of the Fedora 4 resource
+        datastore -- SPARQL datastore, defaults to sparql_backend
+    """
+    return resource_documents([fedora_url], datastore)[fedora_url]
+
+def resource_documents(fedora_urls, datastore=None):
+    """Returns the (uuid, doc_type, _source), or None, of many Fedora
+    resources by url with one SPARQL query for every SPARQL_VALUES_SIZE
+    resources
+
+    Args:
+        fedora_urls -- urls of the Fedora 4 resources
+        datastore -- SPARQL datastore, defaults to sparql_backend
+    """
+    datastore = datastore or sparql_backend
+    bindings = dict([(url, []) for url in fedora_urls])
+    fedora_urls = list(bindings.keys())
+    values_size = app.config.get('SPARQL_VALUES_SIZE', 100)
+    for start in range(0, len(fedora_urls), values_size):
+        urls = fedora_urls[start:start+values_size]
+        result = datastore.query(RESOURCES_SPARQL.format(
+            " ".join(["<{}>".format(url) for url in urls])))
+        if result is None:
+            raise IOError("Reading {} from the triplestore failed".format(
+                ", ".join(urls)))
+        for row in result.get('bindings', []):
+            bindings[row['resource']['value']].append(row)
+    return dict([(url, __resource_document__(url, rows))
+                 for url, rows in bindings.items()])
+
+def __resource_document__(fedora_url, bindings):
+    """Returns the (uuid, doc_type, _source) of a resource from the rows
+    of its triples or None"""
+    if len(bindings) < 1:
+        return None
+    source, classes = {"fedora:hasLocation": [fedora_url], "type": []}, []
+    for row in bindings:
+        predicate, value = row['predicate']['value'], row['object']['value']
+        if predicate == RDF_TYPE:
+            classes.append(value)
+            field = field_name(value)
+            if field is not None and not field in source["type"]:
+                source["type"].append(field)
+            continue
+        if predicate == FEDORA + "uuid":
+            source["fedora:uuid"] = [value]
+            continue
+        field = field_name(predicate)
+        if field is None:
+            continue
+        if 'uuid' in row:
+            value = row['uuid']['value']
+        if not value in source.setdefault(field, []):
+            source[field].append(value)
+    doc_type = search_doc_type(classes)
+    if doc_type is None or not "fedora:uuid" in source:
+        return None
+    return source["fedora:uuid"][0], doc_type, source
+
+def __indexed__(elastic_search, fedora_urls, index):
+    """Returns the (uuid, doc_type, _source) indexed for each of a list of
+    Fedora urls with one search"""
+    fedora_urls = list(set(fedora_urls))
+    output = dict()
+    if len(fedora_urls) < 1:
+        return output
+    result = elastic_search.search(
+        index=index,
+        body={"query": {"filtered": {"filter": {
+            "terms": {"fedora:hasLocation": fedora_urls}}}},
+              "size": len(fedora_urls)})
+    for hit in result.get('hits', {}).get('hits', []):
+        for url in hit['_source'].get('fedora:hasLocation', []):
+            if url in fedora_urls:
+                output.setdefault(url, (hit['_id'],
+                                        hit['_type'],
+                                        hit['_source']))
+    return output
+
+
+class SyncWorker(object):
+    """Applies batches of changes to the index and advances the
+    high-water mark
+
+    Args:
+        feed -- PollingFeed or EventFeed
+        state -- SyncState
+        elastic_search -- Elastic Search client, defaults to es_search
+        index -- Elastic Search index, defaults to bibframe
+        batch_size -- changes per batch
+        denormalize -- refresh the display fields of dependents
+    """
+
+    def __init__(self, feed, state, elastic_search=None, index=es_index,
+                 batch_size=100, denormalize=True, datastore=None):
+        self.feed = feed
+        self.state = state
+        self.elastic_search = elastic_search or es_search
+        self.index = index
+        self.batch_size = batch_size
+        self.denormalize = denormalize
+        self.datastore = datastore or sparql_backend
+
+    def run_once(self):
+        """Applies one batch of changes, returning the number applied"""
+        # The urls already seen at the mark are sorted, the last one is
+        # where polling resumes
+        after = self.state.seen[-1] if len(self.state.seen) > 0 else None
+        changes = [change for change in
+                   self.feed.changes(self.state.mark, self.batch_size, after)
+                   if not (change.modified == self.state.mark and
+                           change.url in self.state.seen)]
+        if len(changes) < 1:
+            self.state.lag = 0.0
+            self.state.save()
+            return 0
+        actions, stale = [], set()
+        # One search for the documents indexed for the page and one SPARQL
+        # query for the resources' triples
+        indexed = __indexed__(self.elastic_search,
+                              [change.url for change in changes],
+                              self.index)
+        documents = resource_documents(
+            [change.url for change in changes if not change.deleted],
+            self.datastore)
+        for change in changes:
+            previous = indexed.get(change.url)
+            document = None
+            if not change.deleted:
+                document = documents.get(change.url)
+            if previous is not None and \
+               (document is None or document[:2] != previous[:2]):
+                # Deleted, or its fedora:uuid or type changed
+                actions.append({"_op_type": "delete",
+                                "_index": self.index,
+                                "_type": previous[1],
+                                "_id": previous[0]})
+                stale.update(dependents(*previous,
+                                        elastic_search=self.elastic_search,
+                                        index=self.index))
+                stale.discard(previous[0])
+            if document is None:
+                continue
+            doc_id, doc_type, source = document
+            actions.append({"_index": self.index,
+                            "_type": doc_type,
+                            "_id": doc_id,
+                            "_source": source})
+            stale.update(dependents(doc_id, doc_type, source,
+                                    elastic_search=self.elastic_search,
+                                    index=self.index))
+        if len(actions) > 0:
+            # Refreshed so the display fields of dependents are computed
+            # from searches that see the changes
+            count, errors = bulk(self.elastic_search, actions,
+                                 raise_on_error=False, refresh=True)
+            for error in errors:
+                # Deleting a document that is already gone is not an error
+                if error.get('delete', {}).get('status') != 404:
+                    raise IOError("Indexing changes failed {}".format(error))
+        if self.denormalize and len(stale) > 0:
+            refresh(sorted(stale), self.elastic_search, self.index)
+        now = time.time()
+        newest = max(changes,
+                     key=lambda change: parse_time(change.modified)).modified
+        self.state.lag = max(now - parse_time(change.modified)
+                             for change in changes)
+        self.state.seen = sorted(set(
+            [change.url for change in changes if change.modified == newest] +
+            (self.state.seen if newest == self.state.mark else [])))
+        self.state.mark = newest
+        self.state.indexed += len(changes)
+        self.state.save()
+        logger.info("Applied %s changes up to %s, lag %.1fs",
+                    len(changes), newest, self.state.lag)
+        return len(changes)
+
+    def run(self, interval=10, once=False):
+        """Applies batches until the feed is empty, then polls again every
+        interval seconds unless once is True"""
+        while True:
+            applied = self.run_once()
+            if applied >= self.batch_size:
+                continue
+            if once or (isinstance(self.feed, EventFeed) and applied < 1):
+                return
+            time.sleep(interval)
+
+def sync_state_path():
+    return app.config.get('SYNC_STATE_FILE',
+                          os.path.join(app.instance_path, 'sync.json'))
+
+def sync_report():
+    """Returns the saved state of the sync worker with the seconds since
+    it last ran, or None if it has not run"""
+    path = sync_state_path()
+    if not os.path.exists(path):
+        return None
+    with open(path) as state:
+        report = json.load(state)
+    report.pop('seen', None)
+    if report.get('updated'):
+        report['since_update'] = round(time.time() - report['updated'], 3)
+    return report
+
+def main(args):
+    logging.basicConfig(level=logging.INFO)
+    if args.events:
+        stream = sys.stdin if args.events == '-' else open(args.events)
+        feed = EventFeed(stream)
+    else:
+        feed = PollingFeed()
+    state = SyncState(args.state or sync_state_path()).load()
+    worker = SyncWorker(feed, state,
+                        batch_size=args.batch_size,
+                        denormalize=not args.no_denormalize)
+    with app.app_context():
+        worker.run(args.interval, args.once)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Reindexes the Fedora resources that changed")
+    parser.add_argument('--events',
+                        help='File of JSON line events, - for stdin; '
+                             'polls the triplestore if not given')
+    parser.add_argument('--state', help='High-water mark file, defaults to '
+                                        'SYNC_STATE_FILE')
+    parser.add_argument('--interval', type=float,
+                        default=app.config.get('SYNC_INTERVAL', 10),
+                        help='Seconds between polls')
+    parser.add_argument('--batch-size', type=int,
+                        default=app.config.get('SYNC_BATCH_SIZE', 100))
+    parser.add_argument('--once', action='store_true',
+                        help='Stop when there are no more changes')
+    parser.add_argument('--no-denormalize', action='store_true',
+                        help='Do not refresh the display fields of '
+                             'dependents')
+    main(parser.parse_args())
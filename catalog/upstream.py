@@ -0,0 +1,227 @@
+"""
+Name:        upstream
+Purpose:     Pooled, keep-alive HTTP clients for the services the catalog
+             talks to besides Elastic Search, the triplestore of the
+             semantic server and Kibana.
+
+Author:      Jeremy Nelson
+
+Created:     2015/07/27
+Copyright:   (c) Jeremy Nelson 2015
+Licence:     GPLv3
+"""
+__author__ = "Jeremy Nelson"
+__license__ = "GPLv3"
+
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from . import app, datastore_url
+
+logger = logging.getLogger(__name__)
+
+class UpstreamUnavailable(requests.exceptions.ConnectionError):
+    """Raised without contacting an upstream whose circuit is open"""
+    pass
+
+
+class CircuitBreaker(object):
+    """Opens after max_failures consecutive failures so that requests to a
+    slow or down upstream fail immediately, and lets a single trial
+    request through once reset_timeout seconds have passed"""
+
+    def __init__(self, max_failures=5, reset_timeout=30, clock=time.time):
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Returns True if a request may be sent to the upstream"""
+        with self.lock:
+            if self.opened is None:
+                return True
+            if self.clock() - self.opened >= self.reset_timeout:
+                # Half-open, the next failure re-opens the circuit
+                self.opened = self.clock()
+                self.trial = True
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.max_failures:
+                self.opened = self.clock()
+            self.trial = False
+
+    @property
+    def state(self):
+        if self.opened is None:
+            return "closed"
+        if self.trial:
+            return "half-open"
+        return "open"
+
+
+class UpstreamClient(object):
+    """HTTP client for one upstream host with a connection pool,
+    connect and read timeouts, retries with backoff and a circuit
+    breaker"""
+
+    def __init__(self,
+                 base_url,
+                 pool_size=10,
+                 connect_timeout=3.05,
+                 read_timeout=30,
+                 retries=2,
+                 backoff=0.2,
+                 max_failures=5,
+                 reset_timeout=30):
+        if not base_url.startswith("http"):
+            base_url = "http://" + base_url
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.breaker = CircuitBreaker(max_failures, reset_timeout)
+        self.session = requests.Session()
+        # POSTs are not retried, a 502 or 504 from a proxy does not mean a
+        # SPARQL update sent to /triplestore was not applied
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=backoff,
+                status_forcelist=[502, 503, 504],
+                allowed_methods=frozenset(['GET', 'HEAD']),
+                raise_on_status=False))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method, path, **kwargs):
+        """Sends a request to a path on the upstream, raising
+        UpstreamUnavailable if the circuit is open
+
+        Args:
+            method -- HTTP method
+            path -- path relative to the base url
+        """
+        if not self.breaker.allow():
+            raise UpstreamUnavailable(
+                "{} is unavailable".format(self.base_url))
+        kwargs.setdefault('timeout', self.timeout)
+        url = "{}/{}".format(self.base_url, path.lstrip("/"))
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException as error:
+            self.breaker.failure()
+            logger.warning("Request to %s failed: %s", url, error)
+            raise
+        if response.status_code >= 500:
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+        return response
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+
+class StaticCache(object):
+    """Disk cache for immutable upstream assets, i.e. Kibana's static
+    bundles, so that they are only fetched through the proxy once"""
+
+    def __init__(self, directory, pattern, chunk_size=65536):
+        self.directory = directory
+        self.pattern = re.compile(pattern)
+        self.chunk_size = chunk_size
+
+    def cacheable(self, path):
+        """Returns True if the path is an immutable asset"""
+        return self.pattern.search(path) is not None
+
+    def __paths__(self, path):
+        key = hashlib.sha1(path.encode()).hexdigest()
+        return (os.path.join(self.directory, key),
+                os.path.join(self.directory, "{}.json".format(key)))
+
+    def get(self, path):
+        """Returns the (file path, headers) of a cached asset or None
+
+        Args:
+            path -- upstream path with query string
+        """
+        body_path, meta_path = self.__paths__(path)
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as meta:
+            return body_path, json.load(meta)
+
+    def put(self, path, response):
+        """Streams an upstream response into the cache, returning the 
+        same (file path, headers) as get
+
+        Args:
+            path -- upstream path with query string
+            response -- streaming requests response
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        body_path, meta_path = self.__paths__(path)
+        # Each writer has its own temporary file, threads of a process
+        # may cache the same asset at once
+        with tempfile.NamedTemporaryFile(dir=self.directory,
+                                         suffix=".tmp",
+                                         delete=False) as body:
+            for chunk in response.iter_content(self.chunk_size):
+                body.write(chunk)
+        os.replace(body.name, body_path)
+        headers = {"Content-Type": response.headers.get(
+            'Content-Type', 'application/octet-stream')}
+        with tempfile.NamedTemporaryFile("w",
+                                         dir=self.directory,
+                                         suffix=".tmp",
+                                         delete=False) as meta:
+            json.dump(headers, meta)
+        os.replace(meta.name, meta_path)
+        return body_path, headers
+
+
+def __upstream_client__(base_url):
+    """Creates an UpstreamClient configured from the UPSTREAM_* settings"""
+    return UpstreamClient(
+        base_url,
+        pool_size=app.config.get('UPSTREAM_POOL_SIZE', 10),
+        connect_timeout=app.config.get('UPSTREAM_CONNECT_TIMEOUT', 3.05),
+        read_timeout=app.config.get('UPSTREAM_READ_TIMEOUT', 30),
+        retries=app.config.get('UPSTREAM_RETRIES', 2),
+        backoff=app.config.get('UPSTREAM_BACKOFF', 0.2),
+        max_failures=app.config.get('UPSTREAM_MAX_FAILURES', 5),
+        reset_timeout=app.config.get('UPSTREAM_RESET_TIMEOUT', 30))
+
+triplestore = __upstream_client__(datastore_url)
+kibana = __upstream_client__(app.config.get('KIBANA_URL', 'localhost:5601'))
+kibana_cache = StaticCache(
+    app.config.get('KIBANA_CACHE_DIR', 
+                   os.path.join(app.instance_path, 'kibana-cache')),
+    app.config.get('KIBANA_CACHE_PATHS', r'^(bundles|styles|images|fonts)/'))
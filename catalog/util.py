@@ -1,8 +1,12 @@
 __author__ = "Jeremy Nelson, Mike Stabile"
 
+import base64
+import binascii
+import json
 import re
 from werkzeug.routing import BaseConverter
-from . import es_search
+from . import es_index, es_search
+from .cache import entity_map, get_labels
 from flask import url_for
 from elasticsearch.exceptions import NotFoundError
 
@@ -11,7 +15,23 @@ class RegexConverter(BaseConverter):
         super(RegexConverter, self).__init__(url_map)
         self.regex = items[0]
 
-uuidPattern = re.compile('[a-fA-F0-9]{8}-[a-fA-F0-9]{4}-4[a-fA-F0-9]{3}-[89aAbB][a-fA-F0-9]{3}-[a-fA-F0-9]{12}')
+# Versions 1 to 5, catalog.ingest and catalog.marc assign uuid5 ids
+uuidPattern = re.compile('[a-fA-F0-9]{8}-[a-fA-F0-9]{4}-[1-5][a-fA-F0-9]{3}-[89aAbB][a-fA-F0-9]{3}-[a-fA-F0-9]{12}')
+
+# JSON-LD context for the prefixed fields of the bibframe index
+JSONLD_CONTEXT = {
+    "bf": "http://bibframe.org/vocab/",
+    "fedora": "http://fedora.info/definitions/v4/repository#",
+    "mads": "http://www.loc.gov/mads/rdf/v1#",
+    "schema": "http://schema.org/",
+    "type": "@type"}
+
+# Completion suggesters and the typeahead group each one is returned under
+SUGGEST_GROUPS = [('work', 'work'),
+                  ('instance', 'instance'),
+                  ('person', 'agent'),
+                  ('organization', 'agent'),
+                  ('topic', 'topic')]
 
 
 def lookupRelatedDetails(v):
@@ -19,21 +39,27 @@ def lookupRelatedDetails(v):
     returnList = []
     #print('Entered lookup: ', v)
     if isinstance(v, list):
-        for pUuid in v:
-            #print ("pUuid: ",pUuid)   
-            mUuid = uuidPattern.match(pUuid)
-            if mUuid:
-                #if v matches a uuid pattern then search for the item in elasticsearch
-                if es_search.exists(id=pUuid, index='bibframe'):
-                    uuidResult = es_search.get_source(id=pUuid, index='bibframe')
-                    #uuidResult = {'id':pUuid,'result':uuidResult}
-                    returnList.append(uuidResult)
+        #if v matches a uuid pattern then search for the item in elasticsearch
+        uuids = [pUuid for pUuid in v 
+                 if isinstance(pUuid, str) and uuidPattern.match(pUuid)]
+        uuidResults = entity_map().get_many(uuids)
+        for pUuid in uuids:
+            if pUuid in uuidResults:
+                returnList.append(uuidResults[pUuid])
     if len(returnList) > 0:
         return returnList
     else:
         return 0
     
-def findRelatedItems(filterFld,v):
+def primeRelatedDetails(source):
+    #Queue every uuid referenced by the fields of source so that the
+    #lookups share a single mget
+    for v in source.values():
+        if isinstance(v, list):
+            entity_map().prime([pUuid for pUuid in v 
+                if isinstance(pUuid, str) and uuidPattern.match(pUuid)])
+
+def findRelatedItems(filterFld,v,size=10):
     es_dsl = {'rel_instances':{}, 'rel_works':{}, 'rel_agents':{}, 'rel_topics':{}}
     #print(filterFld)
     if "instances" in filterFld:
@@ -82,16 +108,20 @@ def findRelatedItems(filterFld,v):
                  }
     result = {}
     #print("es_dsl***",es_dsl)
+    sections, msearch_body = [], []
     for k, dsl in es_dsl.items():
         #print ("k:",k," dsl:",dsl)
         if k.replace("rel_","") in filterFld:
-            #print("*** Entered search ***")
-            searchResult = es_search.search(
-                body=dsl, 
-                index='bibframe', 
-                )
-            #print("searchResult*** ", searchResult)
-            result = {k:searchResult['hits']['hits']}
+            dsl['size'] = size
+            sections.append(k)
+            msearch_body.extend([{'index': es_index}, dsl])
+    if len(msearch_body) < 1:
+        return result
+    responses = es_search.msearch(body=msearch_body).get('responses', [])
+    for k, searchResult in zip(sections, responses):
+        hits = searchResult.get('hits', {})
+        result[k] = hits.get('hits', [])
+        result["{}_total".format(k)] = hits.get('total', 0)
     #print("rel items *** ",result)
     return result
 
@@ -118,7 +148,7 @@ def __agent_search__(phrase):
 
             }
      }
-    result = es_search.suggest(body=es_dsl, index='bibframe')
+    result = es_search.suggest(body=es_dsl, index=es_index)
     for suggest_type in [ "person-suggest", 'organization-suggest']:
         for hit in result.get(suggest_type)[0]['options']:
             row = {'agent': hit['text'], 
@@ -127,6 +157,31 @@ def __agent_search__(phrase):
     return json.dumps(output)
 
 
+def __all_types_search__(phrase):
+    """Suggest completion across all of the typeahead types in a single 
+    request, returning the results grouped by type
+
+    Args:
+        phrase -- text phrase
+    """
+    output = dict()
+    es_dsl = dict()
+    for key, group in SUGGEST_GROUPS:
+        es_dsl["{}-suggest".format(key)] = {
+            "text": phrase,
+            "completion": {
+                "field": "{}_suggest".format(key)
+            }
+        }
+        output[group] = []
+    result = es_search.suggest(body=es_dsl, index=es_index)
+    for key, group in SUGGEST_GROUPS:
+        for hit in result.get("{}-suggest".format(key))[0]['options']:
+            row = {group: hit['text'],
+                   'uuid': hit['payload']['id']}
+            output[group].append(row)
+    return json.dumps(output)
+
 def __expand_instance__(instance):
     """Helper function takes a search result Instance, queries index for 
     creator and holdings information 
@@ -134,51 +189,150 @@ def __expand_instance__(instance):
     Args:
         instance -- Elastic search hit result
     """
-    output = dict()
-    work_id = instance.get('bf:instanceOf')
-    if not work_id:
-        return {}
-    try:
-        work = es_search.get(
-            id=work_id[0],  
-            index='bibframe', 
-            fields=['bf:creator', 
-                    'bf:subject'])
-    except NotFoundError:
+    return __expand_instances__([instance])[0]
+
+def __expand_instances__(instances):
+    """Helper function takes a page of search result Instances and
+    enriches all of them at once, fetching Works and creators with
+    mget and cover art and held items with a single msearch.
+
+    Args:
+        instances -- list of Elastic search hit _source
+    """
+    outputs = [dict() for instance in instances]
+    work_ids = dict()
+    for i, instance in enumerate(instances):
+        work_id = instance.get('bf:instanceOf')
+        if work_id:
+            work_ids[i] = work_id[0]
+    if len(work_ids) < 1:
+        return outputs
+    works = entity_map().get_many(set(work_ids.values()))
+    creator_ids = set()
+    for work in works.values():
+        creator_ids.update(work.get('bf:creator', []))
+    creator_labels = get_labels(creator_ids)
+    expanded, msearch_body = [], []
+    for i, work_id in sorted(work_ids.items()):
         #! Should preform secondary ES search on work_id
-        return {}
-    
-    if not work.get('found'):
-        return {}
-    creators = str()
-    for creator_id in work.get('fields', {}).get('bf:creator', []):
-        creator = es_search.get(
-            id=creator_id, 
-            index='bibframe', 
-            fields=['bf:label'])
-        if creator.get('found'):
-            creators += ' '.join(creator.get('fields', 
-                                 {}).get('bf:label'))
-    if len(creators) > 0:
-        output['creators'] = creators
-    cover_art = __get_cover_art__(instance.get('fedora:uuid')[0])
-    if cover_art:
-        output['cover'] = cover_art
-    items = __get_held_items__(instance.get('fedora:uuid')[0])
-    output['held_items'] = []
-    if len(items) > 0:
-        for row in items:
-            item = dict()
-            for field, value in row.items():
-                item[field.split(":")[1]] = value
-            if not 'circulationStatus' in item:
-                item['circulationStatus'] = 'Available'
-            for key in ['shelfMarkLcc', 'heldBy', 'subLocation']:
-                if not key in item:
-                    item[key] = None 
-            output['held_items'].append(item)
+        if not work_id in works:
+            continue
+        creators = str()
+        for creator_id in works[work_id].get('bf:creator', []):
+            if creator_id in creator_labels:
+                creators += ' '.join(creator_labels[creator_id])
+        if len(creators) > 0:
+            outputs[i]['creators'] = creators
+        outputs[i]['held_items'] = []
+        instance_uuid = instances[i].get('fedora:uuid', [None])[0]
+        if instance_uuid is None:
+            continue
+        expanded.append(i)
+        msearch_body.extend([
+            {'index': es_index},
+            __cover_art_dsl__(instance_uuid),
+            {'index': es_index, 'type': 'HeldItem'},
+            __held_items_dsl__(instance_uuid)])
+    if len(msearch_body) < 1:
+        return outputs
+    responses = es_search.msearch(body=msearch_body).get('responses', [])
+    for j, i in enumerate(expanded):
+        cover_art = __cover_art_result__(responses[2*j])
+        if cover_art:
+            outputs[i]['cover'] = cover_art
+        items = __held_items_result__(responses[2*j+1])
+        outputs[i]['held_items'] = __format_held_items__(items)
+    return outputs
+
+def __display_result__(source):
+    """Returns the search result fields of a Work or Instance from the
+    display fields written at index time by catalog.denormalize, or None
+    if the document has not been denormalized
+
+    Args:
+        source -- Elastic search hit _source
+    """
+    if not 'display_title' in source:
+        return None
+    output = {"title": source['display_title'],
+              "creators": " ".join(source.get('display_creators') or [])}
+    if source.get('cover_id'):
+        output['cover'] = {"src": url_for('cover',
+                                          uuid=source['cover_id'],
+                                          ext='jpg')}
+    summary = source.get('holdings_summary')
+    if summary is not None:
+        output['held_items'] = summary.get('items', [])
+    return output
+
+def __format_held_items__(items):
+    """Helper function flattens held item fields for display in the
+    search results
+
+    Args:
+        items -- list of HeldItem fields
+    """
+    output = []
+    for row in items:
+        item = dict()
+        for field, value in row.items():
+            item[field.split(":")[1]] = value
+        if not 'circulationStatus' in item:
+            item['circulationStatus'] = 'Available'
+        for key in ['shelfMarkLcc', 'heldBy', 'subLocation']:
+            if not key in item:
+                item[key] = None 
+        output.append(item)
     return output
 
+def __decode_cursor__(cursor):
+    """Decodes a search cursor into the search_after sort values, raising
+    ValueError for an invalid cursor"""
+    try:
+        values = json.loads(
+            base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (TypeError, UnicodeDecodeError, binascii.Error):
+        raise ValueError("Invalid cursor {}".format(cursor))
+    if not isinstance(values, list):
+        raise ValueError("Invalid cursor {}".format(cursor))
+    return values
+
+def __encode_cursor__(sort_values):
+    """Encodes the sort values of the last hit of a page into an opaque
+    search cursor"""
+    return base64.urlsafe_b64encode(
+        json.dumps(sort_values).encode()).decode()
+
+def __export_ndjson__(hits):
+    """Generator serializes search hits as newline delimited JSON
+
+    Args:
+        hits -- iterable of Elastic search hits
+    """
+    for hit in hits:
+        row = {"_id": hit['_id'], 
+               "_type": hit['_type'],
+               "_source": hit.get('_source', {})}
+        yield json.dumps(row) + "\n"
+
+def __export_jsonld__(hits):
+    """Generator serializes search hits as a JSON-LD graph
+
+    Args:
+        hits -- iterable of Elastic search hits
+    """
+    yield '{{"@context": {}, "@graph": ['.format(json.dumps(JSONLD_CONTEXT))
+    for i, hit in enumerate(hits):
+        source = dict(hit.get('_source', {}))
+        location = source.get('fedora:hasLocation')
+        if location:
+            node = {"@id": location[0]}
+        else:
+            node = {"@id": "urn:uuid:{}".format(hit['_id'])}
+        node.update(source)
+        yield "{}\n{}".format("," if i > 0 else "", json.dumps(node))
+    yield "]}\n"
+
 def __generate_sort__(sort, doc_type):
     """Generates sort DSL based on type of sort and the doc_type"""
     output = {}
@@ -190,44 +344,177 @@ def __generate_sort__(sort, doc_type):
     output["bf:label"] = {"order": order}
     return output
 
-def __get_cover_art__(instance_uuid):
-    """Helper function takes an instance_uuid and searches for 
-    any cover art, returning the CoverArt ID and schema:isBasedOnUrl.
-    This may change in the future versions.
-
-    Args:
-        instance_uuid -- RDF fedora:uuid 
-    """
+def __class_counts__():
+    """Helper function counts the documents in the index by Elastic Search
+    type, by BIBFRAME class and by authority class with one search, 
+    returning each aggregation in the shape the summary page expects"""
+    authorities = ['bf:Person', 'bf:Organization', 'bf:Topic', 'bf:Place']
     es_dsl = {
+        "query": {"match_all": {}},
+        "size": 0,
+        "aggs": {
+            "bfMajorSum": {
+                "terms": {
+                    "field": "_type",
+                    "size": 20,
+                    "order": {
+                        "_count": "desc"
+                    }
+                }
+            },
+            "bfTypeSum": {
+                "terms": {
+                    "field": "type",
+                    "size": 100,
+                    "order": {
+                        "_count": "desc"
+                    }
+                }
+            },
+            "bfAuthSum": {
+                "filters": {
+                    "filters": dict([
+                        ('type:"{}"'.format(authority), {
+                            "query": {
+                                "query_string": {
+                                    "query": 'type:"{}"'.format(authority),
+                                    "analyze_wildcard": True
+                                }
+                            }
+                        })
+                        for authority in authorities])
+                }
+            }
+        }
+    }
+    result = es_search.search(
+        body=es_dsl, 
+        index=es_index, 
+        size=0)
+    output = dict()
+    for name, aggregation in result.get('aggregations', {}).items():
+        output[name] = {"hits": result.get('hits'),
+                        "aggregations": {"2": aggregation}}
+    return output
+
+def __instance_filter__(field, instance_uuid):
+    """Returns a term filter on an instance_uuid, or a terms filter if
+    given a list of instance uuids"""
+    if isinstance(instance_uuid, list):
+        return {"terms": {field: instance_uuid}}
+    return {"term": {field: instance_uuid}}
+
+def __cover_art_dsl__(instance_uuid):
+    """Returns the search DSL for CoverArt of an instance_uuid or a list
+    of instance uuids"""
+    return {
       "fields": ['schema:isBasedOnUrl'],
       "query": {
         "filtered": {
           "filter": [
-            {"term": { 
-              "bf:coverArtFor": instance_uuid}
-            }
+            __instance_filter__("bf:coverArtFor", instance_uuid)
           ]
         }
       }
      }
-    result = es_search.search(
-        body=es_dsl,
-        index='bibframe')
-    if result.get('hits').get('total') > 0:
+
+def __cover_art_result__(result):
+    """Returns the CoverArt src and url from a cover art search result"""
+    if result.get('hits', {}).get('total', 0) > 0:
         top_hit = result['hits']['hits'][0]
         return {"src": url_for('cover', uuid=top_hit['_id'], ext='jpg'),
                 "url": top_hit['fields']['schema:isBasedOnUrl']}
 
-def __get_held_items__(instance_uuid):
-    """Helper function takes an instance uuid and search for any heldItems
-    that match the instance, returning the circulation status and 
-    name of the organization that holds the item
+def __search_dsl__(phrase, filter_='all', sort='relevance', cursor=False):
+    """Generates the search DSL for a phrase, filter and sort. In cursor
+    mode the sort always ends with _uid as a tiebreaker so that the sort
+    values of a hit can be used with search_after, and the type filters
+    are bool queries because search_after needs Elastic Search 5, which
+    removed the filtered and or queries.
 
     Args:
-      instance_uuid -- RDF fedora:uuid
+        phrase -- text phrase
+        filter_ -- all, works, instances, agents or topics
+        sort -- relevance, a-z or z-a
+        cursor -- generate the sort for search_after, defaults to False
     """
-    items = list()
+    doc_type = None
     es_dsl = {
+        "query": {},
+        "sort": {}
+    }
+    if filter_.startswith("all"):
+        es_dsl['query']['match'] =  {"_all": phrase}
+    else:
+        if filter_.endswith("s"):
+            filter_ = filter_[:-1]
+        doc_type = filter_
+        if cursor:
+            types = ["Person", "Organization"] \
+                if doc_type.startswith("agent") else [doc_type.title()]
+            es_dsl["query"]["bool"] = {
+                "must": {"match": {"_all": phrase}},
+                "filter": {
+                    "bool": {
+                        "should": [{"type": {"value": type_}}
+                                   for type_ in types]
+                    }
+                }
+            }
+        else:
+            es_dsl["query"]["filtered"] =  {
+                "query": {
+                    "match": {"_all": phrase}
+                }
+            }
+            if doc_type.startswith("agent"):
+                es_dsl["query"]["filtered"]["filter"] = {
+                    "or": [
+                        {
+                            "type": {
+                                "value": "Person"
+                            }
+                         },
+                         {
+                             "type": {
+                                 "value": "Organization"
+                             }
+                         }
+                    ]
+                }
+            else:
+                es_dsl["query"]["filtered"]["filter"] = {
+                    "type": {
+                        "value": doc_type.title()
+                    }
+               }
+    if not sort.startswith("relevance"):
+      es_dsl['sort'] = __generate_sort__(sort, doc_type)
+    if cursor:
+        if sort.startswith("relevance"):
+            es_dsl['sort'] = [{"_score": {"order": "desc"}}]
+        else:
+            es_dsl['sort'] = [es_dsl['sort']]
+        es_dsl['sort'].append({"_uid": {"order": "asc"}})
+    return es_dsl
+
+def __get_cover_art__(instance_uuid):
+    """Helper function takes an instance_uuid and searches for 
+    any cover art, returning the CoverArt ID and schema:isBasedOnUrl.
+    This may change in the future versions.
+
+    Args:
+        instance_uuid -- RDF fedora:uuid 
+    """
+    result = es_search.search(
+        body=__cover_art_dsl__(instance_uuid),
+        index=es_index)
+    return __cover_art_result__(result)
+
+def __held_items_dsl__(instance_uuid):
+    """Returns the search DSL for the HeldItems of an instance_uuid or a
+    list of instance uuids"""
+    return {
       "fields": ['bf:circulationStatus', 
                  'bf:heldBy', 
                  'bf:itemId',
@@ -237,24 +524,80 @@ def __get_held_items__(instance_uuid):
       "query": {
         "filtered": {
           "filter": [
-            {"term": { 
-              "bf:holdingFor": instance_uuid}
-            }
+            __instance_filter__("bf:holdingFor", instance_uuid)
           ]
         }
       }
 
     }
-    result = es_search.search(
-        body=es_dsl,
-        index='bibframe',
-        doc_type='HeldItem')
-    for hit in result.get('hits', []).get('hits', []):
+
+def __held_items_result__(result):
+    """Returns the list of HeldItem fields from a held items search 
+    result"""
+    items = list()
+    for hit in result.get('hits', {}).get('hits', []):
         if not 'fields' in hit:
             continue
         items.append(hit['fields'])
-        #fields = hit['fields']
-        #items.append({"location": get_label(fields[0]),
-        #              "itemId": fields
-        #              "circulationStatus": fields.get('bf:circulationStatus')})    
-    return items 
+    return items
+
+def __get_entity__(uuid, doc_type=None, fields=None, source=True):
+    """Helper function retrieves a document with a single get, returning
+    None instead of raising NotFoundError when it does not exist
+
+    Args:
+        uuid -- document id
+        doc_type -- optional Elastic Search type
+        fields -- optional list of stored fields
+        source -- False or list of _source fields to limit the _source
+    """
+    params = dict()
+    if doc_type is not None:
+        params['doc_type'] = doc_type
+    if fields is not None:
+        params['fields'] = fields
+    if source is not True:
+        params['_source'] = source
+    try:
+        result = es_search.get(id=uuid, index=es_index, **params)
+    except NotFoundError:
+        return None
+    if not result.get('found'):
+        return None
+    return result
+
+def __get_entities__(uuids, fields=None):
+    """Helper function retrieves many documents with a single mget, 
+    returning a dict of _source by id and a list of the missing ids
+
+    Args:
+        uuids -- list of document ids
+        fields -- optional list of _source fields to return
+    """
+    entities, missing = dict(), []
+    if len(uuids) < 1:
+        return entities, missing
+    params = dict()
+    if fields is not None:
+        params['_source_include'] = fields
+    result = es_search.mget(body={'ids': uuids}, index=es_index, **params)
+    for doc in result.get('docs', []):
+        if doc.get('found'):
+            entities[doc['_id']] = doc.get('_source', {})
+        else:
+            missing.append(doc['_id'])
+    return entities, missing
+
+def __get_held_items__(instance_uuid):
+    """Helper function takes an instance uuid and search for any heldItems
+    that match the instance, returning the circulation status and 
+    name of the organization that holds the item
+
+    Args:
+      instance_uuid -- RDF fedora:uuid
+    """
+    result = es_search.search(
+        body=__held_items_dsl__(instance_uuid),
+        index=es_index,
+        doc_type='HeldItem')
+    return __held_items_result__(result)
@@ -2,6 +2,7 @@ __author__ = "Original:Jeremy Nelson, Contributor:Mike Stabile"
 
 import base64
 import io
+import itertools
 import json
 import mimetypes
 import requests
@@ -9,16 +10,30 @@ import logging
 import re
 
 
-from elasticsearch.exceptions import NotFoundError
+from elasticsearch.exceptions import ElasticsearchException, NotFoundError
+from elasticsearch.helpers import scan
 from flask import abort, jsonify, render_template, redirect
 from flask import request, session, send_file, url_for
 from flask import stream_with_context, Response
 
 
 from .forms import BasicSearch
-from . import app, datastore_url, es_search, __version__
+from . import app, datastore_url, es_index, es_search, upstream, __version__
+from .cache import entity_map, label_cache, purge_sparql_cache
+from .cache import sparql_cache, RefreshingValue
+from .metrics import exposition
+from .slowlog import slow_queries
+from .profiling import list_profiles, profile_path, profile_text
+from .profiling import PROFILE_SORTS
+from .sync import sync_report
 from .filters import *
-from .util import __expand_instance__, __get_cover_art__, __get_held_items__
+from .util import __agent_search__, __all_types_search__
+from .util import __decode_cursor__, __display_result__, __encode_cursor__
+from .util import __expand_instance__, __expand_instances__
+from .util import __export_jsonld__, __export_ndjson__
+from .util import __get_entity__, __get_entities__, __search_dsl__
+from .util import __class_counts__, __get_cover_art__, __get_held_items__
+from .suggest import prefix_index, prefix_search
 
 try:
     from simplepam import authenticate
@@ -37,21 +52,172 @@ WHERE {{{{
 }}}}""".format(PREFIX)
 
 
+class_counts = RefreshingValue(
+    __class_counts__,
+    app.config.get('CLASS_COUNT_REFRESH', 300))
+
 # Reporting Module Routes
 
+# Headers passed through between the browser and Kibana
+KIBANA_REQUEST_HEADERS = ['Accept', 
+                          'Accept-Encoding',
+                          'If-Modified-Since',
+                          'If-None-Match',
+                          'If-Range',
+                          'Range']
+KIBANA_RESPONSE_HEADERS = ['Accept-Ranges',
+                           'Cache-Control',
+                           'Content-Encoding',
+                           'Content-Length',
+                           'Content-Range',
+                           'Content-Type',
+                           'ETag',
+                           'Expires',
+                           'Last-Modified']
+
+def __kibana_get__(url, headers):
+    """Sends a streaming GET to Kibana, aborting with a 503 while its
+    circuit is open or a 502 if the request fails"""
+    try:
+        return upstream.kibana.get(url, stream=True, headers=headers)
+    except upstream.UpstreamUnavailable:
+        abort(503)
+    except requests.exceptions.RequestException:
+        abort(502)
+
 @app.route('/reports/<regex("(.*)"):url>')
 def kibana(url=None):
     if not 'username' in session:
         raise abort(403)
-    kibana_url = app.config.get('KIBANA_URL')
-    if not kibana_url.startswith("http"):
-        kibana_url = 'http://' + kibana_url
-    url = "{}/{}".format(kibana_url, url)
-    req = requests.get(url, stream=True)
+    if request.query_string:
+        url = "{}?{}".format(url, request.query_string.decode())
+    accel_redirect = app.config.get('KIBANA_ACCEL_REDIRECT')
+    if accel_redirect:
+        # nginx proxies the internal location to Kibana
+        response = Response()
+        response.headers['X-Accel-Redirect'] = "{}/{}".format(
+            accel_redirect.rstrip("/"), url)
+        return response
+    req = None
+    if app.config.get('KIBANA_CACHE', True) and \
+       upstream.kibana_cache.cacheable(url):
+        cached = upstream.kibana_cache.get(url)
+        if cached is None:
+            req = __kibana_get__(url, {'Accept-Encoding': 'identity'})
+            if req.status_code == 200:
+                cached = upstream.kibana_cache.put(url, req)
+        if cached is not None:
+            body_path, headers = cached
+            return send_file(body_path,
+                             mimetype=headers['Content-Type'],
+                             conditional=True,
+                             cache_timeout=app.config.get(
+                                 'KIBANA_CACHE_TIMEOUT', 86400))
+    if req is None:
+        headers = dict([(name, request.headers[name]) 
+                        for name in KIBANA_REQUEST_HEADERS 
+                        if name in request.headers])
+        req = __kibana_get__(url, headers)
     return Response(
         stream_with_context(
-            req.iter_content()), content_type = req.headers['content-type'])
+            req.raw.stream(65536, decode_content=False)),
+        status=req.status_code,
+        headers=[(name, req.headers[name]) 
+                 for name in KIBANA_RESPONSE_HEADERS
+                 if name in req.headers])
+
+@app.route('/reports/cache', methods=['GET', 'POST'])
+def cache_stats():
+    """Returns the label and SPARQL cache statistics. A POST invalidates
+    the label of the uuid in the form, or clears the label cache if no 
+    uuid is given; with cache=sparql it purges the SPARQL results that
+    mention the fedora_url in the form, or all of them."""
+    if not 'username' in session:
+        raise abort(403)
+    if request.method == 'POST':
+        if request.form.get('cache', 'labels') == 'sparql':
+            purge_sparql_cache(request.form.get('fedora_url'))
+        else:
+            uuid = request.form.get('uuid')
+            if uuid is None:
+                label_cache.clear()
+            else:
+                label_cache.invalidate(
+                    uuid, 
+                    request.form.get('version', type=int))
+    return jsonify({"labels": label_cache.stats(),
+                    "sparql": sparql_cache.stats()})
+
+@app.route('/reports/slow-queries', methods=['GET', 'POST'])
+def slow_query_report():
+    """Returns the slowest Elastic Search and SPARQL query shapes and the
+    most recent slow queries. The sort parameter orders the shapes by 
+    total, mean, max or count; a POST clears the log."""
+    if not 'username' in session:
+        raise abort(403)
+    if request.method == 'POST':
+        slow_queries.clear()
+    return jsonify({
+        "threshold": slow_queries.threshold,
+        "top": slow_queries.top(
+            request.values.get('size', 20, type=int),
+            request.values.get('sort', 'total')),
+        "recent": list(reversed(slow_queries.recent))})
 
+@app.route('/reports/profiles')
+def profile_report():
+    """Lists the saved request profiles, newest first, with the functions
+    taking the most cumulative time"""
+    if not 'username' in session:
+        raise abort(403)
+    return jsonify({"profiles": list_profiles()})
+
+@app.route('/reports/profiles/<name>')
+def profile_detail(name):
+    """Returns a saved profile as pstats text, sorted by the sort 
+    parameter, or the .prof file for snakeviz or pstats with format=prof"""
+    if not 'username' in session:
+        raise abort(403)
+    if request.args.get('format') == 'prof':
+        path = profile_path(name)
+        if path is None:
+            abort(404)
+        return send_file(path, 
+                         mimetype='application/octet-stream',
+                         as_attachment=True)
+    sort = request.args.get('sort', 'cumulative')
+    if not sort in PROFILE_SORTS:
+        response = jsonify({"message": "error",
+                            "body": "Invalid sort {}".format(sort)})
+        response.status_code = 400
+        return response
+    text = profile_text(name, sort)
+    if text is None:
+        abort(404)
+    return Response(text, mimetype='text/plain')
+
+@app.route('/reports/sync')
+def sync_status():
+    """Returns the high-water mark, indexing lag and the seconds since the
+    incremental sync worker last ran"""
+    if not 'username' in session:
+        raise abort(403)
+    report = sync_report()
+    if report is None:
+        abort(404)
+    return jsonify(report)
+
+@app.route('/metrics')
+def metrics_report():
+    """Returns the request, Elastic Search and SPARQL timing histograms in
+    the Prometheus text format. Scrapers without a session authenticate
+    with an Authorization: Bearer header matching METRICS_TOKEN."""
+    token = app.config.get('METRICS_TOKEN')
+    bearer = request.headers.get('Authorization', '')
+    if not 'username' in session and \
+       not (token and bearer == "Bearer {}".format(token)):
+        raise abort(403)
+    return Response(exposition(), mimetype='text/plain; version=0.0.4')
 
 @app.route("/login", methods=["GET", "POST"])
 def login():
@@ -77,55 +243,37 @@ def search():
     search_type = request.form.get('search_type', 'kw')
     phrase = request.form.get('phrase')
     size = int(request.form.get('size', 20))
-    from_ = int(request.form.get('from'))
+    from_ = int(request.form.get('from', 0))
     filter_ = request.form.get('filter', 'All').lower()
     sort = request.form.get('sort', 'Relevance').lower()
-    doc_type, results = None, []
-    es_dsl = {
-        "query": {},
-        "sort": {}
-    }
-    if filter_.startswith("all"):
-        es_dsl['query']['match'] =  {"_all": phrase}
-    else:
-        if filter_.endswith("s"):
-            filter_ = filter_[:-1]
-        doc_type = filter_
-        es_dsl["query"]["filtered"] =  {
-            "query": {
-                "match": {"_all": phrase}
-            }
-        }
-        if doc_type.startswith("agent"):
-            es_dsl["query"]["filtered"]["filter"] = {
-                "or": [
-                    {
-                        "type": {
-                            "value": "Person"
-                        }
-                     },
-                     {
-                         "type": {
-                             "value": "Organization"
-                         }
-                     }
-                ]
-            }
-        else:
-            es_dsl["query"]["filtered"]["filter"] = {
-                "type": {
-                    "value": doc_type.title()
-                }
-           }
-    if not sort.startswith("relevance"):
-      es_dsl['sort'] = __generate_sort__(sort, doc_type)
-    #print(es_dsl)
+    cursor = request.form.get('cursor')
+    # Cursor mode pages with search_after, the cursor is empty for the
+    # first page and the next token of the previous page afterwards
+    use_cursor = cursor is not None and app.config.get('SEARCH_CURSOR', False)
+    results = []
+    es_dsl = __search_dsl__(phrase, filter_, sort, use_cursor)
+    if use_cursor and len(cursor) > 0:
+        try:
+            es_dsl['search_after'] = __decode_cursor__(cursor)
+        except ValueError:
+            response = jsonify({"message": "error",
+                                "body": "Invalid cursor {}".format(cursor)})
+            response.status_code = 400
+            return response
     result = es_search.search(
         body=es_dsl, 
-        index='bibframe', 
+        index=es_index, 
         size=size,
-        from_=from_)
-    for hit in result.get('hits').get('hits'):
+        from_=0 if use_cursor else from_)
+    hits = result.get('hits').get('hits')
+    for hit in hits:
+        entity_map().put(hit['_id'], hit['_source'])
+    # Denormalized Works and Instances render from _source alone, the
+    # others are expanded at query time
+    displays = [__display_result__(hit['_source']) for hit in hits]
+    pending = [hit for hit, display in zip(hits, displays) if display is None]
+    expanded = iter(__expand_instances__([hit['_source'] for hit in pending]))
+    for hit, display in zip(hits, displays):
         typeDisplay = ""
         #if filter_.startswith("all"):
         typeDisplay =  hit['_type']
@@ -135,13 +283,66 @@ def search():
             "creators": find_creators(['_source']),
             "iType": typeDisplay,
             "url": "{}/{}".format(hit['_type'], hit['_id'])}
-        item.update(__expand_instance__(hit['_source']))
+        if display is None:
+            item.update(next(expanded))
+        else:
+            item.update(display)
         results.append(item)
     #print(results)
-    return jsonify(
-        {"hits": results, 
-         "from": from_ + size,
-         "total": result['hits']['total']})
+    output = {"hits": results, 
+              "from": from_ + size,
+              "total": result['hits']['total']}
+    if use_cursor:
+        output["next"] = None
+        if len(hits) == size:
+            output["next"] = __encode_cursor__(hits[-1]['sort'])
+    return jsonify(output)
+
+@app.route('/export', methods=['POST', 'GET'])
+def export():
+    """Streams every search result for a phrase, filter and sort as 
+    newline delimited JSON or as a JSON-LD graph, scrolling through the
+    results so memory use does not grow with the number of hits. Exports
+    can cover the whole index, so like the reports they are for staff."""
+    if not 'username' in session:
+        raise abort(403)
+    params = request.values
+    phrase = params.get('phrase')
+    if not phrase:
+        response = jsonify({"message": "error",
+                            "body": "Missing phrase"})
+        response.status_code = 400
+        return response
+    filter_ = params.get('filter', 'All').lower()
+    sort = params.get('sort', 'Relevance').lower()
+    format_ = params.get('format', 'ndjson').lower()
+    fields = params.get('fields')
+    es_dsl = __search_dsl__(phrase, filter_, sort)
+    if sort.startswith("relevance"):
+        es_dsl.pop('sort')
+    scan_params = {"size": app.config.get('EXPORT_SCROLL_SIZE', 500),
+                   "preserve_order": not sort.startswith("relevance")}
+    if fields:
+        scan_params['_source_include'] = fields.split(",")
+    hits = scan(es_search, query=es_dsl, index=es_index, **scan_params)
+    # The search and first scroll page run before the response starts so
+    # that their errors are not hidden behind a 200
+    try:
+        first = next(hits, None)
+    except ElasticsearchException as error:
+        app.logger.error("Export of %s failed: %s", phrase, error)
+        response = jsonify({"message": "error",
+                            "body": "Search failed"})
+        response.status_code = 502
+        return response
+    hits = itertools.chain([first] if first is not None else [], hits)
+    if format_.startswith('jsonld'):
+        return Response(
+            stream_with_context(__export_jsonld__(hits)),
+            content_type='application/ld+json')
+    return Response(
+        stream_with_context(__export_ndjson__(hits)),
+        content_type='application/x-ndjson')
 
 @app.route("/typeahead", methods=['GET', 'POST'])
 def typeahead_search():
@@ -150,8 +351,11 @@ def typeahead_search():
     search_type = request.args.get('type')
     key = search_type.lower()
     phrase = request.args.get('q')
-   ##if key.startswith('alltypes'):
-		
+    if prefix_index.ready and (key.startswith('alltypes') or 
+        key.startswith('agent') or key in dict(SUGGEST_GROUPS)):
+        return json.dumps(prefix_search(phrase, key))
+    if key.startswith('alltypes'):
+        return __all_types_search__(phrase)
     if key.startswith('agent'):
         return __agent_search__(phrase)
     else: 
@@ -165,7 +369,7 @@ def typeahead_search():
         }
     result = es_search.suggest(
         body=es_dsl,
-        index='bibframe')
+        index=es_index)
     
     for hit in result.get('{}-suggest'.format(key))[0]['options']:
         row = {key: hit['text'], 
@@ -175,11 +379,8 @@ def typeahead_search():
 
 @app.route("/CoverArt/<uuid>.<ext>", defaults={"ext": "jpg"})
 def cover(uuid, ext):
-    if es_search.exists(id=uuid, index='bibframe'):
-        cover = es_search.get(
-            id=uuid, 
-            index='bibframe', 
-            fields=['bf:coverArt'])
+    cover = __get_entity__(uuid, fields=['bf:coverArt'], source=False)
+    if cover is not None:
         raw_image = base64.b64decode(
             cover.get('fields').get('bf:coverArt')[0])
         file_name = '{}.{}'.format(uuid, ext)
@@ -197,8 +398,8 @@ def detail_redirect(uuid, ext):
         uuid -- UUID of Bibframe Resource
         ext -- extension of the view, defaults to html
     """
-    if es_search.exists(id=uuid, index='bibframe'):
-        result = es_search.get(id=uuid, index='bibframe', fields=['_type'])
+    result = __get_entity__(uuid, source=False)
+    if result is not None:
         entity = result.get('_type')   
         return redirect(url_for('detail', 
                         entity=entity, 
@@ -208,12 +409,13 @@ def detail_redirect(uuid, ext):
 
 #@app.route("/<entity>/<uuid>.<ext>")
 @app.route("/<entity>/<uuid>")
-@app.route("/<entity>/<uuid>.json")
+@app.route("/<entity>/<uuid>.json", defaults={"ext": "json"})
 def detail(uuid, entity="Work", ext="html"):
-    if es_search.exists(id=uuid, index='bibframe', doc_type=entity):
+    result = __get_entity__(uuid, doc_type=entity)
+    if result is not None:
         resource = dict()
-        result = es_search.get_source(id=uuid, index='bibframe')
-        resource.update(result)
+        entity_map().put(uuid, result['_source'])
+        resource.update(result['_source'])
         if ext.startswith('json'):
             return jsonify(resource)
         template = "detail.html"
@@ -225,14 +427,51 @@ def detail(uuid, entity="Work", ext="html"):
             version=__version__)
     abort(404)
 
+def __is_string_list__(value):
+    return isinstance(value, list) and \
+        all([isinstance(row, str) for row in value])
+
+@app.route("/entities/batch", methods=['POST'])
+def entities_batch():
+    """Returns up to BATCH_MAX_ENTITIES entities by uuid in one response.
+    Takes a JSON body or form with a list of uuids and an optional list
+    of fields to return for each entity."""
+    data = request.get_json(silent=True)
+    if data is None:
+        data = {"uuids": request.form.getlist('uuids'),
+                "fields": request.form.getlist('fields') or None}
+    uuids, fields = None, None
+    if isinstance(data, dict):
+        uuids = data.get('uuids') or []
+        fields = data.get('fields')
+    max_entities = app.config.get('BATCH_MAX_ENTITIES', 100)
+    error = None
+    if not __is_string_list__(uuids):
+        error = "uuids must be a list of strings"
+    elif fields is not None and not __is_string_list__(fields):
+        error = "fields must be a list of strings"
+    elif len(uuids) > max_entities:
+        error = "Cannot request more than {} entities".format(max_entities)
+    if error is not None:
+        response = jsonify({"message": "error", "body": error})
+        response.status_code = 400
+        return response
+    entities, missing = __get_entities__(uuids, fields)
+    return jsonify({"entities": entities, "missing": missing})
+
 @app.route("/itemDetails")
 def itemDetails():
     uuid = request.args.get('uuid')
     doc_type = request.args.get('type')
+    size = request.args.get(
+        'size', app.config.get('RELATED_ITEMS_SIZE', 10), type=int)
     relItems = {}
-    if es_search.exists(id=uuid, index='bibframe'):
-        resource = dict()
-    result = es_search.get(id=uuid, index='bibframe')
+    result = __get_entity__(uuid)
+    if result is None:
+        abort(404)
+    resource = dict()
+    entity_map().put(uuid, dict(result['_source']))
+    primeRelatedDetails(result['_source'])
     for k, v in result['_source'].items():
         #print(k," : ",v," --> ",type(v))
         itemLookup = lookupRelatedDetails(v)
@@ -241,14 +480,14 @@ def itemDetails():
     if doc_type == 'Work':
         #print("*** work Type")
         lookupFlds = {'instances':'bf:instanceOf'}
-        relItems = findRelatedItems(lookupFlds, uuid)
+        relItems = findRelatedItems(lookupFlds, uuid, size)
     if doc_type == 'Person':
         #print("*** Person Type")
         lookupFlds = {'works':'bf:contributor'}
-        relItems = findRelatedItems(lookupFlds, uuid)
+        relItems = findRelatedItems(lookupFlds, uuid, size)
     if doc_type == 'Topic':
         lookupFlds = {'works':'bf:subject'}
-        relItems = findRelatedItems(lookupFlds, uuid)
+        relItems = findRelatedItems(lookupFlds, uuid, size)
         		
     result['_z_relatedItems'] = relItems    
     resource.update(result)
@@ -256,109 +495,7 @@ def itemDetails():
 
 @app.route("/classcount")
 def itemCounts():
-    es_dsl = {
-                "query": {
-                    "query_string": {
-                        "query": "*",
-                        "analyze_wildcard": True
-                    }
-                },
-                "size": 0,
-                "aggs": {
-                    "2": {
-                        "terms": {
-                            "field": "_type",
-                            "size": 20,
-                            "order": {
-                                "_count": "desc"
-                            }
-                        }
-                    }
-                }
-            }
-    bfMajorSum = es_search.search(
-        body=es_dsl, 
-        index='bibframe', 
-        size=0)
-    es_dsl = {
-                "query": {
-                    "query_string": {
-                        "query": "*",
-                        "analyze_wildcard": True
-                    }
-                },
-                "size": 0,
-                "aggs": {
-                    "2": {
-                        "terms": {
-                            "field": "type",
-                            "size": 100,
-                            "order": {
-                                "_count": "desc"
-                            }
-                        }
-                    }
-                }
-            }
-    bfTypeSum = es_search.search(
-        body=es_dsl, 
-        index='bibframe', 
-        size=0)
-    es_dsl = {
-  "query": {
-    "query_string": {
-      "query": "*",
-      "analyze_wildcard": True
-    }
-  },
-  "size": 0,
-  "aggs": {
-    "2": {
-      "filters": {
-        "filters": {
-          "type:\"bf:Person\"": {
-            "query": {
-              "query_string": {
-                "query": "type:\"bf:Person\"",
-                "analyze_wildcard": True
-              }
-            }
-          },
-          "type:\"bf:Organization\"": {
-            "query": {
-              "query_string": {
-                "query": "type:\"bf:Organization\"",
-                "analyze_wildcard": True
-              }
-            }
-          },
-          "type:\"bf:Topic\"": {
-            "query": {
-              "query_string": {
-                "query": "type:\"bf:Topic\"",
-                "analyze_wildcard": True
-              }
-            }
-          },
-          "type:\"bf:Place\"": {
-            "query": {
-              "query_string": {
-                "query": "type:\"bf:Place\"",
-                "analyze_wildcard": True
-              }
-            }
-          }
-        }
-      }
-    }
-  }
-}
-    bfAuthSum = es_search.search(
-        body=es_dsl, 
-        index='bibframe', 
-        size=0)
-    result = {'bfTypeSum':bfTypeSum,'bfMajorSum':bfMajorSum,'bfAuthSum':bfAuthSum}
-    return jsonify(result)
+    return jsonify(class_counts.get())
 
 @app.route("/")
 def index():
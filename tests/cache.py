@@ -0,0 +1,127 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+TEST_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+os.environ.setdefault('BIBCAT_SETTINGS',
+                      os.path.join(TEST_DIRECTORY, 'settings.py'))
+try:
+    import catalog
+except ImportError:
+    sys.path.append(os.path.dirname(TEST_DIRECTORY))
+    import catalog
+import catalog.cache as cache
+import catalog.filters as filters
+
+WORK_URL = "http://localhost:8080/rest/ab/cd/abcd-1234"
+
+LABEL_SPARQL = """PREFIX bf: <http://bibframe.org/vocab/>
+PREFIX fedora: <http://fedora.info/definitions/v4/repository#>
+SELECT ?label
+WHERE {{
+  <{}> bf:label ?label .
+}}""".format(WORK_URL)
+
+
+class CountingDatastore(object):
+    """Stand-in for the SPARQL backend that counts its queries"""
+
+    def __init__(self):
+        self.queries = []
+
+    def query(self, sparql):
+        self.queries.append(sparql)
+        return {"results": {"bindings": [{"label": {"value": "Work"}}]}}
+
+
+class SPARQLCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.datastore = CountingDatastore()
+        patcher = mock.patch.object(filters, 'sparql_backend',
+                                    self.datastore)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cache.sparql_cache.clear()
+        self.addCleanup(cache.sparql_cache.clear)
+
+    def test_normalize_sparql(self):
+        reformatted = ("PREFIX bf: <http://bibframe.org/vocab/>   "
+                       "PREFIX fedora: "
+                       "<http://fedora.info/definitions/v4/repository#>\n"
+                       "# The label of the work\n"
+                       "SELECT ?label WHERE {{ <{}>\tbf:label ?label . "
+                       "# one label\n}}".format(WORK_URL))
+        self.assertEqual(cache.normalize_sparql(reformatted),
+                         cache.normalize_sparql(LABEL_SPARQL))
+        # Whitespace and # inside IRIs and literals are part of the query
+        self.assertNotEqual(
+            cache.normalize_sparql('SELECT ?s WHERE { ?s ?p "a  b" }'),
+            cache.normalize_sparql('SELECT ?s WHERE { ?s ?p "a b" }'))
+        self.assertEqual(
+            cache.normalize_sparql('SELECT ?s WHERE { ?s ?p "# not" }'),
+            'SELECT ?s WHERE { ?s ?p "# not" }')
+
+    def test_shared_entry(self):
+        first = filters.__sparql__(LABEL_SPARQL)
+        second = filters.__sparql__(
+            "# cached\n" + "\n\n".join(LABEL_SPARQL.split("\n")) + "  ")
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.datastore.queries), 1)
+        self.assertGreaterEqual(cache.sparql_cache.stats()['hits'], 1)
+
+    def test_invalidate(self):
+        filters.__sparql__(LABEL_SPARQL)
+        cache.sparql_cache.invalidate(cache.normalize_sparql(LABEL_SPARQL))
+        filters.__sparql__(LABEL_SPARQL)
+        self.assertEqual(len(self.datastore.queries), 2)
+
+    def test_purge(self):
+        other = LABEL_SPARQL.replace(WORK_URL, WORK_URL + "-other")
+        filters.__sparql__(LABEL_SPARQL)
+        filters.__sparql__(other)
+        cache.purge_sparql_cache(WORK_URL)
+        filters.__sparql__(LABEL_SPARQL)
+        filters.__sparql__(other)
+        self.assertEqual(len(self.datastore.queries), 3)
+        cache.purge_sparql_cache()
+        filters.__sparql__(other)
+        self.assertEqual(len(self.datastore.queries), 4)
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_version_invalidation(self):
+        lru = cache.LRUCache(maxsize=10, ttl=60)
+        lru.set('uuid', ['Label'], version=2)
+        # Older or equal versions leave the entry in place
+        lru.invalidate('uuid', 1)
+        lru.invalidate('uuid', 2)
+        self.assertEqual(lru.get('uuid'), ['Label'])
+        lru.invalidate('uuid', 3)
+        self.assertIsNone(lru.get('uuid'))
+        lru.set('uuid', ['Label'])
+        lru.invalidate('uuid')
+        self.assertIsNone(lru.get('uuid'))
+
+    def test_evictions(self):
+        lru = cache.LRUCache(maxsize=2, ttl=60)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.get('a'), 1)
+        self.assertEqual(lru.stats()['evictions'], 1)
+
+    def test_ttl(self):
+        lru = cache.LRUCache(maxsize=2, ttl=60)
+        lru.set('a', 1)
+        with mock.patch.object(cache.time, 'time',
+                               return_value=cache.time.time() + 61):
+            self.assertIsNone(lru.get('a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
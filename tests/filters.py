@@ -0,0 +1,120 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+TEST_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+os.environ.setdefault('BIBCAT_SETTINGS',
+                      os.path.join(TEST_DIRECTORY, 'settings.py'))
+try:
+    import catalog
+except ImportError:
+    sys.path.append(os.path.dirname(TEST_DIRECTORY))
+    import catalog
+import catalog.cache as cache
+import catalog.filters as filters
+from catalog.datastore import LocalDatastore
+
+REPOSITORY = "http://localhost:8080/rest/"
+
+REPOSITORY_TURTLE = """@prefix bf: <http://bibframe.org/vocab/> .
+@prefix fedora: <http://fedora.info/definitions/v4/repository#> .
+@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .
+
+<http://localhost:8080/rest/work> a bf:Work .
+
+<http://localhost:8080/rest/instance1> a bf:Instance ;
+    bf:instanceOf <http://localhost:8080/rest/work> .
+
+<http://localhost:8080/rest/instance2> a bf:Instance ;
+    bf:instanceOf <http://localhost:8080/rest/work> .
+
+<http://localhost:8080/rest/instance3> a bf:Instance .
+
+<http://localhost:8080/rest/cover1> fedora:uuid "cover-1"^^xsd:string ;
+    bf:coverArtFor <http://localhost:8080/rest/instance1> .
+
+<http://localhost:8080/rest/item1> fedora:uuid "item-1"^^xsd:string ;
+    bf:holdingFor <http://localhost:8080/rest/instance1> ;
+    bf:circulationStatus "Available" ;
+    bf:itemId "0001" ;
+    bf:heldBy <http://localhost:8080/rest/library> .
+
+<http://localhost:8080/rest/item2> fedora:uuid "item-2"^^xsd:string ;
+    bf:holdingFor <http://localhost:8080/rest/instance2> ;
+    bf:circulationStatus "On loan" ;
+    bf:itemId "0002" ;
+    bf:heldBy <http://localhost:8080/rest/library> .
+
+<http://localhost:8080/rest/library> bf:label "Tutt Library" .
+"""
+
+
+def __entity__(name):
+    return {'fedora:hasLocation': [REPOSITORY + name]}
+
+
+class EntityDetailsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        path = os.path.join(self.directory.name, 'repository.ttl')
+        with open(path, 'w') as turtle:
+            turtle.write(REPOSITORY_TURTLE)
+        self.datastore = LocalDatastore([path])
+        self.query = mock.Mock(wraps=self.datastore.query)
+        patcher = mock.patch.object(filters, 'sparql_backend',
+                                    mock.Mock(query=self.query))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cache.sparql_cache.clear()
+        self.addCleanup(cache.sparql_cache.clear)
+
+    def test_entity_details_sparql(self):
+        urls = [REPOSITORY + name for name in
+                ['work', 'instance1', 'instance2', 'instance3']]
+        details = filters.entity_details_sparql(urls)
+        self.assertEqual(self.query.call_count, 1)
+        # A Work has the held items and cover art of its Instances
+        self.assertEqual(details[urls[0]]['covers'], ['cover-1'])
+        self.assertEqual(sorted(details[urls[0]]['held_items']),
+                         ['item-1', 'item-2'])
+        self.assertEqual(details[urls[1]],
+                         {'held_items': ['item-1'], 'covers': ['cover-1']})
+        self.assertEqual(details[urls[2]],
+                         {'held_items': ['item-2'], 'covers': []})
+        self.assertEqual(details[urls[3]], {'held_items': [], 'covers': []})
+
+    def test_values_size(self):
+        urls = [REPOSITORY + name for name in
+                ['instance1', 'instance2', 'instance3']]
+        with mock.patch.dict(catalog.app.config, {'SPARQL_VALUES_SIZE': 2}):
+            details = filters.entity_details_sparql(urls)
+        self.assertEqual(self.query.call_count, 2)
+        self.assertEqual(details[urls[1]]['held_items'], ['item-2'])
+
+    def test_page(self):
+        entities = [__entity__(name) for name in
+                    ['instance1', 'instance2', 'instance3']]
+        empty_map = mock.Mock(get_many=mock.Mock(return_value={}))
+        with catalog.app.test_request_context('/'), \
+             mock.patch.object(filters, 'entity_map',
+                               return_value=empty_map):
+            filters.prime_entity_details(entities)
+            covers = [filters.get_cover_sparql(entity)
+                      for entity in entities]
+            # The covers and held items of the whole page come from one
+            # query, the held items missing from the index from another
+            self.assertEqual(self.query.call_count, 1)
+            held_items = filters.held_items_sparql(entities[1])
+            self.assertEqual(self.query.call_count, 2)
+        self.assertEqual(covers[0], '/CoverArt/cover-1.jpg')
+        self.assertTrue(covers[1].endswith('cover-placeholder.png'))
+        self.assertIn('Tutt Library', held_items)
+        self.assertIn('On loan', held_items)
+
+
+if __name__ == '__main__':
+    unittest.main()
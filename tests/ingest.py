@@ -0,0 +1,130 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+import rdflib
+from elasticsearch.serializer import JSONSerializer
+
+TEST_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+os.environ.setdefault('BIBCAT_SETTINGS',
+                      os.path.join(TEST_DIRECTORY, 'settings.py'))
+try:
+    import catalog
+except ImportError:
+    sys.path.append(os.path.dirname(TEST_DIRECTORY))
+    import catalog
+import catalog.ingest as ingest
+
+WORK_TURTLE = """@prefix bf: <http://bibframe.org/vocab/> .
+
+<http://bibframe.org/resources/sample-lc-2/16736259> a bf:Text, bf:Work ;
+    bf:authorizedAccessPoint "Howden, Martin. Russell Crowe :the biography" ;
+    bf:creator <http://bibframe.org/resources/sample-lc-2/16736259person12> ;
+    bf:language <http://id.loc.gov/vocabulary/languages/eng> ;
+    bf:workTitle <http://bibframe.org/resources/sample-lc-2/16736259title11> .
+
+<http://bibframe.org/resources/sample-lc-2/16736259person12> a bf:Person ;
+    bf:label "Howden, Martin." .
+
+<http://bibframe.org/resources/sample-lc-2/16736259title11> a bf:Title ;
+    bf:titleValue "Russell Crowe :" .
+"""
+WORK = rdflib.URIRef('http://bibframe.org/resources/sample-lc-2/16736259')
+PERSON = rdflib.URIRef(
+    'http://bibframe.org/resources/sample-lc-2/16736259person12')
+
+
+class BulkElasticsearch(object):
+    """Stand-in for the Elastic Search client that records _bulk actions"""
+
+    def __init__(self):
+        self.actions = []
+        self.settings = []
+        self.transport = self
+        self.serializer = JSONSerializer()
+        self.indices = self
+
+    def bulk(self, body, **params):
+        lines = [json.loads(line) for line in body.splitlines() if line]
+        items = []
+        for action, source in zip(lines[::2], lines[1::2]):
+            self.actions.append((action, source))
+            op_type, meta = list(action.items())[0]
+            items.append({op_type: {'_id': meta['_id'], 'status': 201}})
+        return {'items': items}
+
+    def get_settings(self, index):
+        return {index: {'settings': {'index': {'refresh_interval': '1s'}}}}
+
+    def put_settings(self, index, body):
+        self.settings.append(body['index']['refresh_interval'])
+
+
+class IngestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.graph = rdflib.Graph().parse(data=WORK_TURTLE, format='turtle')
+
+    def test_guess_search_doc_type(self):
+        self.assertEqual(ingest.guess_search_doc_type(self.graph, WORK),
+                         'Work')
+        self.assertEqual(ingest.guess_search_doc_type(self.graph, PERSON),
+                         'Person')
+        self.assertIsNone(ingest.guess_search_doc_type(
+            self.graph, rdflib.URIRef('http://catalog.test/none')))
+
+    def test_subject_document(self):
+        doc_id, doc_type, source = ingest.subject_document(self.graph, WORK)
+        self.assertEqual(doc_id, ingest.subject_uuid(WORK))
+        self.assertEqual(doc_type, 'Work')
+        self.assertEqual(sorted(source['type']), ['bf:Text', 'bf:Work'])
+        # Subjects of the graph are referenced by document id, others
+        # keep their urls
+        self.assertEqual(source['bf:creator'], [ingest.subject_uuid(PERSON)])
+        self.assertEqual(source['bf:language'],
+                         ['http://id.loc.gov/vocabulary/languages/eng'])
+
+    def test_ingest(self):
+        elastic_search = BulkElasticsearch()
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ['one.ttl', 'two.ttl']:
+                with open(os.path.join(directory, name), 'w') as rdf:
+                    rdf.write(WORK_TURTLE)
+            report = ingest.ingest([directory],
+                                   elastic_search=elastic_search,
+                                   workers=2,
+                                   batch_size=2)
+        self.assertEqual(report['files'], 2)
+        self.assertEqual(report['triples'], 20)
+        self.assertEqual(report['documents'], 6)
+        self.assertEqual(len(elastic_search.actions), 6)
+        self.assertEqual(elastic_search.settings, ['-1', '1s'])
+
+    def test_namespace(self):
+        # The Work and its creator are in different files
+        prefix, work_turtle, person_turtle, title_turtle = \
+            WORK_TURTLE.split("\n\n")
+        elastic_search = BulkElasticsearch()
+        with tempfile.TemporaryDirectory() as directory:
+            for name, turtle in [('work.ttl', work_turtle),
+                                 ('person.ttl', person_turtle)]:
+                with open(os.path.join(directory, name), 'w') as rdf:
+                    rdf.write("\n\n".join([prefix, turtle]))
+            ingest.ingest([directory],
+                          elastic_search=elastic_search,
+                          workers=2,
+                          namespace='http://bibframe.org/resources/')
+        sources = dict([(action['index']['_id'], source)
+                        for action, source in elastic_search.actions])
+        self.assertEqual(len(sources), 2)
+        work = sources[ingest.subject_uuid(WORK)]
+        self.assertEqual(work['bf:creator'], [ingest.subject_uuid(PERSON)])
+        self.assertIn(ingest.subject_uuid(PERSON), sources)
+        self.assertEqual(work['bf:language'],
+                         ['http://id.loc.gov/vocabulary/languages/eng'])
+
+
+if __name__ == '__main__':
+    unittest.main()
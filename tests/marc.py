@@ -0,0 +1,112 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+import pymarc
+
+TEST_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+os.environ.setdefault('BIBCAT_SETTINGS',
+                      os.path.join(TEST_DIRECTORY, 'settings.py'))
+try:
+    import catalog
+except ImportError:
+    sys.path.append(os.path.dirname(TEST_DIRECTORY))
+    import catalog
+import catalog.marc as marc
+from tests.ingest import BulkElasticsearch
+
+def __record__(control, title, author):
+    record = pymarc.Record(force_utf8=True)
+    record.add_field(
+        pymarc.Field(tag='001', data=control),
+        pymarc.Field(tag='100', indicators=['1', ' '], subfields=[
+            pymarc.Subfield('a', author)]),
+        pymarc.Field(tag='245', indicators=['1', '0'], subfields=[
+            pymarc.Subfield('a', title + " :"),
+            pymarc.Subfield('b', 'the biography /')]),
+        pymarc.Field(tag='650', indicators=[' ', '0'], subfields=[
+            pymarc.Subfield('a', 'Actors'),
+            pymarc.Subfield('z', 'Australia')]),
+        pymarc.Field(tag='852', indicators=[' ', ' '], subfields=[
+            pymarc.Subfield('b', 'Stacks'),
+            pymarc.Subfield('h', 'PN3018.C76')]))
+    return record
+
+RECORDS = [__record__('16736259', 'Russell Crowe', 'Howden, Martin.'),
+           __record__('16736260', 'Cate Blanchett', 'Howden, Martin.'),
+           __record__('16736261', 'Hugh Jackman', 'Smith, Ann.')]
+
+
+class MARCIngestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'records.mrc')
+        with open(self.path, 'wb') as marc_file:
+            for record in RECORDS:
+                marc_file.write(record.as_marc())
+
+    def test_record_documents(self):
+        documents = marc.record_documents(RECORDS[0])
+        by_type = dict([(doc_type, source)
+                        for doc_id, doc_type, source, turtle in documents])
+        self.assertEqual(sorted(by_type),
+                         ['HeldItem', 'Instance', 'Person', 'Title', 'Topic',
+                          'Work'])
+        self.assertEqual(by_type['Title']['bf:titleValue'], ['Russell Crowe'])
+        self.assertEqual(by_type['Topic']['bf:label'], ['Actors--Australia'])
+        self.assertEqual(by_type['Work']['bf:creator'],
+                         by_type['Person']['fedora:uuid'])
+        self.assertEqual(by_type['HeldItem']['bf:holdingFor'],
+                         by_type['Instance']['fedora:uuid'])
+
+    def test_ingest_marc(self):
+        elastic_search = BulkElasticsearch()
+        report = marc.ingest_marc(self.path,
+                                  elastic_search=elastic_search,
+                                  workers=2,
+                                  chunk_size=2,
+                                  batch_size=4)
+        self.assertEqual(report['records'], 3)
+        self.assertEqual(report['documents'], 18)
+        with open("{}.checkpoint".format(self.path)) as checkpoint:
+            saved = json.load(checkpoint)
+        self.assertEqual(saved['records'], 3)
+        self.assertEqual(saved['offset'], os.path.getsize(self.path))
+
+    def test_resume(self):
+        offset = len(RECORDS[0].as_marc()) + len(RECORDS[1].as_marc())
+        marc.Checkpoint("{}.checkpoint".format(self.path),
+                        self.path).save(offset, 2)
+        elastic_search = BulkElasticsearch()
+        report = marc.ingest_marc(self.path,
+                                  elastic_search=elastic_search,
+                                  workers=1,
+                                  resume=True)
+        self.assertEqual(report['records'], 1)
+        titles = [source['bf:titleValue'] for action, source in
+                  elastic_search.actions if 'bf:titleValue' in source]
+        self.assertEqual(titles, [['Hugh Jackman']])
+
+    def test_ingest_marcxml(self):
+        path = os.path.join(self.directory.name, 'records.xml')
+        writer = pymarc.XMLWriter(open(path, 'wb'))
+        for record in RECORDS:
+            writer.write(record)
+        writer.close()
+        elastic_search = BulkElasticsearch()
+        report = marc.ingest_marc(path,
+                                  elastic_search=elastic_search,
+                                  workers=1)
+        self.assertEqual(report['records'], 3)
+        self.assertEqual(report['errors'], 0)
+        self.assertEqual(report['documents'], 18)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+
+if __name__ == '__main__':
+    unittest.main()
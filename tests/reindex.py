@@ -0,0 +1,217 @@
+import copy
+import fnmatch
+import json
+import os
+import sys
+import unittest
+from unittest import mock
+
+from elasticsearch.serializer import JSONSerializer
+
+TEST_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+os.environ.setdefault('BIBCAT_SETTINGS',
+                      os.path.join(TEST_DIRECTORY, 'settings.py'))
+try:
+    import catalog
+except ImportError:
+    sys.path.append(os.path.dirname(TEST_DIRECTORY))
+    import catalog
+import catalog.reindex as reindex
+
+MAPPINGS = {"Work": {"properties": {"bf:title": {"type": "string"}}}}
+
+
+class AliasElasticsearch(object):
+    """Stand-in for the Elastic Search client with indices, aliases, scan
+    and _bulk"""
+
+    def __init__(self, documents, index='bibframe', alias=None):
+        self.transport = self
+        self.serializer = JSONSerializer()
+        self.indices = self
+        self.documents = {index: dict(documents)}
+        self.settings = {index: {"number_of_shards": "5",
+                                 "number_of_replicas": "1",
+                                 "uuid": "abc",
+                                 "creation_date": "1439251200000"}}
+        self.mappings = {index: copy.deepcopy(MAPPINGS)}
+        self.aliases = {}
+        if alias is not None:
+            self.aliases[alias] = [index]
+        self.alias_updates = []
+        self.dropped = 0
+
+    def __matches__(self, pattern):
+        return [name for name in self.documents
+                if fnmatch.fnmatch(name, pattern)]
+
+    def get_settings(self, index):
+        return dict([(name, {"settings": {"index": dict(
+                        self.settings[name])}})
+                     for name in self.__matches__(index)])
+
+    def put_settings(self, index, body):
+        self.settings[index].update(body['index'])
+
+    def get_mapping(self, index):
+        return {index: {"mappings": copy.deepcopy(self.mappings[index])}}
+
+    def exists(self, index):
+        return index in self.documents
+
+    def exists_alias(self, name):
+        return name in self.aliases
+
+    def get_alias(self, name):
+        return dict([(index, {"aliases": {name: {}}})
+                     for index in self.aliases[name]])
+
+    def create(self, index, body):
+        self.documents[index] = {}
+        self.settings[index] = dict(body['settings']['index'])
+        self.mappings[index] = body['mappings']
+
+    def delete(self, index):
+        del self.documents[index]
+
+    def refresh(self, index):
+        pass
+
+    def update_aliases(self, body):
+        self.alias_updates.append(body['actions'])
+        for action in body['actions']:
+            for op_type, meta in action.items():
+                indices = self.aliases.setdefault(meta['alias'], [])
+                if op_type == 'add':
+                    indices.append(meta['index'])
+                else:
+                    indices.remove(meta['index'])
+
+    def count(self, index):
+        return {"count": len(self.documents[index])}
+
+    def search(self, body, scroll, index, size, search_type):
+        hits = [{"_index": index, "_type": doc_type, "_id": doc_id,
+                 "_source": copy.deepcopy(source)}
+                for (doc_type, doc_id), source in
+                sorted(self.documents[index].items())]
+        self.pages = [hits[i:i + size] for i in range(0, len(hits), size)]
+        return {"_scroll_id": "0", "hits": {"hits": []}}
+
+    def scroll(self, scroll_id, scroll):
+        page = self.pages.pop(0) if len(self.pages) > 0 else []
+        return {"_scroll_id": "1",
+                "_shards": {"failed": 0, "total": 1},
+                "hits": {"hits": page}}
+
+    def bulk(self, body, **params):
+        lines = [json.loads(line) for line in body.splitlines() if line]
+        items = []
+        for action, source in zip(lines[::2], lines[1::2]):
+            meta = action['index']
+            if self.dropped > 0:
+                self.dropped -= 1
+            else:
+                self.documents[meta['_index']][
+                    (meta['_type'], meta['_id'])] = source
+            items.append({'index': {'_id': meta['_id'], 'status': 201}})
+        return {'items': items}
+
+
+DOCUMENTS = dict([(('Work', str(i)), {"bf:title": ["Work {}".format(i)]})
+                  for i in range(5)])
+
+
+class ReindexTest(unittest.TestCase):
+
+    def test_index_version(self):
+        self.assertEqual(reindex.index_version('bibframe_v12', 'bibframe'),
+                         12)
+        self.assertIsNone(reindex.index_version('bibframe', 'bibframe'))
+        self.assertIsNone(reindex.index_version('other_v1', 'bibframe'))
+
+    def test_reindex(self):
+        elastic_search = AliasElasticsearch(DOCUMENTS, 'bibframe_v1',
+                                            alias='bibframe')
+        report = reindex.reindex(elastic_search, 'bibframe', batch_size=2)
+        self.assertEqual(report['target'], 'bibframe_v2')
+        self.assertEqual(report['target_count'], 5)
+        self.assertTrue(report['swapped'])
+        self.assertEqual(elastic_search.documents['bibframe_v2'], DOCUMENTS)
+        self.assertEqual(elastic_search.mappings['bibframe_v2'], MAPPINGS)
+        settings = elastic_search.settings['bibframe_v2']
+        self.assertNotIn('uuid', settings)
+        self.assertEqual(settings['number_of_replicas'], "1")
+        self.assertEqual(settings['refresh_interval'], "1s")
+        # The alias moves in a single _aliases call and the previous
+        # version is kept
+        self.assertEqual(elastic_search.alias_updates, [[
+            {"remove": {"index": "bibframe_v1", "alias": "bibframe"}},
+            {"add": {"index": "bibframe_v2", "alias": "bibframe"}}]])
+        self.assertEqual(elastic_search.aliases['bibframe'], ['bibframe_v2'])
+        self.assertIn('bibframe_v1', elastic_search.documents)
+        self.assertEqual(reindex.rollback(elastic_search, 'bibframe'),
+                         'bibframe_v1')
+        self.assertEqual(elastic_search.aliases['bibframe'], ['bibframe_v1'])
+
+    def test_count_mismatch(self):
+        elastic_search = AliasElasticsearch(DOCUMENTS, 'bibframe_v1',
+                                            alias='bibframe')
+        elastic_search.dropped = 1
+        self.assertRaises(IOError, reindex.reindex, elastic_search,
+                          'bibframe')
+        self.assertEqual(elastic_search.alias_updates, [])
+        self.assertEqual(elastic_search.aliases['bibframe'], ['bibframe_v1'])
+
+    def test_migrate(self):
+        elastic_search = AliasElasticsearch(DOCUMENTS)
+        self.assertRaises(ValueError, reindex.reindex, elastic_search,
+                          'bibframe')
+        report = reindex.reindex(elastic_search, 'bibframe', migrate=True)
+        self.assertEqual(report['target'], 'bibframe_v1')
+        self.assertEqual(report['source'], 'bibframe_v0')
+        self.assertNotIn('bibframe', elastic_search.documents)
+        self.assertEqual(elastic_search.aliases['bibframe'], ['bibframe_v1'])
+
+    def test_migrate_rollback(self):
+        elastic_search = AliasElasticsearch(DOCUMENTS)
+        body = {"settings": {"index": {"number_of_shards": "1"}},
+                "mappings": {"Work": {"properties": {}}}}
+        reindex.reindex(elastic_search, 'bibframe', body=body, migrate=True)
+        # The original index is kept unchanged as version 0
+        self.assertEqual(elastic_search.documents['bibframe_v0'], DOCUMENTS)
+        self.assertEqual(elastic_search.mappings['bibframe_v0'], MAPPINGS)
+        self.assertEqual(reindex.rollback(elastic_search, 'bibframe'),
+                         'bibframe_v0')
+        self.assertEqual(elastic_search.aliases['bibframe'], ['bibframe_v0'])
+
+    def test_migrate_failure(self):
+        elastic_search = AliasElasticsearch(DOCUMENTS)
+        # The copy into the new version succeeds, the one kept for
+        # rollback loses a document
+        copy_documents = reindex.copy_documents
+        def lossy(source, target, **kwargs):
+            if target == 'bibframe_v0':
+                elastic_search.dropped = 1
+            return copy_documents(source, target, **kwargs)
+        with mock.patch.object(reindex, 'copy_documents', lossy):
+            self.assertRaises(IOError, reindex.reindex, elastic_search,
+                              'bibframe', migrate=True)
+        self.assertEqual(elastic_search.documents['bibframe'], DOCUMENTS)
+        self.assertEqual(elastic_search.aliases, {})
+
+    def test_prune(self):
+        elastic_search = AliasElasticsearch(DOCUMENTS, 'bibframe_v1',
+                                            alias='bibframe')
+        reindex.reindex(elastic_search, 'bibframe')
+        reindex.reindex(elastic_search, 'bibframe')
+        self.assertEqual(reindex.prune(1, elastic_search, 'bibframe'),
+                         ['bibframe_v1'])
+        self.assertEqual(
+            [row['index'] for row in
+             reindex.status(elastic_search, 'bibframe')['versions']],
+            ['bibframe_v2', 'bibframe_v3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,7 @@
+"""Configuration used by the catalog tests, loaded with the
+BIBCAT_SETTINGS environmental variable"""
+SECRET_KEY = "bibcat-tests"
+ELASTIC_SEARCH = "localhost:9200"
+KIBANA_URL = "localhost:5601"
+TESTING = True
+WTF_CSRF_ENABLED = False
@@ -0,0 +1,126 @@
+import copy
+import os
+import sys
+import unittest
+from unittest import mock
+
+TEST_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+os.environ.setdefault('BIBCAT_SETTINGS',
+                      os.path.join(TEST_DIRECTORY, 'settings.py'))
+try:
+    import catalog
+except ImportError:
+    sys.path.append(os.path.dirname(TEST_DIRECTORY))
+    import catalog
+import catalog.suggest as suggest
+
+
+class ScanElasticsearch(object):
+    """Stand-in for the Elastic Search client that scrolls through
+    documents by type, with range queries on a modified timestamp"""
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    def search(self, body, scroll, index, doc_type, search_type):
+        doc_types = doc_type.split(",")
+        since = body['query'].get('range', {}).get('modified', {}).get('gte')
+        hits = []
+        for uuid, (type_, modified, source) in sorted(self.documents.items()):
+            if not type_ in doc_types:
+                continue
+            if since is not None and modified < since:
+                continue
+            hit = {"_id": uuid, "_type": type_}
+            if body.get('_source', True):
+                hit['_source'] = copy.deepcopy(source)
+            hits.append(hit)
+        self.pages = [hits]
+        return {"_scroll_id": "0"}
+
+    def scroll(self, scroll_id, scroll):
+        page = self.pages.pop(0) if len(self.pages) > 0 else []
+        return {"_scroll_id": "1",
+                "_shards": {"failed": 0, "total": 1},
+                "hits": {"hits": page}}
+
+
+def __work__(label, modified=0, *labels):
+    return ('Work', modified,
+            {'work_suggest': {'input': [label] + list(labels)}})
+
+def __person__(label, modified=0):
+    return ('Person', modified, {'bf:label': [label]})
+
+
+class PrefixIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.elastic_search = ScanElasticsearch({
+            'w1': __work__('Russell Crowe : the biography', 0,
+                           'Russell Crowe biography'),
+            'w2': __work__('Russian grammar'),
+            'w3': __work__('Rust in action'),
+            'w4': __work__('Ruins of Rome'),
+            'p1': __person__('Russell, Bertrand')})
+        self.index = suggest.PrefixIndex(self.elastic_search, 'bibframe')
+        self.index.build()
+
+    def test_prefix(self):
+        matches = self.index.suggest('Russ', ['work', 'person'])
+        self.assertEqual(sorted(uuid for label, uuid in matches['work']),
+                         ['w1', 'w2'])
+        self.assertEqual(matches['person'], [('Russell, Bertrand', 'p1')])
+        # Punctuation and case are normalized away
+        self.assertEqual(self.index.suggest('russell crowe: the', ['work']),
+                         {'work': [('Russell Crowe : the biography', 'w1')]})
+        self.assertEqual(self.index.suggest('', ['work']), {'work': []})
+        self.assertEqual(self.index.suggest('Zebra', ['work']), {'work': []})
+
+    def test_size(self):
+        matches = self.index.suggest('ru', ['work', 'person', 'topic'],
+                                     size=2)
+        self.assertEqual(len(matches['work']), 2)
+        self.assertEqual(len(matches['person']), 1)
+        self.assertEqual(matches['topic'], [])
+
+    def test_dedup(self):
+        # w1 has two labels starting with the prefix but is suggested once
+        matches = self.index.suggest('russell', ['work'])
+        self.assertEqual([uuid for label, uuid in matches['work']], ['w1'])
+
+    def test_refresh(self):
+        documents = self.elastic_search.documents
+        documents['w5'] = __work__('Rugby rules', 10)
+        documents['w2'] = __work__('Grammar of Russian', 10)
+        del documents['w3']
+        self.index.last_refresh = 0.005
+        with mock.patch.dict(catalog.app.config,
+                             {'TYPEAHEAD_INDEX_TIMESTAMP': 'modified'}):
+            with mock.patch.object(self.elastic_search, 'search',
+                                   wraps=self.elastic_search.search) as search:
+                self.index.refresh()
+        # Only the documents changed since the last refresh are read
+        self.assertEqual(search.call_count, 1)
+        self.assertEqual(search.call_args[1]['body']['query'],
+                         {'range': {'modified': {'gte': 5}}})
+        matches = self.index.suggest('ru', ['work'], size=10)
+        self.assertEqual(sorted(uuid for label, uuid in matches['work']),
+                         ['w1', 'w3', 'w4', 'w5'])
+        self.assertEqual(self.index.suggest('grammar', ['work']),
+                         {'work': [('Grammar of Russian', 'w2')]})
+
+    def test_rebuild(self):
+        del self.elastic_search.documents['w3']
+        self.index.last_build -= 61
+        with mock.patch.dict(catalog.app.config,
+                             {'TYPEAHEAD_INDEX_TIMESTAMP': 'modified',
+                              'TYPEAHEAD_INDEX_REBUILD': 60}):
+            self.index.refresh()
+        # Deleted documents are dropped by the periodic full rebuild
+        self.assertNotIn('w3', self.index.by_uuid)
+        self.assertEqual(self.index.suggest('rust', ['work']),
+                         {'work': []})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,224 @@
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+TEST_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+os.environ.setdefault('BIBCAT_SETTINGS',
+                      os.path.join(TEST_DIRECTORY, 'settings.py'))
+try:
+    import catalog
+except ImportError:
+    sys.path.append(os.path.dirname(TEST_DIRECTORY))
+    import catalog
+import catalog.sync as sync
+from catalog.datastore import LocalDatastore
+from tests.ingest import BulkElasticsearch
+
+REPOSITORY_TURTLE = """@prefix bf: <http://bibframe.org/vocab/> .
+@prefix fedora: <http://fedora.info/definitions/v4/repository#> .
+@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .
+
+<http://localhost:8080/rest/work> a bf:Work ;
+    fedora:uuid "0b7c8f0e-3b9e-4c7a-9d55-6a2f1c0e9a01" ;
+    fedora:lastModified "2015-08-01T10:00:00Z"^^xsd:dateTime ;
+    bf:authorizedAccessPoint "Howden, Martin. Russell Crowe" ;
+    bf:creator <http://localhost:8080/rest/person> .
+
+<http://localhost:8080/rest/person> a bf:Person ;
+    fedora:uuid "a1b2c3d4-e5f6-4a7b-8c9d-0e1f2a3b4c03" ;
+    fedora:lastModified "2015-08-02T10:00:00Z"^^xsd:dateTime ;
+    bf:label "Howden, Martin." .
+"""
+BULK_TURTLE = """@prefix bf: <http://bibframe.org/vocab/> .
+@prefix fedora: <http://fedora.info/definitions/v4/repository#> .
+@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .
+""" + "".join(["""
+<http://localhost:8080/rest/bulk{0}> a bf:Person ;
+    fedora:uuid "uuid-{0}" ;
+    fedora:lastModified "2015-08-03T10:00:00Z"^^xsd:dateTime ;
+    bf:label "Person {0}" .
+""".format(i) for i in range(3)]) + """
+<http://localhost:8080/rest/bulk3> a bf:Person ;
+    fedora:uuid "uuid-3" ;
+    fedora:lastModified "2015-08-02T10:00:00Z"^^xsd:dateTime ;
+    bf:label "Person 3" .
+"""
+WORK_URL = 'http://localhost:8080/rest/work'
+PERSON_URL = 'http://localhost:8080/rest/person'
+
+
+class SearchElasticsearch(BulkElasticsearch):
+    """BulkElasticsearch that finds no indexed documents"""
+
+    def search(self, index=None, body=None, **params):
+        return {'hits': {'total': 0, 'hits': []}}
+
+
+class IndexedElasticsearch(BulkElasticsearch):
+    """BulkElasticsearch that finds indexed documents by
+    fedora:hasLocation and records its searches"""
+
+    def __init__(self, hits):
+        super(IndexedElasticsearch, self).__init__()
+        self.hits = hits
+        self.searches = []
+
+    def search(self, index=None, body=None, **params):
+        self.searches.append(body)
+        urls = body['query']['filtered']['filter'].get(
+            'terms', {}).get('fedora:hasLocation', [])
+        hits = [hit for hit in self.hits
+                if hit['_source']['fedora:hasLocation'][0] in urls]
+        return {'hits': {'total': len(hits), 'hits': hits}}
+
+
+class SyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(self.directory.name, 'repository.ttl')
+        with open(path, 'w') as turtle:
+            turtle.write(REPOSITORY_TURTLE)
+        self.datastore = LocalDatastore([path])
+        self.state = sync.SyncState(
+            os.path.join(self.directory.name, 'sync.json'))
+
+    def test_resource_document(self):
+        doc_id, doc_type, source = sync.resource_document(WORK_URL,
+                                                          self.datastore)
+        self.assertEqual(doc_id, '0b7c8f0e-3b9e-4c7a-9d55-6a2f1c0e9a01')
+        self.assertEqual(doc_type, 'Work')
+        self.assertEqual(source['bf:creator'],
+                         ['a1b2c3d4-e5f6-4a7b-8c9d-0e1f2a3b4c03'])
+        self.assertEqual(source['fedora:hasLocation'], [WORK_URL])
+        self.assertIsNone(sync.resource_document(
+            'http://localhost:8080/rest/missing', self.datastore))
+
+    def test_polling_feed(self):
+        feed = sync.PollingFeed(self.datastore)
+        changes = feed.changes(None, 10)
+        self.assertEqual([change.url for change in changes],
+                         [WORK_URL, PERSON_URL])
+        changes = feed.changes('2015-08-02T00:00:00Z', 10)
+        self.assertEqual([change.url for change in changes], [PERSON_URL])
+
+    def test_event_feed(self):
+        events = io.StringIO("\n".join([
+            json.dumps({"org.fcrepo.jms.identifier": "/rest/work",
+                        "org.fcrepo.jms.baseURL": "http://localhost:8080",
+                        "org.fcrepo.jms.eventType": "NODE_REMOVED,"
+                                                    "ResourceDeletion",
+                        "org.fcrepo.jms.timestamp": 1438423200000}),
+            "not json"]))
+        with self.assertLogs('catalog.sync', 'WARNING'):
+            changes = sync.EventFeed(events).changes(None, 10)
+        self.assertEqual(len(changes), 1)
+        self.assertEqual(changes[0].url, WORK_URL)
+        self.assertTrue(changes[0].deleted)
+        self.assertEqual(changes[0].modified, '2015-08-01T10:00:00.000000Z')
+
+    def test_run_once(self):
+        elastic_search = SearchElasticsearch()
+        worker = sync.SyncWorker(sync.PollingFeed(self.datastore),
+                                 self.state,
+                                 elastic_search=elastic_search,
+                                 denormalize=False,
+                                 datastore=self.datastore)
+        self.assertEqual(worker.run_once(), 2)
+        self.assertEqual(len(elastic_search.actions), 2)
+        self.assertEqual(self.state.seen, [PERSON_URL])
+        self.assertEqual(self.state.indexed, 2)
+        # The change at the high-water mark is not applied twice
+        self.assertEqual(worker.run_once(), 0)
+        restarted = sync.SyncState(self.state.path).load()
+        self.assertEqual(restarted.mark, self.state.mark)
+        self.assertEqual(restarted.seen, [PERSON_URL])
+
+    def test_page_queries(self):
+        elastic_search = IndexedElasticsearch([])
+        query = mock.Mock(wraps=self.datastore.query)
+        datastore = mock.Mock(query=query)
+        worker = sync.SyncWorker(sync.PollingFeed(datastore),
+                                 self.state,
+                                 elastic_search=elastic_search,
+                                 denormalize=False,
+                                 datastore=datastore)
+        with mock.patch.object(sync, 'dependents', return_value=set()):
+            self.assertEqual(worker.run_once(), 2)
+        # One search for the indexed documents of the page, one SPARQL
+        # query for the changes and one for the resources
+        self.assertEqual(len(elastic_search.searches), 1)
+        self.assertEqual(sorted(elastic_search.searches[0]['query'][
+            'filtered']['filter']['terms']['fedora:hasLocation']),
+                         [PERSON_URL, WORK_URL])
+        self.assertEqual(query.call_count, 2)
+        self.assertEqual(len(elastic_search.actions), 2)
+
+    def test_changed_uuid(self):
+        # The Work was indexed under an earlier fedora:uuid
+        elastic_search = IndexedElasticsearch([
+            {'_id': 'old-uuid', '_type': 'Work',
+             '_source': {'fedora:hasLocation': [WORK_URL]}}])
+        worker = sync.SyncWorker(sync.PollingFeed(self.datastore),
+                                 self.state,
+                                 elastic_search=elastic_search,
+                                 denormalize=False,
+                                 datastore=self.datastore)
+        with mock.patch.object(sync, 'dependents', return_value=set()), \
+             mock.patch.object(sync, 'bulk',
+                               return_value=(3, [])) as bulk:
+            worker.run_once()
+        actions = bulk.call_args[0][1]
+        self.assertIn({'_op_type': 'delete', '_index': 'bibframe',
+                       '_type': 'Work', '_id': 'old-uuid'}, actions)
+        self.assertIn('0b7c8f0e-3b9e-4c7a-9d55-6a2f1c0e9a01',
+                      [action['_id'] for action in actions
+                       if not '_op_type' in action])
+
+    def test_same_timestamp(self):
+        # More resources than the batch size share the mark's timestamp,
+        # as after a bulk load
+        path = os.path.join(self.directory.name, 'bulk.ttl')
+        with open(path, 'w') as turtle:
+            turtle.write(BULK_TURTLE)
+        datastore = LocalDatastore([path])
+        elastic_search = SearchElasticsearch()
+        worker = sync.SyncWorker(sync.PollingFeed(datastore),
+                                 self.state,
+                                 elastic_search=elastic_search,
+                                 batch_size=2,
+                                 denormalize=False,
+                                 datastore=datastore)
+        worker.run(once=True)
+        self.assertEqual(self.state.indexed, 4)
+        self.assertEqual(
+            sorted(action['index']['_id']
+                   for action, source in elastic_search.actions),
+            ['uuid-0', 'uuid-1', 'uuid-2', 'uuid-3'])
+        self.assertEqual(sync.parse_time(self.state.mark),
+                         sync.parse_time('2015-08-03T10:00:00Z'))
+        self.assertEqual(len(self.state.seen), 3)
+        self.assertEqual(worker.run_once(), 0)
+
+    def test_parse_time(self):
+        self.assertEqual(sync.parse_time('2015-08-01T10:00:00Z'),
+                         1438423200.0)
+        self.assertEqual(sync.parse_time('2015-08-01T12:00:00.5+02:00'),
+                         1438423200.5)
+        self.assertEqual(sync.parse_time('2015-08-01T10:00:00'),
+                         1438423200.0)
+        self.assertEqual(sync.parse_time(1438423200000), 1438423200.0)
+        self.assertEqual(sync.parse_time(sync.format_time(1438423200.25)),
+                         1438423200.25)
+        self.assertRaises(ValueError, sync.parse_time, 'yesterday')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+
+if __name__ == '__main__':
+    unittest.main()
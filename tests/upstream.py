@@ -0,0 +1,140 @@
+import os
+import sys
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import requests
+
+TEST_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+os.environ.setdefault('BIBCAT_SETTINGS',
+                      os.path.join(TEST_DIRECTORY, 'settings.py'))
+try:
+    import catalog
+except ImportError:
+    sys.path.append(os.path.dirname(TEST_DIRECTORY))
+    import catalog
+import catalog.upstream as upstream
+
+
+class Clock(object):
+    """Clock that only moves when the test advances it"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class UnavailableHandler(BaseHTTPRequestHandler):
+    """Answers every request with a 503 and counts them by method"""
+    requests = []
+
+    def __respond__(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        UnavailableHandler.requests.append(self.command)
+        self.send_response(503)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_GET = __respond__
+    do_POST = __respond__
+
+    def log_message(self, *args):
+        pass
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.breaker = upstream.CircuitBreaker(max_failures=3,
+                                               reset_timeout=30,
+                                               clock=self.clock)
+
+    def test_opens_after_max_failures(self):
+        for i in range(2):
+            self.breaker.failure()
+            self.assertTrue(self.breaker.allow())
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, "open")
+        self.assertFalse(self.breaker.allow())
+        self.clock.now += 29
+        self.assertFalse(self.breaker.allow())
+
+    def test_success_resets_failures(self):
+        self.breaker.failure()
+        self.breaker.failure()
+        self.breaker.success()
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, "closed")
+
+    def test_half_open(self):
+        for i in range(3):
+            self.breaker.failure()
+        self.clock.now += 30
+        # A single trial request is let through
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, "half-open")
+        self.assertFalse(self.breaker.allow())
+        # and closes the circuit if it succeeds
+        self.breaker.success()
+        self.assertEqual(self.breaker.state, "closed")
+        self.assertTrue(self.breaker.allow())
+
+    def test_half_open_failure(self):
+        for i in range(3):
+            self.breaker.failure()
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, "open")
+        self.clock.now += 10
+        self.assertFalse(self.breaker.allow())
+        self.clock.now += 20
+        self.assertTrue(self.breaker.allow())
+
+
+class UpstreamClientTest(unittest.TestCase):
+
+    def setUp(self):
+        UnavailableHandler.requests = []
+        self.server = HTTPServer(('127.0.0.1', 0), UnavailableHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.client = upstream.UpstreamClient(
+            "127.0.0.1:{}".format(self.server.server_port),
+            retries=2,
+            backoff=0,
+            max_failures=2)
+
+    def test_retries(self):
+        # GETs are retried on a 503, POSTs are sent once because a SPARQL
+        # update may already have been applied
+        self.assertEqual(self.client.get('/').status_code, 503)
+        self.assertEqual(UnavailableHandler.requests, ['GET'] * 3)
+        UnavailableHandler.requests = []
+        self.assertEqual(
+            self.client.post('/triplestore', data={'sparql': 'x'}).status_code,
+            503)
+        self.assertEqual(UnavailableHandler.requests, ['POST'])
+
+    def test_circuit_opens(self):
+        self.client.get('/')
+        self.client.get('/')
+        UnavailableHandler.requests = []
+        self.assertRaises(upstream.UpstreamUnavailable, self.client.get, '/')
+        self.assertTrue(issubclass(upstream.UpstreamUnavailable,
+                                   requests.exceptions.ConnectionError))
+        self.assertEqual(UnavailableHandler.requests, [])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
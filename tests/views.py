@@ -0,0 +1,743 @@
+import copy
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import rdflib
+from elasticsearch.exceptions import ConnectionError, NotFoundError
+from flask import g, render_template_string
+
+TEST_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+os.environ.setdefault('BIBCAT_SETTINGS',
+                      os.path.join(TEST_DIRECTORY, 'settings.py'))
+try:
+    import catalog
+except ImportError:
+    sys.path.append(os.path.dirname(TEST_DIRECTORY))
+    import catalog
+import catalog.cache
+import catalog.denormalize
+import catalog.ingest
+import catalog.marc
+import catalog.metrics
+import catalog.slowlog
+import catalog.suggest
+import catalog.upstream
+from tests.marc import RECORDS
+
+WORK_UUID = '0b7c8f0e-3b9e-4c7a-9d55-6a2f1c0e9a01'
+INSTANCE_UUID = '6f1d2c3b-4a5e-4f60-8b71-9c8d7e6f5a02'
+PERSON_UUID = 'a1b2c3d4-e5f6-4a7b-8c9d-0e1f2a3b4c03'
+COVER_UUID = 'c0ffee00-1234-4abc-8def-0123456789ab'
+
+DOCUMENTS = {
+    WORK_UUID: ('Work', {
+        'type': ['bf:Work'],
+        'fedora:uuid': [WORK_UUID],
+        'bf:authorizedAccessPoint': ['Howden, Martin. Russell Crowe'],
+        'bf:creator': [PERSON_UUID]}),
+    INSTANCE_UUID: ('Instance', {
+        'type': ['bf:Instance'],
+        'fedora:uuid': [INSTANCE_UUID],
+        'bf:titleStatement': ['Russell Crowe : the biography'],
+        'bf:instanceOf': [WORK_UUID]}),
+    PERSON_UUID: ('Person', {
+        'type': ['bf:Person'],
+        'fedora:uuid': [PERSON_UUID],
+        'bf:label': ['Howden, Martin.']}),
+    COVER_UUID: ('CoverArt', {
+        'bf:coverArt': ['R0lGODlhAQABAAAAACw='],
+        'bf:coverArtFor': [INSTANCE_UUID]})
+}
+
+
+class CountingElasticsearch(object):
+    """Stand-in for the Elastic Search client that records every call"""
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.calls = []
+
+    def __doc__(self, uuid, fields=None, _source=True):
+        doc_type, source = self.documents[uuid]
+        doc = {'_id': uuid, '_type': doc_type, '_version': 1, 'found': True}
+        if fields is not None:
+            doc['fields'] = dict([(field, source[field]) for field in fields
+                                  if field in source])
+        if _source is not False:
+            # Views edit the _source they are given, i.e. /itemDetails
+            doc['_source'] = copy.deepcopy(source)
+        return doc
+
+    def get(self, index, id, doc_type='_all', fields=None, _source=True):
+        self.calls.append('get')
+        if not id in self.documents or \
+           doc_type not in ('_all', self.documents[id][0]):
+            raise NotFoundError(404, 'not found')
+        return self.__doc__(id, fields, _source)
+
+    def mget(self, body, index=None, _source_include=None, **params):
+        self.calls.append('mget')
+        docs = []
+        for uuid in body['ids']:
+            if not uuid in self.documents:
+                docs.append({'_id': uuid, 'found': False})
+                continue
+            doc = self.__doc__(uuid)
+            if _source_include is not None:
+                doc['_source'] = dict([(key, value) 
+                    for key, value in doc['_source'].items()
+                    if key in _source_include])
+            docs.append(doc)
+        return {'docs': docs}
+
+    def search(self, body=None, index=None, **params):
+        self.calls.append('search')
+        if 'scroll' in params:
+            return self.__scan__(params)
+        result = {'hits': {'total': 0, 'hits': []}}
+        if 'aggs' in body:
+            result['aggregations'] = dict([(name, {'buckets': []})
+                                           for name in body['aggs']])
+        return result
+
+    def __scan__(self, params):
+        """Pages through every document, the first page is empty for
+        search_type=scan like Elastic Search 1.x"""
+        hits = [self.__doc__(uuid) for uuid in sorted(self.documents)]
+        size = params.get('size', 10)
+        self.pages = [hits[i:i + size] for i in range(0, len(hits), size)]
+        first = [] if params.get('search_type') == 'scan' else \
+            self.pages.pop(0)
+        return {'_scroll_id': '0',
+                '_shards': {'failed': 0, 'total': 1},
+                'hits': {'total': len(hits), 'hits': first}}
+
+    def scroll(self, scroll_id, scroll):
+        self.calls.append('scroll')
+        page = self.pages.pop(0) if len(self.pages) > 0 else []
+        return {'_scroll_id': scroll_id,
+                '_shards': {'failed': 0, 'total': 1},
+                'hits': {'hits': page}}
+
+    def suggest(self, body, index=None, **params):
+        self.calls.append('suggest')
+        output = dict()
+        for name, suggester in body.items():
+            field = suggester['completion']['field']
+            options = [{'text': source['bf:label'][0],
+                        'payload': {'id': uuid}}
+                       for uuid, (doc_type, source) in
+                       sorted(self.documents.items())
+                       if field == '{}_suggest'.format(doc_type.lower())
+                       and 'bf:label' in source]
+            output[name] = [{'text': suggester['text'],
+                             'options': options}]
+        return output
+
+    def msearch(self, body, index=None, **params):
+        self.calls.append('msearch')
+        return {'responses': [{'hits': {'total': 0, 'hits': []}}
+                              for header in body[::2]]}
+
+
+class ElasticSearchCallsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.es = CountingElasticsearch(DOCUMENTS)
+        for module in [catalog, catalog.cache, catalog.filters,
+                       catalog.util, catalog.views]:
+            patcher = mock.patch.object(module, 'es_search', self.es)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        catalog.cache.label_cache.clear()
+        self.app = catalog.app.test_client()
+
+    def test_classcount(self):
+        catalog.views.class_counts.value = None
+        for i in range(2):
+            response = self.app.get('/classcount')
+            self.assertEqual(response.status_code, 200)
+        result = response.get_json()
+        for name in ['bfAuthSum', 'bfMajorSum', 'bfTypeSum']:
+            self.assertEqual(result[name]['aggregations']['2']['buckets'], [])
+        self.assertEqual(self.es.calls, ['search'])
+
+    def test_cover(self):
+        response = self.app.get('/CoverArt/{}.jpg'.format(COVER_UUID))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.es.calls, ['get'])
+
+    def test_detail_json(self):
+        response = self.app.get('/Work/{}.json'.format(WORK_UUID))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['bf:creator'], [PERSON_UUID])
+        self.assertEqual(self.es.calls, ['get'])
+
+    def test_detail_missing(self):
+        response = self.app.get('/Instance/{}.json'.format(WORK_UUID))
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.es.calls, ['get'])
+
+    def test_detail_redirect(self):
+        response = self.app.get('/{}'.format(WORK_UUID))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.es.calls, ['get'])
+
+    def test_instance_detail(self):
+        response = self.app.get('/Instance/{}'.format(INSTANCE_UUID))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Howden, Martin.', response.data)
+        # Instance, its Work and the Work's creators, cover art and
+        # held items
+        self.assertEqual(
+            sorted(self.es.calls),
+            ['get', 'mget', 'mget', 'search', 'search'])
+
+    def test_entities_batch(self):
+        response = self.app.post(
+            '/entities/batch',
+            data=json.dumps({"uuids": [WORK_UUID, PERSON_UUID, 'missing'],
+                             "fields": ['bf:label']}),
+            content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        result = response.get_json()
+        self.assertEqual(result['entities'][PERSON_UUID],
+                         {'bf:label': ['Howden, Martin.']})
+        self.assertEqual(result['entities'][WORK_UUID], {})
+        self.assertEqual(result['missing'], ['missing'])
+        self.assertEqual(self.es.calls, ['mget'])
+
+    def test_entities_batch_limit(self):
+        uuids = [WORK_UUID] * (catalog.app.config.get(
+            'BATCH_MAX_ENTITIES', 100) + 1)
+        response = self.app.post(
+            '/entities/batch',
+            data=json.dumps({"uuids": uuids}),
+            content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.es.calls, [])
+
+    def test_entities_batch_invalid(self):
+        for body in [[WORK_UUID],
+                     {"uuids": "abc"},
+                     {"uuids": [WORK_UUID, 1]},
+                     {"uuids": [WORK_UUID], "fields": "bf:label"},
+                     {"uuids": [WORK_UUID], "fields": [None]}]:
+            response = self.app.post(
+                '/entities/batch',
+                data=json.dumps(body),
+                content_type='application/json')
+            self.assertEqual(response.status_code, 400, body)
+            self.assertEqual(response.get_json()['message'], 'error')
+        self.assertEqual(self.es.calls, [])
+
+    def test_search_cursor(self):
+        catalog.app.config['SEARCH_CURSOR'] = True
+        self.addCleanup(catalog.app.config.pop, 'SEARCH_CURSOR')
+        response = self.app.post('/search', data={'phrase': 'Crowe',
+                                                  'filter': 'Agents',
+                                                  'cursor': ''})
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.get_json()['next'])
+        for cursor in ['not a cursor', 'e30=', '%%%']:
+            response = self.app.post('/search', data={'phrase': 'Crowe',
+                                                      'cursor': cursor})
+            self.assertEqual(response.status_code, 400, cursor)
+            self.assertEqual(response.get_json()['message'], 'error')
+        self.assertEqual(self.es.calls, ['search'])
+
+    def __login__(self):
+        with self.app.session_transaction() as session:
+            session['username'] = 'staff'
+
+    def test_export_protected(self):
+        self.assertEqual(self.app.get('/export?phrase=Crowe').status_code,
+                         403)
+        self.__login__()
+        response = self.app.get('/export')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['message'], 'error')
+        self.assertEqual(self.es.calls, [])
+
+    def test_export_failure(self):
+        self.__login__()
+        with mock.patch.object(self.es, 'search',
+                               side_effect=ConnectionError('N/A', 'down', None)):
+            response = self.app.get('/export?phrase=Crowe')
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(response.get_json()['message'], 'error')
+
+    def test_export_ndjson(self):
+        catalog.app.config['EXPORT_SCROLL_SIZE'] = 3
+        self.addCleanup(catalog.app.config.pop, 'EXPORT_SCROLL_SIZE')
+        self.__login__()
+        response = self.app.get('/export?phrase=Crowe')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content_type, 'application/x-ndjson')
+        rows = [json.loads(line) for line in
+                response.get_data(as_text=True).splitlines()]
+        self.assertEqual([row['_id'] for row in rows], sorted(DOCUMENTS))
+        self.assertEqual(rows[0]['_source'], DOCUMENTS[rows[0]['_id']][1])
+        # Four documents in pages of three
+        self.assertEqual(self.es.calls,
+                         ['search', 'scroll', 'scroll', 'scroll'])
+
+    def test_export_jsonld(self):
+        catalog.app.config['EXPORT_SCROLL_SIZE'] = 3
+        self.addCleanup(catalog.app.config.pop, 'EXPORT_SCROLL_SIZE')
+        self.__login__()
+        response = self.app.post('/export', data={'phrase': 'Crowe',
+                                                  'sort': 'a-z',
+                                                  'format': 'jsonld'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content_type, 'application/ld+json')
+        graph = json.loads(response.get_data(as_text=True))
+        self.assertIn('@context', graph)
+        self.assertEqual(sorted(node['@id'] for node in graph['@graph']),
+                         sorted('urn:uuid:{}'.format(uuid)
+                                for uuid in DOCUMENTS))
+        self.assertEqual(self.es.calls, ['search', 'scroll', 'scroll'])
+
+    def test_item_details(self):
+        response = self.app.get('/itemDetails?uuid={}&type=Work'.format(
+            WORK_UUID))
+        self.assertEqual(response.status_code, 200)
+        lookup = response.get_json()['_source']['bf:creator']['lookup']
+        self.assertEqual(lookup[0]['bf:label'], ['Howden, Martin.'])
+        self.assertEqual(self.es.calls, ['get', 'mget', 'msearch'])
+        related = response.get_json()['_z_relatedItems']
+        self.assertEqual(related['rel_instances'], [])
+        self.assertEqual(related['rel_instances_total'], 0)
+
+    def test_display_fields(self):
+        doc_type, source = DOCUMENTS[INSTANCE_UUID]
+        fields = catalog.denormalize.display_fields(
+            [(INSTANCE_UUID, doc_type, source)], self.es)
+        self.assertEqual(fields[INSTANCE_UUID]['display_title'],
+                         'Russell Crowe : the biography')
+        self.assertEqual(fields[INSTANCE_UUID]['display_creators'],
+                         ['Howden, Martin.'])
+        self.assertEqual(fields[INSTANCE_UUID]['holdings_summary']['count'],
+                         0)
+        # The Work, then its title and creators, then cover art and held
+        # items
+        self.assertEqual(self.es.calls, ['mget', 'mget', 'msearch'])
+
+    def test_display_fields_work(self):
+        # A Work shows the cover art and held items of its Instances
+        def msearch(body, **params):
+            self.es.calls.append('msearch')
+            self.assertEqual(body[1]['query']['filtered']['filter'],
+                             [{'terms': {'bf:coverArtFor': [INSTANCE_UUID]}}])
+            return {'responses': [
+                {'hits': {'total': 1, 'hits': [{'_id': COVER_UUID}]}},
+                {'hits': {'total': 1, 'hits': [
+                    {'fields': {'bf:itemId': ['0001']}}]}}]}
+        instances = [{'_id': INSTANCE_UUID,
+                      'fields': {'bf:instanceOf': [WORK_UUID]}}]
+        doc_type, source = DOCUMENTS[WORK_UUID]
+        with mock.patch.object(catalog.denormalize, 'scan',
+                               return_value=instances), \
+             mock.patch.object(self.es, 'msearch', msearch):
+            fields = catalog.denormalize.display_fields(
+                [(WORK_UUID, doc_type, source)], self.es)
+        self.assertEqual(fields[WORK_UUID]['display_title'],
+                         'Howden, Martin. Russell Crowe')
+        self.assertEqual(fields[WORK_UUID]['cover_id'], COVER_UUID)
+        self.assertEqual(fields[WORK_UUID]['holdings_summary']['count'], 1)
+        self.assertEqual(
+            fields[WORK_UUID]['holdings_summary']['available'], 1)
+
+    def test_dependents(self):
+        doc_type, source = DOCUMENTS[COVER_UUID]
+        with mock.patch.object(catalog.denormalize, 'scan',
+                               return_value=[]):
+            stale = catalog.denormalize.dependents(COVER_UUID, doc_type,
+                                                   source, self.es)
+        self.assertEqual(stale, set([INSTANCE_UUID, WORK_UUID]))
+
+    def test_search_expanded(self):
+        # Hits without display fields are expanded together, so the
+        # number of Elastic Search calls does not grow with the page size
+        def search(hits):
+            def answer(*args, **kwargs):
+                self.es.calls.append('search')
+                return {'hits': {'total': len(hits), 'hits': hits}}
+            return answer
+        for size in [1, 5]:
+            self.es.calls = []
+            hits = [{'_id': '{}-{}'.format(INSTANCE_UUID, i),
+                     '_type': 'Instance',
+                     '_source': dict(DOCUMENTS[INSTANCE_UUID][1],
+                                     **{'fedora:uuid': [
+                                         '{}-{}'.format(INSTANCE_UUID, i)]})}
+                    for i in range(size)]
+            catalog.cache.label_cache.clear()
+            with mock.patch.object(self.es, 'search', search(hits)):
+                response = self.app.post('/search', data={'phrase': 'crowe'})
+            result = response.get_json()
+            self.assertEqual(len(result['hits']), size)
+            self.assertEqual(result['hits'][-1]['creators'],
+                             'Howden, Martin.')
+            # The search, Works, creator labels and one msearch for the
+            # cover art and held items of every hit
+            self.assertEqual(self.es.calls,
+                             ['search', 'mget', 'mget', 'msearch'])
+
+    def test_search_denormalized(self):
+        source = dict(DOCUMENTS[INSTANCE_UUID][1],
+                      display_title='Russell Crowe : the biography',
+                      display_creators=['Howden, Martin.'],
+                      cover_id=COVER_UUID,
+                      holdings_summary={"count": 0, 
+                                        "available": 0, 
+                                        "items": []})
+        result = {'hits': {'total': 1, 'hits': [
+            {'_id': INSTANCE_UUID, '_type': 'Instance', '_source': source}]}}
+        with mock.patch.object(self.es, 'search', return_value=result):
+            response = self.app.post('/search', data={'phrase': 'crowe'})
+        hit = response.get_json()['hits'][0]
+        self.assertEqual(hit['title'], 'Russell Crowe : the biography')
+        self.assertEqual(hit['creators'], 'Howden, Martin.')
+        self.assertEqual(hit['cover']['src'],
+                         '/CoverArt/{}.jpg'.format(COVER_UUID))
+        self.assertEqual(hit['held_items'], [])
+        self.assertEqual(self.es.calls, [])
+
+    def tearDown(self):
+        pass
+
+
+WORK_TURTLE = """@prefix bf: <http://bibframe.org/vocab/> .
+
+<http://bibframe.org/resources/sample-lc-2/16736259> a bf:Work ;
+    bf:authorizedAccessPoint "Howden, Martin. Russell Crowe :the biography" ;
+    bf:creator <http://bibframe.org/resources/sample-lc-2/16736259person12> .
+
+<http://bibframe.org/resources/sample-lc-2/16736259person12> a bf:Person ;
+    bf:label "Howden, Martin." .
+"""
+
+
+class LoadedItemDetailsTest(unittest.TestCase):
+    """/itemDetails on the documents written by the bulk loaders, whose
+    ids are uuid5"""
+
+    def __load__(self, documents):
+        self.es = CountingElasticsearch(dict(
+            [(doc_id, (doc_type, source))
+             for doc_id, doc_type, source in documents]))
+        for module in [catalog, catalog.cache, catalog.filters,
+                       catalog.util, catalog.views]:
+            patcher = mock.patch.object(module, 'es_search', self.es)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        catalog.cache.label_cache.clear()
+        self.app = catalog.app.test_client()
+
+    def __creator_lookup__(self, work_id):
+        response = self.app.get('/itemDetails?uuid={}&type=Work'.format(
+            work_id))
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()['_source']['bf:creator']['lookup']
+
+    def test_ingested(self):
+        graph = rdflib.Graph().parse(data=WORK_TURTLE, format='turtle')
+        documents = [catalog.ingest.subject_document(graph, subject)
+                     for subject in set(graph.subjects())]
+        self.__load__(documents)
+        work_id = catalog.ingest.subject_uuid(rdflib.URIRef(
+            'http://bibframe.org/resources/sample-lc-2/16736259'))
+        lookup = self.__creator_lookup__(work_id)
+        self.assertEqual(lookup[0]['bf:label'], ['Howden, Martin.'])
+
+    def test_marc(self):
+        documents = catalog.marc.record_documents(RECORDS[0])
+        self.__load__([(doc_id, doc_type, source)
+                       for doc_id, doc_type, source, turtle in documents])
+        work_id = [doc_id for doc_id, doc_type, source, turtle in documents
+                   if doc_type == 'Work'][0]
+        lookup = self.__creator_lookup__(work_id)
+        # Trailing punctuation is cleaned from MARC headings
+        self.assertEqual(lookup[0]['bf:label'], ['Howden, Martin'])
+        self.assertEqual(lookup[0]['type'], ['bf:Person'])
+
+
+class UpstreamResponse(object):
+    """Stand-in for a streaming requests response"""
+
+    def __init__(self, status_code, body, content_type):
+        self.status_code = status_code
+        self.body = body
+        self.headers = {'Content-Type': content_type}
+        self.raw = self
+
+    def stream(self, chunk_size, decode_content=True):
+        yield self.body
+
+    def iter_content(self, chunk_size):
+        yield self.body
+
+
+class KibanaProxyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.kibana = mock.Mock()
+        self.kibana.get.return_value = UpstreamResponse(
+            200, b'console.log(1);', 'application/javascript')
+        cache = catalog.upstream.StaticCache(self.directory.name,
+                                             r'^bundles/')
+        for name, value in [('kibana', self.kibana),
+                            ('kibana_cache', cache)]:
+            patcher = mock.patch.object(catalog.upstream, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.app = catalog.app.test_client()
+        with self.app.session_transaction() as session:
+            session['username'] = 'staff'
+
+    def test_cache(self):
+        for i in range(2):
+            response = self.app.get('/reports/bundles/kibana.js')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data, b'console.log(1);')
+            self.assertEqual(response.mimetype, 'application/javascript')
+        # The miss is fetched once, the hit is served from disk
+        self.assertEqual(self.kibana.get.call_count, 1)
+        self.assertEqual(
+            [name for name in os.listdir(self.directory.name)
+             if name.endswith('.tmp')], [])
+
+    def test_not_cached(self):
+        self.kibana.get.return_value = UpstreamResponse(
+            200, b'<html></html>', 'text/html')
+        for i in range(2):
+            response = self.app.get('/reports/app/kibana')
+            self.assertEqual(response.data, b'<html></html>')
+        self.assertEqual(self.kibana.get.call_count, 2)
+
+    def test_upstream_failure(self):
+        self.kibana.get.side_effect = \
+            catalog.upstream.requests.exceptions.ReadTimeout('slow')
+        self.assertEqual(self.app.get('/reports/app/kibana').status_code,
+                         502)
+        self.kibana.get.side_effect = \
+            catalog.upstream.UpstreamUnavailable('open')
+        self.assertEqual(
+            self.app.get('/reports/bundles/kibana.js').status_code, 503)
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+
+class TypeaheadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.es = CountingElasticsearch(DOCUMENTS)
+        for module in [catalog, catalog.util, catalog.views]:
+            patcher = mock.patch.object(module, 'es_search', self.es)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.index = catalog.suggest.PrefixIndex(self.es, 'bibframe')
+        for module in [catalog.suggest, catalog.views]:
+            patcher = mock.patch.object(module, 'prefix_index', self.index)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.app = catalog.app.test_client()
+
+    def __ready__(self):
+        self.index.__swap__({
+            WORK_UUID: [('russell crowe', 'Russell Crowe', WORK_UUID,
+                         'work')],
+            PERSON_UUID: [('howden martin', 'Howden, Martin.', PERSON_UUID,
+                           'person')]})
+        self.index.ready = True
+
+    def test_all_types(self):
+        response = self.app.get('/typeahead?q=How&type=AllTypes')
+        result = json.loads(response.get_data(as_text=True))
+        self.assertEqual(sorted(result),
+                         ['agent', 'instance', 'topic', 'work'])
+        self.assertEqual(result['agent'],
+                         [{'agent': 'Howden, Martin.', 'uuid': PERSON_UUID}])
+        # One suggest request for every type
+        self.assertEqual(self.es.calls, ['suggest'])
+
+    def test_all_types_prefix_index(self):
+        self.__ready__()
+        response = self.app.get('/typeahead?q=How&type=AllTypes')
+        result = json.loads(response.get_data(as_text=True))
+        self.assertEqual(result['agent'],
+                         [{'agent': 'Howden, Martin.', 'uuid': PERSON_UUID}])
+        self.assertEqual(result['work'], [])
+        self.assertEqual(self.es.calls, [])
+
+    def test_type_prefix_index(self):
+        self.__ready__()
+        response = self.app.get('/typeahead?q=russell+c&type=Work')
+        self.assertEqual(json.loads(response.get_data(as_text=True)),
+                         [{'work': 'Russell Crowe', 'uuid': WORK_UUID}])
+        response = self.app.get('/typeahead?q=howden&type=Agent')
+        self.assertEqual(json.loads(response.get_data(as_text=True)),
+                         [{'agent': 'Howden, Martin.', 'uuid': PERSON_UUID}])
+        self.assertEqual(self.es.calls, [])
+
+    def test_type(self):
+        response = self.app.get('/typeahead?q=How&type=Person')
+        self.assertEqual(json.loads(response.get_data(as_text=True)),
+                         [{'person': 'Howden, Martin.', 'uuid': PERSON_UUID}])
+        self.assertEqual(self.es.calls, ['suggest'])
+
+
+class SearchDSLTest(unittest.TestCase):
+
+    def test_cursor_round_trip(self):
+        for values in [[1.5, 'Work#' + WORK_UUID],
+                       ['Crowe, Russell', 'Person#' + PERSON_UUID],
+                       [None, 'Instance#\u00e9']]:
+            cursor = catalog.util.__encode_cursor__(values)
+            self.assertNotIn('/', cursor)
+            self.assertEqual(catalog.util.__decode_cursor__(cursor), values)
+        for cursor in ['not a cursor', 'e30=', '']:
+            self.assertRaises(ValueError, catalog.util.__decode_cursor__,
+                              cursor)
+
+    def test_cursor_dsl(self):
+        def keys(value):
+            if isinstance(value, dict):
+                return set(value).union(*[keys(row)
+                                          for row in value.values()])
+            if isinstance(value, list):
+                return set().union(*[keys(row) for row in value])
+            return set()
+        for filter_ in ['works', 'instances', 'agents', 'topics']:
+            es_dsl = catalog.util.__search_dsl__('Crowe', filter_,
+                                                 'a-z', cursor=True)
+            self.assertFalse(keys(es_dsl) & set(['filtered', 'or']),
+                             filter_)
+            self.assertEqual(es_dsl['sort'][-1], {"_uid": {"order": "asc"}})
+        es_dsl = catalog.util.__search_dsl__('Crowe', 'agents', cursor=True)
+        self.assertEqual(
+            es_dsl['query']['bool']['filter']['bool']['should'],
+            [{"type": {"value": "Person"}},
+             {"type": {"value": "Organization"}}])
+        self.assertIn('filtered', catalog.util.__search_dsl__(
+            'Crowe', 'agents')['query'])
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.es = CountingElasticsearch(DOCUMENTS)
+        instrumented = catalog.metrics.InstrumentedClient(self.es, 'es')
+        for module in [catalog, catalog.cache, catalog.filters,
+                       catalog.util, catalog.views]:
+            patcher = mock.patch.object(module, 'es_search', instrumented)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for histogram in catalog.metrics.HISTOGRAMS:
+            histogram.clear()
+        self.app = catalog.app.test_client()
+
+    def test_server_timing(self):
+        response = self.app.get('/Work/{}.json'.format(WORK_UUID))
+        self.assertEqual(response.status_code, 200)
+        timing = response.headers['Server-Timing']
+        self.assertIn('es;dur=', timing)
+        self.assertIn('desc="1 calls"', timing)
+        self.assertIn('total;dur=', timing)
+
+    def test_nested_render(self):
+        def inner():
+            time.sleep(0.05)
+            return render_template_string("inner")
+        def wait():
+            time.sleep(0.05)
+            return ""
+        with catalog.app.test_request_context('/'):
+            catalog.metrics.start_timer()
+            render_template_string("{{ inner() }}{{ wait() }}",
+                                   inner=inner, wait=wait)
+            calls, seconds = g.upstream_timings['render']
+        # Both templates are timed and the inner one is not counted twice
+        self.assertEqual(calls, 2)
+        self.assertGreaterEqual(seconds, 0.1)
+        self.assertLess(seconds, 0.14)
+
+    def test_metrics_protected(self):
+        response = self.app.get('/metrics')
+        self.assertEqual(response.status_code, 403)
+
+    def test_metrics(self):
+        self.app.get('/Work/{}.json'.format(WORK_UUID))
+        with self.app.session_transaction() as session:
+            session['username'] = 'staff'
+        response = self.app.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        body = response.get_data(as_text=True)
+        self.assertIn(
+            'bibcat_upstream_call_seconds_count{backend="es",operation="get"} 1',
+            body)
+        self.assertIn(
+            'bibcat_request_upstream_calls_count{endpoint="detail",'
+            'backend="es"} 1',
+            body)
+
+    def test_slow_queries(self):
+        catalog.slowlog.slow_queries.clear()
+        with mock.patch.object(catalog.slowlog.slow_queries, 'threshold', 0):
+            with self.assertLogs('catalog.slowlog', 'WARNING') as logs:
+                self.app.get('/Work/{}.json'.format(WORK_UUID))
+                self.app.get('/Work/{}.json'.format(INSTANCE_UUID))
+        self.assertEqual(len(logs.output), 2)
+        with self.app.session_transaction() as session:
+            session['username'] = 'staff'
+        response = self.app.get('/reports/slow-queries')
+        self.assertEqual(response.status_code, 200)
+        result = response.get_json()
+        self.assertEqual(len(result['recent']), 2)
+        self.assertEqual(len(result['top']), 1)
+        self.assertEqual(result['top'][0]['count'], 2)
+        self.assertEqual(result['top'][0]['views'], ['detail'])
+        self.assertNotIn(WORK_UUID, result['top'][0]['query'])
+
+    def test_normalize_dsl(self):
+        dsl = {"query": {"match": {"_all": "russell crowe"}},
+               "filter": {"terms": {"_type": ["Work", "Instance"]}},
+               "size": 20}
+        self.assertEqual(
+            catalog.slowlog.normalize_dsl(dsl),
+            {"query": {"match": {"_all": "?"}},
+             "filter": {"terms": {"_type": ["?"]}},
+             "size": "?"})
+
+    def test_profile(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with mock.patch.dict(catalog.app.config,
+                                 {'PROFILE_DIR': directory}):
+                response = self.app.get(
+                    '/Work/{}.json?profile=1'.format(WORK_UUID))
+                self.assertNotIn('X-Profile', response.headers)
+                with self.app.session_transaction() as session:
+                    session['username'] = 'staff'
+                response = self.app.get(
+                    '/Work/{}.json?profile=1'.format(WORK_UUID))
+                name = response.headers['X-Profile']
+                result = self.app.get('/reports/profiles').get_json()
+                self.assertEqual(len(result['profiles']), 1)
+                self.assertEqual(result['profiles'][0]['endpoint'], 'detail')
+                self.assertTrue(result['profiles'][0]['functions'])
+                response = self.app.get('/reports/profiles/{}'.format(name))
+                self.assertEqual(response.status_code, 200)
+                self.assertIn(b'function calls', response.data)
+                response = self.app.get('/reports/profiles/missing')
+                self.assertEqual(response.status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()